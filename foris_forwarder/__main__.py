@@ -26,7 +26,10 @@ import typing
 
 import pkg_resources
 
+from foris_forwarder.aio import AsyncApp
 from foris_forwarder.app import App
+from foris_forwarder.configuration import ForwarderOptions
+from foris_forwarder.itemqueue import DROP_OLDEST, OVERFLOW_POLICIES
 
 logger = logging.getLogger(__file__)
 
@@ -96,19 +99,198 @@ def main() -> typing.NoReturn:
         help="path to fosquitto subordinates dir",
         default=pathlib.Path("/etc/fosquitto/bridges"),
     )
+    parser.add_argument(
+        "--inflight-window",
+        type=int,
+        help="max number of unconfirmed messages per direction (0 = wait for each message to be published)",
+        default=0,
+    )
+    parser.add_argument(
+        "--queue-max-items",
+        type=int,
+        help="max number of queued messages per direction and subordinate (0 = unlimited)",
+        default=0,
+    )
+    parser.add_argument(
+        "--queue-max-bytes",
+        type=int,
+        help="max payload size of queued messages per direction and subordinate (0 = unlimited)",
+        default=0,
+    )
+    parser.add_argument(
+        "--queue-overflow-policy",
+        choices=OVERFLOW_POLICIES,
+        help="which messages are dropped when a queue limit is reached",
+        default=DROP_OLDEST,
+    )
+    parser.add_argument(
+        "--ttl-request",
+        type=float,
+        help="drop queued requests which are older than given number of seconds (0 = never)",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--ttl-reply",
+        type=float,
+        help="drop queued replies which are older than given number of seconds (0 = never)",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--ttl-notification",
+        type=float,
+        help="drop queued notifications which are older than given number of seconds (0 = never)",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--retry-max-attempts",
+        type=int,
+        help="how many times is a failed operation retried (0 = unlimited)",
+        default=0,
+    )
+    parser.add_argument(
+        "--shared-host",
+        action="store_true",
+        help="use a single connection to the local message bus for all subordinates",
+        default=False,
+    )
+    parser.add_argument(
+        "--reactor",
+        action="store_true",
+        help="drive network I/O and queues of all connections from a fixed number of threads",
+        default=False,
+    )
+    parser.add_argument(
+        "--consolidated-subscriptions",
+        action="store_true",
+        help="subscribe for all controllers using wildcard topics and filter messages locally",
+        default=False,
+    )
+    parser.add_argument(
+        "--subscribe-batch-size",
+        type=int,
+        help="max number of topics in a single subscribe/unsubscribe packet (0 = unlimited)",
+        default=100,
+    )
+    parser.add_argument(
+        "--spool-dir",
+        type=pathlib.Path,
+        help="store messages for disconnected subordinates in this directory",
+        default=None,
+    )
+    parser.add_argument(
+        "--spool-max-bytes",
+        type=int,
+        help="max disk usage of the spool per subordinate",
+        default=16 * 1024 * 1024,
+    )
+    parser.add_argument(
+        "--spool-segment-size",
+        type=int,
+        help="size of a spool segment (two segments per subordinate are mapped to memory)",
+        default=1024 * 1024,
+    )
+    parser.add_argument(
+        "--reply-cache-size",
+        type=int,
+        help="max number of cached list/schema replies per subordinate (0 = disabled)",
+        default=0,
+    )
+    parser.add_argument(
+        "--reply-cache-max-age",
+        type=float,
+        help="how long can be a cached list/schema reply used (0 = till the subordinate reconnects)",
+        default=300.0,
+    )
+    parser.add_argument(
+        "--coalesce-action",
+        dest="coalesce_actions",
+        action="append",
+        metavar="MODULE/ACTION",
+        help="identical requests of this read action are forwarded only once (can be repeated, e.g. wifi/get_*)",
+        default=[],
+    )
+    parser.add_argument(
+        "--coalesce-window",
+        type=float,
+        help="how long after forwarding can be an identical request joined",
+        default=1.0,
+    )
+    parser.add_argument(
+        "--notification-rate",
+        type=float,
+        help="max notifications per second per topic passed to the host (0 = unlimited)",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--notification-burst",
+        type=int,
+        help="how many notifications of a single topic can exceed the rate at once",
+        default=5,
+    )
+    parser.add_argument(
+        "--notification-window",
+        type=float,
+        help="notifications of a topic within this window are merged, the latest wins (0 = drop over the rate)",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--metrics-listen",
+        metavar="[HOST:]PORT|PATH",
+        help="serve metrics in Prometheus text format via HTTP on a port or on a Unix socket",
+        default=None,
+    )
+    parser.add_argument(
+        "--control-socket",
+        metavar="PATH",
+        help="accept control commands (json lines) on this Unix socket",
+        default=None,
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run all forwarders within a single asyncio event loop",
+        default=False,
+    )
 
     options = parser.parse_args()
     init_logging(options.debug)
 
     logger.info("Starting Foris Forwarder (%s)" % version)
 
-    app = App(
+    app_class = AsyncApp if options.asyncio else App
+    app = app_class(
         options.controller_id,
         options.port,
         options.passwd_file[0],
         options.passwd_file[1],
         options.uci_config_dir,
         options.fosquitto_dir,
+        ForwarderOptions(
+            inflight_window=options.inflight_window,
+            queue_max_items=options.queue_max_items,
+            queue_max_bytes=options.queue_max_bytes,
+            queue_overflow_policy=options.queue_overflow_policy,
+            ttl_request=options.ttl_request,
+            ttl_reply=options.ttl_reply,
+            ttl_notification=options.ttl_notification,
+            retry_max_attempts=options.retry_max_attempts,
+            shared_host=options.shared_host,
+            reactor=options.reactor,
+            consolidated_subscriptions=options.consolidated_subscriptions,
+            subscribe_batch_size=options.subscribe_batch_size,
+            spool_dir=options.spool_dir,
+            spool_max_bytes=options.spool_max_bytes,
+            spool_segment_size=options.spool_segment_size,
+            reply_cache_size=options.reply_cache_size,
+            reply_cache_max_age=options.reply_cache_max_age,
+            coalesce_actions=options.coalesce_actions,
+            coalesce_window=options.coalesce_window,
+            notification_rate=options.notification_rate,
+            notification_burst=options.notification_burst,
+            notification_window=options.notification_window,
+        ),
+        options.metrics_listen,
+        options.control_socket,
     )
 
     # attach signal handlers
@@ -0,0 +1,904 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import asyncio
+import collections
+import logging
+import queue
+import time
+import typing
+
+from paho.mqtt import client as mqtt
+
+from . import topics
+from .app import App
+from .cache import ReplyCache
+from .client import Client, Settings, SubscriptionRegistry
+from .coalescer import RequestCoalescer
+from .configuration import ForwarderOptions
+from .configuration import Host as HostConf
+from .configuration import Subordinate as SubordinateConf
+from .configuration import Subsubordinate as SubsubordinateConf
+from .forwarder import REPLAY_DELAY
+from .itemqueue import EXPIRED, ItemQueue
+from .items import QUEUE_TIMEOUT, ItemProcessor, Publish, Subscribe
+from .latency import LatencyTracker
+from .logger import LoggingMixin
+from .metrics import DirectionMetrics
+from .scheduler import Scheduler
+from .spool import Spool
+from .throttle import NotificationThrottle
+
+SLEEP_STEP = 0.2
+
+
+class AsyncClient(LoggingMixin):
+    """Connection to one message bus driven by an asyncio event loop
+
+    Socket of the paho client is watched by the event loop (no network thread is started).
+    Only the blocking TCP connect and TLS handshake are performed in the default executor.
+    Publish, subscribe and unsubscribe are awaitable and they are completed according to mid.
+    """
+
+    MISC_PERIOD = 1.0
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(
+        self, settings: Settings, name: typing.Optional[str] = None, keepalive: int = Client.DEFAULT_KEEPALIVE
+    ):
+        self.name = name
+        self.controller_id = settings.controller_id
+        self.settings = settings
+        self.keepalive = keepalive
+        self.message_hook: typing.Optional[typing.Callable[[mqtt.Client, dict, mqtt.MQTTMessage], None]] = None
+        self.state_hook: typing.Optional[typing.Callable[[bool], None]] = None  # connected/disconnected
+
+        self.loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self.client: typing.Optional[mqtt.Client] = None
+        self._fd: typing.Optional[int] = None
+        self._misc_handle: typing.Optional[asyncio.TimerHandle] = None
+        self._closing = False
+
+        self._connected = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._disconnected.set()
+        self._connect_future: typing.Optional[asyncio.Future] = None
+
+        # mid -> future which is resolved once the publish/subscribe/unsubscribe is confirmed
+        self._futures: typing.Dict[int, asyncio.Future] = {}
+
+        # subscriptions of the broker session (it outlives the connection)
+        self.subscriptions = SubscriptionRegistry()
+        self.session_present = False
+        self.connect_count = 0  # number of successful connects
+
+    def __str__(self):
+        return f"{self.controller_id}"
+
+    def set_message_hook(self, hook: typing.Optional[typing.Callable[[mqtt.Client, dict, mqtt.MQTTMessage], None]]):
+        self.message_hook = hook
+
+    def set_state_hook(self, hook: typing.Optional[typing.Callable[[bool], None]]):
+        self.state_hook = hook
+
+    @property
+    def connected(self) -> bool:
+        return bool(self.client) and self._connected.is_set()
+
+    async def wait_until_connected(self, timeout: typing.Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def wait_until_disconnected(self):
+        await self._disconnected.wait()
+
+    def _call(self, callback: typing.Callable[[], None]):
+        """Performs the callback in the event loop (paho callbacks might be triggered from the executor)"""
+        assert self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback()
+        else:
+            self.loop.call_soon_threadsafe(callback)
+
+    def _add_socket(self, client: mqtt.Client, sock):
+        if client is not self.client or self.loop is None:
+            return  # connection was closed meanwhile
+        self._fd = sock.fileno()
+        self.loop.add_reader(self._fd, self._on_readable)
+        if client.want_write():
+            self.loop.add_writer(self._fd, self._on_writable)
+
+    def _remove_socket(self):
+        if self._fd is not None and self.loop:
+            self.loop.remove_reader(self._fd)
+            self.loop.remove_writer(self._fd)
+        self._fd = None
+
+    def _add_writer(self, client: mqtt.Client):
+        if client is self.client and self._fd is not None and self.loop:
+            self.loop.add_writer(self._fd, self._on_writable)
+
+    def _remove_writer(self, client: mqtt.Client):
+        if client is self.client and self._fd is not None and self.loop:
+            self.loop.remove_writer(self._fd)
+
+    def _on_readable(self):
+        client = self.client
+        if client is None:
+            return
+        client.loop_read()
+        # TLS layer may hold already decrypted data which won't trigger the selector
+        sock = client.socket()
+        while sock is not None and client.socket() is sock and getattr(sock, "pending", lambda: 0)():
+            client.loop_read()
+
+    def _on_writable(self):
+        if self.client:
+            self.client.loop_write()
+
+    def _misc(self):
+        if self.client and self.loop:
+            self.client.loop_misc()
+            self._misc_handle = self.loop.call_later(AsyncClient.MISC_PERIOD, self._misc)
+
+    def _fail_pending(self):
+        futures, self._futures = self._futures, {}
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Disconnected"))
+
+    def _set_disconnected(self, rc: int):
+        was_connected = self._connected.is_set()
+        self._connected.clear()
+        self._disconnected.set()
+        if self._misc_handle:
+            self._misc_handle.cancel()
+            self._misc_handle = None
+        if self._connect_future and not self._connect_future.done():
+            self._connect_future.set_result(rc or mqtt.MQTT_ERR_CONN_LOST)
+        self._fail_pending()
+        if was_connected and self.state_hook:
+            self.state_hook(False)
+
+    def _resolve(self, mid: int, result: typing.Any):
+        future = self._futures.pop(mid, None)
+        if future and not future.done():
+            future.set_result(result)
+
+    def _create_client(self) -> mqtt.Client:
+        client = Client.create_mqtt_client(self.settings, self.name or str(self))
+
+        def on_connect(client, userdata, flags, rc):
+            if rc == 0:
+                self.session_present = bool(flags.get("session present"))
+                self.connect_count += 1
+                self.debug(f"Connected to {self.settings.host}:{self.settings.port} (session={self.session_present})")
+                if not self.session_present:
+                    # broker lost the subscriptions, they need to be subscribed again
+                    self.subscriptions.clear()
+                self._disconnected.clear()
+                self._connected.set()
+                if self._misc_handle is None and self.loop:
+                    self._misc_handle = self.loop.call_later(AsyncClient.MISC_PERIOD, self._misc)
+                if self.state_hook:
+                    self.state_hook(True)
+            else:
+                self.warning(f"Failed to connect to {self.settings.host}:{self.settings.port}")
+            if self._connect_future and not self._connect_future.done():
+                self._connect_future.set_result(rc)
+
+        def on_disconnect(client, userdata, rc):
+            self.debug(f"Disconnected from {self.settings.host}:{self.settings.port} (rc={rc})")
+            self._set_disconnected(rc)
+
+        def on_message(client, userdata, message: mqtt.MQTTMessage):
+            self.debug(f"Message Received (len={len(message.payload)}) for topic `{message.topic}`")
+            if self.message_hook:
+                self.message_hook(client, userdata, message)
+
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        client.on_publish = lambda client, userdata, mid: self._resolve(mid, mid)
+        client.on_subscribe = lambda client, userdata, mid, granted_qos: self._resolve(mid, granted_qos)
+        client.on_unsubscribe = lambda client, userdata, mid: self._resolve(mid, mid)
+        client.on_message = on_message
+
+        client.on_socket_open = lambda client, userdata, sock: self._call(lambda: self._add_socket(client, sock))
+        client.on_socket_close = lambda client, userdata, sock: self._call(self._remove_socket)
+        client.on_socket_register_write = lambda client, userdata, sock: self._call(lambda: self._add_writer(client))
+        client.on_socket_unregister_write = lambda client, userdata, sock: self._call(
+            lambda: self._remove_writer(client)
+        )
+        return client
+
+    async def connect(self, timeout: typing.Optional[float] = None) -> bool:
+        """Connects to the message bus and waits for the broker to confirm the connection"""
+        self.loop = asyncio.get_running_loop()
+        if self.client:
+            # drop the previous connection attempt
+            self._close()
+
+        self._closing = False
+        client = self._create_client()
+        self.client = client
+        self._connect_future = self.loop.create_future()
+        connect_future = self._connect_future
+
+        try:
+            await asyncio.wait_for(
+                self.loop.run_in_executor(None, client.connect, self.settings.host, self.settings.port, self.keepalive),
+                timeout,
+            )
+            rc = await asyncio.wait_for(connect_future, timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            self.warning(f"Failed to connect to {self.settings.host}:{self.settings.port}: {exc!r}")
+            rc = mqtt.MQTT_ERR_NO_CONN
+
+        if self._closing or client is not self.client:
+            # disconnected while connecting
+            if client is not self.client:
+                self._discard(client)
+            return False
+
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            self._close()
+            return False
+
+        return True
+
+    async def _wait_for(self, mid: int, timeout: typing.Optional[float]) -> typing.Any:
+        assert self.loop
+        future = self.loop.create_future()
+        self._futures[mid] = future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._futures.pop(mid, None)
+
+    async def publish(self, topic: str, data: typing.Union[str, bytes], timeout: typing.Optional[float] = None):
+        """Publishes a message and waits till it is sent
+
+        :returns: True when published, False on failure, None on timeout
+        """
+        if not self.connected or self.client is None:
+            self.warning(f"Disconnected, can't send message to '{topic}'")
+            return False
+
+        # paho doesn't write to the socket inline (writer is registered), so mid can be stored afterwards
+        message = self.client.publish(topic, data)
+        if message.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.warning(f"Failed to publish message to '{topic}'")
+            return False
+
+        self.debug(f"Publishing message to '{topic}' (mid={message.mid})")
+        try:
+            await self._wait_for(message.mid, timeout)
+        except asyncio.TimeoutError:
+            return None
+        except ConnectionError:
+            return False
+        return True
+
+    async def subscribe(
+        self, topics: typing.List[typing.Tuple[str, int]], timeout: typing.Optional[float] = None
+    ) -> typing.Optional[typing.List[int]]:
+        """Subscribes to topics and waits for the confirmation
+
+        :returns: granted qos for each topic (None when the subscription failed)
+        """
+        if not self.connected or self.client is None:
+            self.warning(f"Disconnected, failed to subscribe to '{topics}'")
+            return None
+
+        res, mid = self.client.subscribe(topics)
+        if res != mqtt.MQTT_ERR_SUCCESS:
+            self.warning(f"Failed to subscribe to '{topics}'")
+            return None
+
+        try:
+            granted_qos = await self._wait_for(mid, timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            # it is not clear whether the broker got the subscription
+            return None
+
+        # registered once granted, so a concurrent subscription doesn't skip the topics meanwhile
+        self.subscriptions.confirm(topics, granted_qos)
+        return granted_qos
+
+    async def unsubscribe(self, topics: typing.List[str], timeout: typing.Optional[float] = None) -> bool:
+        if not self.connected or self.client is None:
+            self.warning(f"Disconnected, failed to unsubscribe from '{topics}'")
+            return False
+
+        res, mid = self.client.unsubscribe(topics)
+        if res != mqtt.MQTT_ERR_SUCCESS:
+            self.warning(f"Failed to unsubscribe from '{topics}'")
+            return False
+
+        self.subscriptions.remove(topics)
+
+        try:
+            await self._wait_for(mid, timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            return False
+        return True
+
+    @staticmethod
+    def _discard(client: mqtt.Client):
+        client.disconnect()
+        client.loop_write()  # try to flush DISCONNECT packet at once
+        sock = client.socket()
+        if sock:
+            sock.close()
+
+    def _close(self):
+        self._remove_socket()
+        if self.client:
+            self._discard(self.client)
+        self.client = None
+        self._set_disconnected(mqtt.MQTT_ERR_SUCCESS)
+
+    async def disconnect(self, timeout: typing.Optional[float] = None):
+        """Closes connection (also interrupts pending connection attempt)"""
+        self._closing = True
+        if self.connected and self.client:
+            self.client.disconnect()
+            try:
+                await asyncio.wait_for(self._disconnected.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._close()
+
+
+class AsyncForwarder(ItemProcessor):
+    """Passes messages between host and a single subordinate within an asyncio event loop
+
+    It has the same interface as Forwarder (start, stop, reload_subordinate, ...)
+    so it can be supervised by ForwarderSupervisor.
+    """
+
+    logger = logging.getLogger(__file__)
+
+    multiplexer = None  # host connection is not shared in asyncio mode
+
+    def __init__(
+        self,
+        host_conf: HostConf,
+        subordinate_conf: SubordinateConf,
+        subsubordinate_confs: typing.List[SubsubordinateConf] = None,
+        options: typing.Optional[ForwarderOptions] = None,
+    ):
+        self.options = options or ForwarderOptions()
+        self.host_conf = host_conf
+        self.subordinate_conf = subordinate_conf
+        self.subsubordinate_confs: typing.List[SubsubordinateConf] = subsubordinate_confs or []
+        # called when the subordinate connects or disconnects
+        self.state_hook: typing.Optional[typing.Callable[[], None]] = None
+
+        # messages of wildcard subscriptions are filtered by controller id
+        self.controller_filter: typing.Optional[typing.FrozenSet[str]] = None
+        if self.options.consolidated_subscriptions:
+            self.controller_filter = frozenset(self.controller_ids)
+
+        self.host = AsyncClient(
+            host_conf.client_settings(), f"{host_conf.controller_id}->{subordinate_conf.controller_id}"
+        )
+        self.host.set_message_hook(self.host_to_subordinate)
+        self.host.set_state_hook(lambda connected: self.connection_changed(self.host_queue, connected))
+        self.subordinate = self.new_subordinate_client(subordinate_conf)
+
+        # list and schema requests are answered locally when possible
+        self.reply_cache: typing.Optional[ReplyCache] = None
+        if self.options.reply_cache_size > 0:
+            self.reply_cache = ReplyCache(
+                subordinate_conf.controller_id, self.options.reply_cache_size, self.options.reply_cache_max_age
+            )
+
+        # identical read requests are forwarded only once
+        self.coalescer: typing.Optional[RequestCoalescer] = None
+        if self.options.coalesce_actions:
+            self.coalescer = RequestCoalescer(
+                subordinate_conf.controller_id, self.options.coalesce_actions, self.options.coalesce_window
+            )
+
+        # notifications passed to the host are limited per topic
+        self.throttle: typing.Optional[NotificationThrottle] = None
+        if self.options.notification_rate > 0 or self.options.notification_window > 0:
+            self.throttle = NotificationThrottle(
+                subordinate_conf.controller_id,
+                self.options.notification_rate,
+                self.options.notification_burst,
+                self.options.notification_window,
+            )
+
+        # requests answered with an error while the subordinate was unreachable
+        self.fast_failed = 0
+
+        # messages for disconnected subordinate are stored on the disk
+        self.spool: typing.Optional[Spool] = None
+        if self.options.spool_dir:
+            self.spool = Spool(
+                self.options.spool_dir / subordinate_conf.controller_id,
+                self.options.spool_segment_size,
+                self.options.spool_max_bytes // self.options.spool_segment_size,
+            )
+
+        self.host_retries: typing.Counter[str] = collections.Counter()
+        self.subordinate_retries: typing.Counter[str] = collections.Counter()
+        self.latency = LatencyTracker(subordinate_conf.controller_id)
+        self.host_metrics = DirectionMetrics()
+        self.subordinate_metrics = DirectionMetrics()
+
+        self.host_queue: ItemQueue = ItemQueue(*self.queue_limits)
+        self.subordinate_queue: ItemQueue = ItemQueue(*self.queue_limits)
+        self.host_wakeup = asyncio.Event()
+        self.subordinate_wakeup = asyncio.Event()
+        self.replay_wakeup = asyncio.Event()
+
+        self.host_ready = False
+        self.subordinate_ready = False
+
+        self._tasks: typing.Set[asyncio.Future] = set()
+
+    @property
+    def ready(self):
+        return self.subordinate_ready and self.host_ready
+
+    @property
+    def controller_ids(self) -> typing.List[str]:
+        """Controllers which are reachable via the subordinate"""
+        return [self.subordinate_conf.controller_id] + [e.controller_id for e in self.subsubordinate_confs]
+
+    @property
+    def subscription_ids(self) -> typing.List[str]:
+        """Controller ids used in subscribed topics (a single wildcard in consolidated mode)"""
+        if self.options.consolidated_subscriptions:
+            return [topics.WILDCARD]
+        return self.controller_ids
+
+    @property
+    def queue_limits(self) -> typing.Tuple[int, int, str]:
+        return self.options.queue_max_items, self.options.queue_max_bytes, self.options.queue_overflow_policy
+
+    def queue_stats(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """Returns depth, byte usage and drop counters of both queues (and of the spool and request latencies)"""
+        stats = {"host": self.host_queue.stats(), "subordinate": self.subordinate_queue.stats()}
+        if self.spool:
+            stats["spool"] = self.spool.stats()
+        if self.reply_cache:
+            stats["reply_cache"] = self.reply_cache.stats()
+        if self.coalescer:
+            stats["coalescer"] = self.coalescer.stats()
+        if self.throttle:
+            stats["throttle"] = self.throttle.stats()
+        if self.fast_failed:
+            stats["fast_failed"] = {"requests": self.fast_failed}
+        stats["latency"] = self.latency.stats(time.monotonic())
+        return stats
+
+    def retry_stats(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        """Returns failure, retry and give up counts of both directions"""
+        return {"host": dict(self.host_retries), "subordinate": dict(self.subordinate_retries)}
+
+    def __str__(self):
+        return f"{self.host}->{self.subordinate}"
+
+    def new_subordinate_client(self, subordinate_conf: SubordinateConf) -> AsyncClient:
+        client = AsyncClient(
+            subordinate_conf.client_settings(), f"{subordinate_conf.controller_id}->{self.host_conf.controller_id}"
+        )
+        client.set_message_hook(self.subordinate_to_host)
+        client.set_state_hook(lambda connected: self.connection_changed(self.subordinate_queue, connected))
+        return client
+
+    def connection_changed(self, item_queue: ItemQueue, connected: bool):
+        if connected and self.retry_now(item_queue):
+            # retries were planned for the previous connection
+            (self.host_wakeup if item_queue is self.host_queue else self.subordinate_wakeup).set()
+        if self.state_hook:
+            self.state_hook()
+
+    def new_publish(self, message: mqtt.MQTTMessage, age: float = 0.0) -> Publish:
+        """
+        :param age: how long ago was the message received (e.g. when stored in the spool)
+        """
+        item = Publish(message)
+        item.first_attempt -= age
+        item.expire_in(self.options.ttls.get(item.message_class))
+        return item
+
+    def host_to_subordinate(self, client, userdata, message: mqtt.MQTTMessage):
+        if self.controller_filter is not None and not topics.is_routed(message.topic, self.controller_filter):
+            return
+        self.debug(f"Msg from host to subordinate (len={len(message.payload)})")
+        item = self.new_publish(message)
+        if self.reply_cache and item.message_class == topics.LIST:
+            # replies are cached per connection (subordinate may be updated meanwhile)
+            cached = self.reply_cache.request(message.topic, message.payload, self.subordinate.connect_count)
+            if cached:
+                self.debug(f"Replying to '{message.topic}' from cache")
+                self.reply(cached.topic, cached.payload)
+                return
+        if self.subordinate_conf.fast_fail and not self.subordinate.connected:
+            # don't let the caller wait for a timeout
+            error = topics.error_reply(
+                message.topic, message.payload, f"Controller '{self.subordinate_conf.controller_id}' is unreachable"
+            )
+            if error:
+                self.debug(f"Failing '{message.topic}' (subordinate disconnected)")
+                self.fast_failed += 1
+                self.reply(error.topic, error.payload)
+                return
+        if self.coalescer and self.coalescer.request(message.topic, message.payload):
+            self.debug(f"Request '{message.topic}' joined to a forwarded one")
+            return
+        if item.message_class in (topics.REQUEST, topics.LIST):
+            self.latency.request(message.topic, message.payload, time.monotonic())
+        if self.spool and (not self.subordinate.connected or not self.spool.empty):
+            # messages are passed via the spool till it is drained to keep the order
+            if self.spool.append(message.topic, message.payload, time.time()):
+                self.replay_wakeup.set()
+                return
+        self.subordinate_queue.put(item)
+        self.subordinate_wakeup.set()
+
+    def subordinate_to_host(self, client, userdata, message: mqtt.MQTTMessage):
+        if self.controller_filter is not None and not topics.is_routed(message.topic, self.controller_filter):
+            return
+        self.debug(f"Msg from subordinate to host (len={len(message.payload)})")
+        item = self.new_publish(message)
+        if item.message_class == topics.REPLY:
+            self.latency.reply(message.topic, time.monotonic())
+        if self.reply_cache:
+            if item.message_class == topics.REPLY:
+                self.reply_cache.reply(message.topic, message.payload)
+            elif item.message_class == topics.NOTIFICATION:
+                self.reply_cache.notification(message.topic)
+        if self.throttle and item.message_class == topics.NOTIFICATION:
+            delay = self.throttle.offer(message.topic, item, time.monotonic(), self.host_queue.merge_delayed)
+            if delay is None:
+                return  # merged to a held notification or dropped
+            if delay:
+                self.host_queue.put_later(item, delay)
+                self.host_wakeup.set()  # the pump needs to wait for the delayed item
+                return
+        self.host_queue.put(item)
+        self.host_wakeup.set()
+        if self.coalescer and item.message_class == topics.REPLY:
+            for copy in self.coalescer.reply(message.topic, message.payload):
+                self.reply(copy.topic, copy.payload)
+
+    def reply(self, topic: str, payload: bytes):
+        """Passes a reply which was not sent by the subordinate to the host"""
+        message = mqtt.MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        self.host_queue.put(self.new_publish(message))
+        self.host_wakeup.set()
+
+    def host_topics(self) -> typing.List[typing.Tuple[str, int]]:
+        return [e for controller_id in self.subscription_ids for e in topics.host_topics(controller_id)]
+
+    def subordinate_topics(self) -> typing.List[typing.Tuple[str, int]]:
+        return [e for controller_id in self.subscription_ids for e in topics.subordinate_topics(controller_id)]
+
+    def _spawn(self, coroutine: typing.Awaitable) -> asyncio.Future:
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def maintain_host(self):
+        await self.maintain(lambda: self.host, self.host_topics, "host_ready")
+
+    async def maintain_subordinate(self):
+        await self.maintain(lambda: self.subordinate, self.subordinate_topics, "subordinate_ready")
+
+    async def maintain(
+        self,
+        get_client: typing.Callable[[], AsyncClient],
+        get_topics: typing.Callable[[], typing.List[typing.Tuple[str, int]]],
+        ready_attr: str,
+    ):
+        """Keeps the client connected and subscribed (client may be replaced on reload)"""
+        attempt_number = 0
+        while True:
+            client = get_client()
+            setattr(self, ready_attr, False)
+            if await client.connect(QUEUE_TIMEOUT) and client is get_client():
+                # topics which are kept within the broker session are not subscribed again
+                if await self.subscribe(client, client.subscriptions.missing(get_topics())):
+                    attempt_number = 0
+                    setattr(self, ready_attr, True)
+                    await client.wait_until_disconnected()
+                    continue
+                await client.disconnect()
+
+            if client is not get_client():
+                continue  # subordinate was reloaded, connect to the new one at once
+
+            attempt_number += 1
+            await asyncio.sleep(self.retry_delay(attempt_number))
+
+    async def subscribe(self, client: AsyncClient, topics_with_qos: typing.List[typing.Tuple[str, int]]) -> bool:
+        """Subscribes in batches, topics rejected by the broker are retried separately
+
+        :returns: False when the client failed to subscribe (e.g. disconnected)
+        """
+        limit = self.options.subscribe_batch_size or len(topics_with_qos) or 1
+        attempt_number = 0
+        while topics_with_qos:
+            rejected = []
+            for start in range(0, len(topics_with_qos), limit):
+                batch = topics_with_qos[start : start + limit]
+                granted_qos = await client.subscribe(batch, QUEUE_TIMEOUT)
+                if granted_qos is None:
+                    return False
+                rejected.extend(Subscribe.rejected(batch, granted_qos))
+
+            max_attempts = self.options.retry_max_attempts
+            if rejected and max_attempts and attempt_number >= max_attempts:
+                self.warning(f"Subscription of {[e[0] for e in rejected]} rejected, giving up")
+                break
+
+            topics_with_qos = rejected
+            if rejected:
+                attempt_number += 1
+                await asyncio.sleep(self.retry_delay(attempt_number))
+
+        return True
+
+    async def pump(
+        self,
+        item_queue: ItemQueue,
+        wakeup: asyncio.Event,
+        get_client: typing.Callable[[], AsyncClient],
+        retries: typing.Counter[str],
+        metrics: DirectionMetrics,
+    ):
+        """Publishes queued messages"""
+        window = asyncio.Semaphore(self.options.inflight_window) if self.options.inflight_window > 0 else None
+        while True:
+            try:
+                item = item_queue.get(False)
+            except queue.Empty:
+                wakeup.clear()
+                # delayed items (retries) are not announced, wait till the first one is due
+                next_due = item_queue.next_due()
+                try:
+                    await asyncio.wait_for(
+                        wakeup.wait(), None if next_due is None else max(next_due - time.monotonic(), 0.0)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            item_queue.task_done()
+            if item is False:
+                # terminating on empty message
+                return
+
+            if window is not None:
+                # pipelined publishing, don't wait for the confirmation
+                await window.acquire()
+                task = self._spawn(self.process_publish(item, item_queue, get_client(), retries, metrics))
+                task.add_done_callback(lambda _: self.published(window, wakeup))  # type: ignore
+            else:
+                await self.process_publish(item, item_queue, get_client(), retries, metrics)
+
+    @staticmethod
+    def published(window: asyncio.Semaphore, wakeup: asyncio.Event):
+        """Frees a slot of the in-flight window (the publish may have planned a retry meanwhile)"""
+        window.release()
+        wakeup.set()
+
+    async def process_publish(
+        self,
+        item: Publish,
+        item_queue: ItemQueue,
+        client: AsyncClient,
+        retries: typing.Counter[str],
+        metrics: DirectionMetrics,
+    ) -> typing.Optional[bool]:
+        now = time.monotonic()
+        if item.expired(now):
+            # nobody is waiting for the message anymore
+            item_queue.record_drop(EXPIRED)
+            self.debug("Dropping expired Publish")
+            return None
+
+        res = await client.publish(item.message.topic, item.message.payload, self.options.publish_timeout)
+        if res:
+            metrics.published(item.size, time.monotonic() - now)
+        if not res and not client.connected:
+            # the connection failed, get rid of the stale items at once
+            flushed = item_queue.flush_expired(now)
+            if flushed:
+                self.debug(f"Flushed {flushed} expired items")
+
+        if not res:
+            retries["failures"] += 1
+            self.plan_retry(item, item_queue, retries)
+
+        return res
+
+    async def replay(self):
+        """Sends messages stored in the spool once the subordinate is connected"""
+        assert self.spool
+        while True:
+            if self.spool.empty:
+                self.replay_wakeup.clear()
+                await self.replay_wakeup.wait()
+                continue
+
+            client = self.subordinate
+            if not client.connected:
+                await asyncio.sleep(REPLAY_DELAY)
+                continue
+
+            now = time.time()
+            for record in self.spool.read(self.options.spool_batch_size):
+                message = mqtt.MQTTMessage(topic=record.topic.encode())
+                message.payload = record.payload
+                item = self.new_publish(message, max(now - record.created, 0.0))
+                started = time.monotonic()
+                if item.expired(started):
+                    self.subordinate_queue.record_drop(EXPIRED)
+                elif not await client.publish(item.message.topic, item.message.payload, self.options.publish_timeout):
+                    # not committed => it will be sent again
+                    await asyncio.sleep(REPLAY_DELAY)
+                    break
+                else:
+                    self.subordinate_metrics.published(item.size, time.monotonic() - started)
+                self.spool.commit(record.position)
+
+    def start(self):
+        """Starts to connect to both subordinate and host (needs to be called within the event loop)"""
+        self.debug("Starting tasks")
+        self._spawn(self.maintain_host())
+        self._spawn(self.maintain_subordinate())
+        self._spawn(
+            self.pump(
+                self.subordinate_queue,
+                self.subordinate_wakeup,
+                lambda: self.subordinate,
+                self.subordinate_retries,
+                self.subordinate_metrics,
+            )
+        )
+        self._spawn(
+            self.pump(self.host_queue, self.host_wakeup, lambda: self.host, self.host_retries, self.host_metrics)
+        )
+        if self.spool:
+            # messages stored before restart are sent as well
+            self._spawn(self.replay())
+
+    def stop(self):
+        """Stops the tasks and disconnects"""
+        self.debug("Stopping")
+        for task in list(self._tasks):
+            task.cancel()
+        self.host_ready = False
+        self.subordinate_ready = False
+        self._spawn(self.host.disconnect(QUEUE_TIMEOUT))
+        self._spawn(self.subordinate.disconnect(QUEUE_TIMEOUT))
+        if self.spool:
+            self.spool.close()
+
+    async def wait_for_ready(self, timeout: typing.Optional[float] = None) -> bool:
+        start = time.monotonic()
+        while not self.ready:
+            if timeout and time.monotonic() - start > timeout:
+                return False
+            await asyncio.sleep(SLEEP_STEP)
+        return True
+
+    async def wait_for_disconnected(self, timeout: typing.Optional[float] = None) -> bool:
+        start = time.monotonic()
+        while self.subordinate.connected or self.host.connected:
+            if timeout and time.monotonic() - start > timeout:
+                return False
+            await asyncio.sleep(SLEEP_STEP)
+        return True
+
+    def reload_subordinate(self, subordinate_conf: SubordinateConf):
+        """Replaces the subordinate connection (the new one is connected in background)"""
+        self.debug(f"Reloading subordinate {subordinate_conf} ({subordinate_conf.ip}:{subordinate_conf.port})")
+
+        previous = self.subordinate
+        self.subordinate_conf = subordinate_conf
+        self.subordinate = self.new_subordinate_client(subordinate_conf)
+        # same controller => same broker session (reconciled once connected)
+        self.subordinate.subscriptions = previous.subscriptions
+        self.subordinate_metrics.connects += previous.connect_count
+        if self.reply_cache:
+            self.reply_cache.invalidate()
+
+        # pending messages (incl. retries) are sent via the new connection
+        self.subordinate_queue.remove_if(lambda item: not isinstance(item, (bool, Publish)))
+        if self.retry_now(self.subordinate_queue):
+            self.subordinate_wakeup.set()
+
+        # maintain task notices the disconnection and connects the new client
+        self._spawn(previous.disconnect(QUEUE_TIMEOUT))
+
+
+class AsyncApp(App):
+    """App which runs all forwarders within a single asyncio event loop
+
+    `serve` coroutine can be used to embed the forwarder into an existing event loop.
+    """
+
+    loop: typing.Optional[asyncio.AbstractEventLoop] = None
+
+    def call(self, function: typing.Callable[..., typing.Any], *args) -> typing.Any:
+        """Forwarders are manipulated only within the event loop"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None and running is self.loop:
+            # called within the loop (e.g. from a signal handler)
+            return function(*args)
+        assert self.loop
+        return asyncio.run_coroutine_threadsafe(self._call(function, *args), self.loop).result()
+
+    @staticmethod
+    async def _call(function: typing.Callable[..., typing.Any], *args) -> typing.Any:
+        return function(*args)
+
+    def run(self) -> typing.NoReturn:  # type: ignore
+        asyncio.run(self.serve())
+        raise RuntimeError("Event loop terminated")
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self.scheduler = Scheduler(lambda: loop.call_soon_threadsafe(wakeup.set))
+
+        # Create forwarders
+        for controller_id, subordinate in self.configuration.subordinates.items():
+            self.add_supervisor(
+                controller_id,
+                AsyncForwarder(self.configuration.host, subordinate, self.subsubordinates(controller_id), self.options),
+            )
+
+        # zconf handlers are triggered from zconf threads
+        self.zconf_listener = self.listen_zconf(lambda handler, *args: loop.call_soon_threadsafe(handler, *args))
+        self.start_metrics_server()
+        self.loop = loop
+        self.start_control_server()
+
+        while True:
+            wakeup.clear()
+            self.check_supervisors(self.scheduler.pop_due(time.monotonic()))
+
+            # sleeps till a subordinate connects/disconnects or till a deadline of a supervisor
+            next_due = self.scheduler.next_due()
+            try:
+                await asyncio.wait_for(wakeup.wait(), None if next_due is None else next_due - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
@@ -17,6 +17,7 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 #
 
+import functools
 import ipaddress
 import logging
 import pathlib
@@ -25,12 +26,20 @@ import time
 import typing
 from abc import ABCMeta
 
-from .configuration import Configuration
+from .configuration import Configuration, ForwarderOptions, Subsubordinate
+from .control import ControlServer
 from .forwarder import Forwarder
 from .logger import LoggingMixin
+from .metrics import MetricsServer, collect
+from .multiplexer import HostMultiplexer
+from .reactor import Reactor
+from .scheduler import Scheduler
 from .supervisor import ForwarderSupervisor
 from .zconf import Listener as ZconfListener
 
+if typing.TYPE_CHECKING:
+    from .aio import AsyncForwarder
+
 
 class SingletonAppMeta(ABCMeta):  # ABCMeta is metaclass of LoggingMixin (it needs to be used here as well)
     """Make sure that there is only one app instance created"""
@@ -52,7 +61,8 @@ class App(LoggingMixin, metaclass=SingletonAppMeta):  # type: ignore
     * updates configuration from zeroconf
     """
 
-    WAIT_LOOP_PERIOD = 0.200
+    STATUS_PERIOD = 1.0
+    STATUS_KEY = "status"  # scheduler key of a planned status refresh (not a controller id)
 
     logger = logging.getLogger(__file__)
 
@@ -64,6 +74,9 @@ class App(LoggingMixin, metaclass=SingletonAppMeta):  # type: ignore
         password: str,
         uci_config_dir: pathlib.Path,
         fosquitto_dir: pathlib.Path,
+        options: typing.Optional[ForwarderOptions] = None,
+        metrics_listen: typing.Optional[str] = None,
+        control_socket: typing.Optional[str] = None,
     ):
         """Instantiates a Foris Forwarder app
         :param controller_id: name of the host foris-controller
@@ -72,30 +85,108 @@ class App(LoggingMixin, metaclass=SingletonAppMeta):  # type: ignore
         :param password: password used to access local foris-controller
         :param uci_config_dir: destinaton where required uci configs are stored
         :param fosquitto_dir: path to directory with mosquitto certificates
+        :param options: tunables passed to all forwarders
+        :param metrics_listen: serve metrics on [host:]port or on a Unix socket path (None = disabled)
+        :param control_socket: path of Unix socket where control commands are accepted (None = disabled)
         """
         self.configuration = Configuration(controller_id, port, username, password, uci_config_dir, fosquitto_dir)
+        self.options = options or ForwarderOptions()
+        self.multiplexer: typing.Optional[HostMultiplexer] = None
+        self.reactor: typing.Optional[Reactor] = None
+        self.zconf_listener: typing.Optional[ZconfListener] = None
+        self.metrics_listen = metrics_listen
+        self.control_socket = control_socket
+        self.control_server: typing.Optional[ControlServer] = None
         self._supervisors_lock = threading.Lock()
         self._supervisors: typing.Dict[str, ForwarderSupervisor] = {}
+        # supervisors are checked when their subordinate connects/disconnects or when their deadline passes
+        self.scheduler = Scheduler()
+
+        # snapshot of forwarders states (replaced as a whole so it can be read without locking)
+        self.status: typing.Dict[str, typing.Any] = {"updated": None, "forwarders": {}}
+        self._status_updated_at: typing.Optional[float] = None
 
     def print_forwarders(self):
-        """Prints forwarders with its connection state to stdout"""
+        """Prints forwarders with its connection state to stdout (from the latest status snapshot)"""
+
+        for controller_id, status in self.current_status()["forwarders"].items():
+            queues = status["queues"]
+            retries = status["retries"]
+            print(
+                status["forwarder"],
+                f"{status['host_connected']}-{status['subordinate_connected']} "
+                f"{[e['netloc'] for e in status['netlocs']]} "
+                f"host_queue={queues['host']} subordinate_queue={queues['subordinate']} "
+                f"host_retries={retries['host']} subordinate_retries={retries['subordinate']} "
+                f"latency={queues['latency']}",
+            )
 
-        with self._supervisors_lock:
-            for controller_id, supervisor in self._supervisors.items():
-                print(
-                    supervisor.forwarder,
-                    f"{supervisor.forwarder.host.connected}-{supervisor.forwarder.subordinate.connected} "
-                    f"{[str(e[0]) + ':' + str(e[1]) for e in supervisor.netlocs]}",
-                )
+    def update_status(self, now: float):
+        """Creates a new status snapshot (at most once per STATUS_PERIOD)
 
-    def run(self) -> typing.NoReturn:
+        When the snapshot is too recent, a refresh is planned so that the change isn't lost.
+        """
+        if self._status_updated_at is not None and self._status_updated_at + App.STATUS_PERIOD > now:
+            self.scheduler.schedule(App.STATUS_KEY, self._status_updated_at + App.STATUS_PERIOD)
+            return
+        self._status_updated_at = now
+        forwarders = {controller_id: e.status() for controller_id, e in list(self._supervisors.items())}
+        self.status = {"updated": time.time(), "forwarders": forwarders}
+
+    def current_status(self) -> typing.Dict[str, typing.Any]:
+        """Returns the status snapshot (a new one is created when it is outdated)"""
+        self.call(self.update_status, time.monotonic())
+        return self.status
+
+    def check_supervisors(self, controller_ids: typing.Iterable[str]):
+        """Checks the supervisors and plans their next checks (the status snapshot is refreshed as well)"""
+        with self._supervisors_lock:
+            for controller_id in controller_ids:
+                supervisor = self._supervisors.get(controller_id)
+                if supervisor:
+                    self.scheduler.schedule(controller_id, supervisor.check())
+        self.update_status(time.monotonic())
 
-        # Create forwarders
-        for controller_id, subordinate in self.configuration.subordinates.items():
-            subsubordinates = [e for e in self.configuration.subsubordinates.values() if e.via == controller_id]
+    def add_supervisor(self, controller_id: str, forwarder: typing.Union[Forwarder, "AsyncForwarder"]):
+        with self._supervisors_lock:
             self._supervisors[controller_id] = ForwarderSupervisor(
-                Forwarder(self.configuration.host, subordinate, subsubordinates)
+                forwarder, functools.partial(self.scheduler.notify, controller_id)
             )
+        self.scheduler.notify(controller_id)
+
+    def supervisor(self, controller_id: str) -> typing.Optional[ForwarderSupervisor]:
+        return self._supervisors.get(controller_id)
+
+    def call(self, function: typing.Callable[..., typing.Any], *args) -> typing.Any:
+        """Calls a function which manipulates forwarders (from a different thread)"""
+        return function(*args)
+
+    def start_control_server(self):
+        if self.control_socket:
+            self.control_server = ControlServer(self.control_socket, self)
+            self.control_server.start()
+
+    def collect_metrics(self) -> str:
+        """Renders metrics of all forwarders in Prometheus text format"""
+        # supervisors lock is not taken (it is held while the supervisors are checked),
+        # a copy of the values is not affected by supervisors added meanwhile
+        return collect(list(self._supervisors.values()))
+
+    def start_metrics_server(self):
+        if self.metrics_listen:
+            self.metrics_server = MetricsServer(self.metrics_listen, self.collect_metrics)
+            self.metrics_server.start()
+
+    def subsubordinates(self, controller_id: str) -> typing.List[Subsubordinate]:
+        """Subsubordinates which are reachable via the subordinate"""
+        return [e for e in self.configuration.subsubordinates.values() if e.via == controller_id]
+
+    def listen_zconf(
+        self, dispatch: typing.Callable[..., None] = lambda handler, *args: handler(*args)
+    ) -> ZconfListener:
+        """Starts to update list of ips from zconf
+        :param dispatch: calls the update handler (e.g. within a different thread)
+        """
 
         # initiate zconf
         zconf_listener = ZconfListener()
@@ -105,25 +196,47 @@ class App(LoggingMixin, metaclass=SingletonAppMeta):  # type: ignore
             self.debug(f"Recieved zconf update from {controller_id}: {[str(e) for e in addresses]} :{port}")
             supervisor = self._supervisors.get(controller_id)
             if supervisor:
-                supervisor.zconf_update(addresses, port)
+                dispatch(supervisor.zconf_update, addresses, port)
 
         zconf_listener.set_add_service_handler(zconf_handler)
         zconf_listener.set_update_service_handler(zconf_handler)
 
-        while True:
-            start_at = time.monotonic()
+        return zconf_listener
 
-            # TODO check for update configurations
+    def run(self) -> typing.NoReturn:
+
+        if self.options.reactor:
+            self.reactor = Reactor()
+            self.reactor.start()
 
-            # Update supervisors state
-            with self._supervisors_lock:
-                for supervisor in self._supervisors.values():
-                    supervisor.check()
+        if self.options.shared_host:
+            self.multiplexer = HostMultiplexer(self.configuration.host, self.options, self.reactor)
+            self.multiplexer.state_hook = lambda: self.scheduler.notify(App.STATUS_KEY)
+            self.multiplexer.start()
+
+        # Create forwarders
+        for controller_id, subordinate in self.configuration.subordinates.items():
+            self.add_supervisor(
+                controller_id,
+                Forwarder(
+                    self.configuration.host,
+                    subordinate,
+                    self.subsubordinates(controller_id),
+                    self.options,
+                    self.multiplexer,
+                    self.reactor,
+                ),
+            )
+
+        self.zconf_listener = self.listen_zconf()
+        self.start_metrics_server()
+        self.start_control_server()
+
+        while True:
+            # TODO check for update configurations
 
-            # sleep for required interval
-            sleep_for = start_at + App.WAIT_LOOP_PERIOD - time.monotonic()
-            if sleep_for > 0:
-                time.sleep(sleep_for)
+            # sleeps till a subordinate connects/disconnects or till a deadline of a supervisor
+            self.check_supervisors(self.scheduler.wait())
 
     def __str__(self):
         return "MainApp"
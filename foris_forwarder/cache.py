@@ -0,0 +1,128 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import collections
+import json
+import logging
+import threading
+import time
+import typing
+
+from . import topics
+from .logger import LoggingMixin
+
+# notifications of these modules may change the list of modules or the schema (e.g. after an update)
+INVALIDATING_MODULES = ("updater", "maintain")
+
+
+class ReplyCache(LoggingMixin):
+    """Bounded cache of replies to list and schema requests
+
+    Request topic and payload (without reply_msg_id) are used as the key.
+    Replies are matched to requests according to the reply id which
+    is a part of the reply topic.
+    """
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, name: str, max_entries: int, max_age: float):
+        """
+        :param max_entries: max number of cached replies (and of requests waiting for a reply)
+        :param max_age: how long can a reply be served from the cache (0 = till invalidated)
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        # (request topic, request payload) -> (reply payload, stored at)
+        self._entries: typing.OrderedDict[typing.Tuple[str, str], typing.Tuple[bytes, float]] = (
+            collections.OrderedDict()
+        )
+        # reply id -> key of the forwarded request
+        self._pending: typing.OrderedDict[str, typing.Tuple[str, str]] = collections.OrderedDict()
+        self._generation: typing.Any = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"cache-{self.name}"
+
+    def request(self, topic: str, payload: bytes, generation: typing.Any = None) -> typing.Optional[topics.Reply]:
+        """Returns cached reply (or remembers that the request is waiting for a reply)
+        :param generation: cache is cleared when it changes (e.g. connection number)
+        """
+        parsed = topics.parse_request(payload)
+        if not parsed:
+            return None
+        reply_id, data = parsed
+        key = (topic, json.dumps(data, sort_keys=True))
+        now = time.monotonic()
+
+        with self._lock:
+            if generation != self._generation:
+                self._clear()
+                self._generation = generation
+
+            entry = self._entries.get(key)
+            if entry and (not self.max_age or entry[1] + self.max_age > now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return topics.Reply(topics.reply_topic(topic, reply_id), entry[0])
+
+            self.misses += 1
+            self._pending[reply_id] = key
+            while len(self._pending) > self.max_entries:
+                self._pending.popitem(last=False)
+            return None
+
+    def reply(self, topic: str, payload: bytes):
+        """Stores the reply if it belongs to a cached request"""
+        reply_id = topic.rsplit("/", 1)[-1]
+        with self._lock:
+            key = self._pending.pop(reply_id, None)
+            if key is None:
+                return
+            self._entries[key] = (payload, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def notification(self, topic: str):
+        """Invalidates replies of the controller when it announces a change"""
+        parts = topic.split("/", 4)
+        if len(parts) > 3 and parts[3] in INVALIDATING_MODULES:
+            self.invalidate(parts[1])
+
+    def invalidate(self, controller_id: typing.Optional[str] = None):
+        """Drops cached replies (of a single controller or all)"""
+        with self._lock:
+            if controller_id is None:
+                self._clear()
+                return
+            for key in [key for key in self._entries if topics.controller_id(key[0]) == controller_id]:
+                del self._entries[key]
+
+    def _clear(self):
+        self._entries.clear()
+        self._pending.clear()
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -25,6 +25,9 @@ import typing
 from paho.mqtt import client as mqtt
 
 from .logger import LoggingMixin
+from .reactor import Reactor
+
+SUBSCRIBE_FAILURE = 0x80  # granted qos of a rejected topic
 
 
 class Settings:
@@ -65,6 +68,51 @@ class PasswordSettings(Settings):
         self.password = password
 
 
+class SubscriptionRegistry:
+    """Topics which were granted by the broker within the broker session of a client
+
+    The broker keeps subscriptions of a persistent session (clean_session=False)
+    so these topics don't need to be subscribed again after a reconnect
+    unless the broker reports that the session is not present.
+    """
+
+    def __init__(self):
+        self._topics: typing.Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def topics(self) -> typing.List[typing.Tuple[str, int]]:
+        with self._lock:
+            return list(self._topics.items())
+
+    def missing(self, topics_with_qos: typing.List[typing.Tuple[str, int]]) -> typing.List[typing.Tuple[str, int]]:
+        """Filters out topics which are already subscribed"""
+        with self._lock:
+            return [(topic, qos) for topic, qos in topics_with_qos if self._topics.get(topic) != qos]
+
+    def add(self, topics_with_qos: typing.List[typing.Tuple[str, int]]):
+        with self._lock:
+            self._topics.update(topics_with_qos)
+
+    def confirm(self, topics_with_qos: typing.List[typing.Tuple[str, int]], granted_qos: typing.Sequence[int]):
+        """Registers topics which were granted by the broker (rejected ones are dropped)"""
+        with self._lock:
+            for (topic, qos), granted in zip(topics_with_qos, granted_qos):
+                if granted == SUBSCRIBE_FAILURE:
+                    self._topics.pop(topic, None)
+                else:
+                    self._topics[topic] = qos
+
+    def remove(self, topics: typing.Iterable[str]):
+        with self._lock:
+            for topic in topics:
+                self._topics.pop(topic, None)
+
+    def clear(self):
+        with self._lock:
+            self._topics.clear()
+
+
 class Client(LoggingMixin):
     """Class which handle connection to one message bus (basically a wrapper arount MQTTClient)
 
@@ -77,12 +125,22 @@ class Client(LoggingMixin):
 
     logger = logging.getLogger(__file__)
 
-    def __init__(self, settings: Settings, name: typing.Optional[str] = None, keepalive: int = DEFAULT_KEEPALIVE):
+    def __init__(
+        self,
+        settings: Settings,
+        name: typing.Optional[str] = None,
+        keepalive: int = DEFAULT_KEEPALIVE,
+        reactor: typing.Optional[Reactor] = None,
+    ):
+        """
+        :param reactor: network I/O is driven by the shared reactor instead of a thread per client
+        """
         self.name = name
         self.controller_id = settings.controller_id
         self.settings = settings
         self.connect_hook: typing.Optional[typing.Callable[[mqtt.Client, dict, dict, int], None]] = None
         self.disconnect_hook: typing.Optional[typing.Callable[[mqtt.Client, dict, int], None]] = None
+        self.state_hook: typing.Optional[typing.Callable[[bool], None]] = None  # connected/disconnected
         self.publish_hook: typing.Optional[typing.Callable[[mqtt.Client, dict, int], None]] = None
         self.subscribe_hook: typing.Optional[
             typing.Optional[typing.Callable[[mqtt.Client, dict, int, typing.List[int]], None]]
@@ -91,9 +149,21 @@ class Client(LoggingMixin):
         self.message_hook: typing.Optional[
             typing.Optional[typing.Callable[[mqtt.Client, dict, mqtt.MQTTMessage], None]]
         ] = None
+        # topics lost together with the broker session (they should be subscribed again)
+        self.resubscribe_hook: typing.Optional[typing.Callable[[typing.List[typing.Tuple[str, int]]], None]] = None
         self._connected = threading.Event()
         self.client: typing.Optional[mqtt.Client] = None
         self.keepalive = keepalive
+        self.reactor = reactor
+
+        # subscriptions of the broker session (it outlives the connection)
+        self.subscriptions = SubscriptionRegistry()
+        self.session_present = False
+        self.connect_count = 0  # number of successful connects (incl. automatic reconnects)
+
+        # mid -> callback which is triggered once the publish/subscribe/unsubscribe is confirmed
+        self._completions: typing.Dict[int, typing.Callable[..., None]] = {}
+        self._completions_lock = threading.Lock()
 
     def __str__(self):
         return f"{self.controller_id}"
@@ -107,6 +177,14 @@ class Client(LoggingMixin):
     def set_disconnect_hook(self, hook: typing.Optional[typing.Callable[[mqtt.Client, dict, int], None]]):
         self.disconnect_hook = hook
 
+    def set_state_hook(self, hook: typing.Optional[typing.Callable[[bool], None]]):
+        """Hook which is called whenever the client connects or disconnects (it is not replaced by items)"""
+        self.state_hook = hook
+
+    def set_resubscribe_hook(self, hook: typing.Optional[typing.Callable[[typing.List[typing.Tuple[str, int]]], None]]):
+        """Hook which is called with the lost topics when the broker didn't keep the session"""
+        self.resubscribe_hook = hook
+
     def set_publish_hook(self, hook: typing.Optional[typing.Callable[[mqtt.Client, dict, int], None]]):
         self.publish_hook = hook
 
@@ -136,32 +214,52 @@ class Client(LoggingMixin):
         """blocks current thread until client is connected"""
         self._connected.wait(timeout)
 
+    @classmethod
+    def create_mqtt_client(cls, settings: Settings, client_id: str) -> mqtt.Client:
+        """Creates paho client with credentials according to settings"""
+        client = mqtt.Client(client_id=client_id, clean_session=False)
+        client.enable_logger(cls.logger)
+
+        if settings.ca_certs and settings.certfile and settings.keyfile:
+            cls.logger.debug(f"ca_certs: '{settings.ca_certs}'")
+            cls.logger.debug(f"certfile: '{settings.certfile}'")
+            cls.logger.debug(f"keyfile: '{settings.keyfile}'")
+            client.tls_set(*map(str, (settings.ca_certs, settings.certfile, settings.keyfile)))
+            client.tls_insecure_set(True)  # certificate is pinned the host name is not matching
+        if settings.username and settings.password:
+            client.username_pw_set(settings.username, settings.password)
+
+        return client
+
     def connect(self):
 
-        self.client = mqtt.Client(client_id=self.name or str(self), clean_session=False)
-        self.client.enable_logger(self.logger)
+        if self.client:
+            # drop the previous connection attempt (e.g. when connect is retried)
+            self._close()
+
+        self.client = self.create_mqtt_client(self.settings, self.name or str(self))
 
-        if self.settings.ca_certs and self.settings.certfile and self.settings.keyfile:
-            self.debug(f"ca_certs: '{self.settings.ca_certs}'")
-            self.debug(f"certfile: '{self.settings.certfile}'")
-            self.debug(f"keyfile: '{self.settings.keyfile}'")
-            self.client.tls_set(*map(str, (self.settings.ca_certs, self.settings.certfile, self.settings.keyfile)))
-            self.client.tls_insecure_set(True)  # certificate is pinned the host name is not matching
-        if self.settings.username and self.settings.password:
-            self.client.username_pw_set(self.settings.username, self.settings.password)
+        # mids of the previous connection are no longer valid
+        with self._completions_lock:
+            self._completions.clear()
 
         def on_connect(client, userdata, flags, rc):
             self.debug(
                 f"Forwarded trying to connect to {self.settings.host}:{self.settings.port}",
             )
             if rc == 0:
-                self.debug(f"Connected to {self.settings.host}:{self.settings.port}")
+                self.session_present = bool(flags.get("session present"))
+                self.debug(f"Connected to {self.settings.host}:{self.settings.port} (session={self.session_present})")
+                self.connect_count += 1
                 self._connected.set()
+                self.reconcile_subscriptions()
             else:
                 self.warning(f"Failed to connect to {self.settings.host}:{self.settings.port}")
 
             if self.connect_hook:
                 self.connect_hook(client, userdata, flags, rc)
+            if self.state_hook and rc == 0:
+                self.state_hook(True)
 
         def on_disconnect(client, userdata, rc):
             if rc == 0:
@@ -171,19 +269,30 @@ class Client(LoggingMixin):
 
             if self.disconnect_hook:
                 self.disconnect_hook(client, userdata, rc)
+            if self.state_hook:
+                self.state_hook(False)
 
         def on_publish(client, userdata, mid):
             self.debug(f"Published (mid={mid}) was published")
+            completion = self._pop_completion(mid)
+            if completion:
+                completion(mid)
             if self.publish_hook:
                 self.publish_hook(client, userdata, mid)
 
         def on_subscribe(client, userdata, mid, granted_qos):
             self.debug(f"Subscribed (mid={mid}) was published")
+            completion = self._pop_completion(mid)
+            if completion:
+                completion(mid, granted_qos)
             if self.subscribe_hook:
                 self.subscribe_hook(client, userdata, mid, granted_qos)
 
         def on_unsubscribe(client, userdata, mid):
             self.debug(f"Unubscribed (mid={mid}) was published")
+            completion = self._pop_completion(mid)
+            if completion:
+                completion(mid)
             if self.unsubscribe_hook:
                 self.unsubscribe_hook(client, userdata, mid)
 
@@ -198,18 +307,62 @@ class Client(LoggingMixin):
         self.client.on_subscribe = on_subscribe
         self.client.on_unsubscribe = on_unsubscribe
         self.client.on_message = on_message
-        self.client.connect_async(self.settings.host, self.settings.port, self.keepalive)
 
-        self.client.loop_start()
+        if self.reactor:
+            client = self.client
+
+            def connect_failed():
+                # nobody waits for the timeout when the connection can't be opened
+                if self.client is client:
+                    on_connect(client, None, {}, mqtt.CONNACK_REFUSED_SERVER_UNAVAILABLE)
+
+            self.reactor.connect(client, self.settings.host, self.settings.port, self.keepalive, connect_failed)
+        else:
+            self.client.connect_async(self.settings.host, self.settings.port, self.keepalive)
+            self.client.loop_start()
+
+    def _close(self):
+        if self.reactor:
+            self.reactor.release(self.client)
+            self.client.disconnect()
+        else:
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def reconcile_subscriptions(self):
+        """Plans to subscribe again when the broker lost the session (called after every connect)
 
-    def publish(self, topic: str, data: str) -> typing.Optional[int]:
+        The topics are passed to the resubscribe hook, so they are subscribed
+        (and retried when rejected) the same way as any other subscription.
+        """
+        if self.session_present:
+            return
+        lost = self.subscriptions.topics
+        self.subscriptions.clear()
+        if lost:
+            self.info(f"Session not present, subscribing {len(lost)} topics again")
+            if self.resubscribe_hook:
+                self.resubscribe_hook(lost)
+
+    def _pop_completion(self, mid: int) -> typing.Optional[typing.Callable[..., None]]:
+        with self._completions_lock:
+            return self._completions.pop(mid, None)
+
+    def publish(
+        self, topic: str, data: str, completion: typing.Optional[typing.Callable[[int], None]] = None
+    ) -> typing.Optional[int]:
         """Publishes messages
 
         This doesn't mean that the message was acutally sent.
         on_publish hook should be checked to determined whether the message was sent
+        :param completion: called with mid once the message is published (matched by mid, not by hook)
         """
         if self.connected and self.client is not None:
-            message = self.client.publish(topic, data)
+            # the lock makes sure that on_publish can't be processed before the completion is stored
+            with self._completions_lock:
+                message = self.client.publish(topic, data)
+                if completion and message.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self._completions[message.mid] = completion
             # this doesn't mean that the message was publish (on_publish callback)
             if message.rc == mqtt.MQTT_ERR_SUCCESS:
                 self.debug(f"Publishing message to '{topic}' (mid={message.mid})")
@@ -221,14 +374,29 @@ class Client(LoggingMixin):
             self.warning(f"Disconnected, can't send message to '{topic}'")
             return None
 
-    def subscribe(self, topics: typing.List[typing.Tuple[str, int]]) -> bool:
+    def subscribe(
+        self,
+        topics: typing.List[typing.Tuple[str, int]],
+        completion: typing.Optional[typing.Callable[[int, typing.List[int]], None]] = None,
+    ) -> bool:
         """Subscibes to a topic
 
         This doesn't mean the client is subscribed for given topic.
         on_subscribe hook should be checked to determined whether the topic was subscribed
+        :param completion: called with mid and granted qos once the subscription is confirmed
         """
         if self.connected and self.client is not None:
-            (res, mid) = self.client.subscribe(topics)
+
+            def subscribed(mid, granted_qos):
+                self.subscriptions.confirm(topics, granted_qos)
+                if completion:
+                    completion(mid, granted_qos)
+
+            # topics are registered once granted (the lock makes sure that the completion is stored in time)
+            with self._completions_lock:
+                (res, mid) = self.client.subscribe(topics)
+                if res == mqtt.MQTT_ERR_SUCCESS:
+                    self._completions[mid] = subscribed
             if res == mqtt.MQTT_ERR_SUCCESS:
                 self.debug(f"Subscribed to '{topics}'")
                 return True
@@ -239,15 +407,22 @@ class Client(LoggingMixin):
             self.warning(f"Disconnected, failed to subscribe to '{topics}'")
             return False
 
-    def unsubscribe(self, topics: typing.List[str]) -> bool:
+    def unsubscribe(
+        self, topics: typing.List[str], completion: typing.Optional[typing.Callable[[int], None]] = None
+    ) -> bool:
         """Unsubscibes from a topic
 
         This doesn't mean the client is unsubscribed for given topic.
         on_unsubscribe hook should be checked to determined whether the topic was subscribed
+        :param completion: called with mid once the unsubscription is confirmed
         """
         if self.connected and self.client is not None:
-            (res, mid) = self.client.unsubscribe(topics)
+            with self._completions_lock:
+                (res, mid) = self.client.unsubscribe(topics)
+                if completion and res == mqtt.MQTT_ERR_SUCCESS:
+                    self._completions[mid] = completion
             if res == mqtt.MQTT_ERR_SUCCESS:
+                self.subscriptions.remove(topics)
                 self.debug(f"Unsubscribed from '{topics}'")
                 return True
             else:
@@ -260,6 +435,5 @@ class Client(LoggingMixin):
     def disconnect(self):
         """Closes connection and disconnects"""
         if self.client:
-            self.client.disconnect()
-            self.client.loop_stop()
+            self._close()
         self.client = None
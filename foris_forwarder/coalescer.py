@@ -0,0 +1,140 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+import collections
+import json
+import logging
+import threading
+import time
+import typing
+
+from . import topics
+from .logger import LoggingMixin
+
+PENDING_MAX_AGE = 60.0  # forget forwarded requests which were not answered
+PENDING_MAX_ENTRIES = 1000
+
+
+class Pending:
+    """Forwarded request and the requests waiting for the same reply"""
+
+    def __init__(self, key: typing.Tuple[str, str], created: float):
+        self.key = key
+        self.created = created
+        self.followers: typing.List[str] = []
+
+
+class RequestCoalescer(LoggingMixin):
+    """Forwards only a single copy of identical read requests
+
+    Requests are identical when they share the topic and the payload (without reply_msg_id).
+    A request which arrives within the window after the forwarded one is not forwarded,
+    it gets a copy of the reply of the forwarded request instead.
+    """
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, name: str, actions: typing.Iterable[str], window: float):
+        """
+        :param actions: allowed "module/action" pairs (action can end with "*", e.g. "wifi/get_*")
+        :param window: how long after forwarding can be a request joined
+        """
+        self.name = name
+        self.window = window
+        self.forwarded = 0
+        self.coalesced = 0
+
+        self._actions: typing.Set[typing.Tuple[str, str]] = set()
+        self._prefixes: typing.List[typing.Tuple[str, str]] = []
+        for pair in actions:
+            module, _, action = pair.partition("/")
+            if action.endswith("*"):
+                self._prefixes.append((module, action[:-1]))
+            else:
+                self._actions.add((module, action))
+
+        # (request topic, request payload) -> latest forwarded request
+        self._joinable: typing.Dict[typing.Tuple[str, str], Pending] = {}
+        # reply id of a forwarded request -> its followers
+        self._pending: typing.OrderedDict[str, Pending] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"coalescer-{self.name}"
+
+    def allowed(self, topic: str) -> bool:
+        names = topics.module_action(topic)
+        if not names:
+            return False
+        if names in self._actions:
+            return True
+        module, action = names
+        return any(module == e[0] and action.startswith(e[1]) for e in self._prefixes)
+
+    def request(self, topic: str, payload: bytes) -> bool:
+        """Returns True if the request was joined to a forwarded one (i.e. it should not be forwarded)"""
+        if not self.allowed(topic):
+            return False
+        parsed = topics.parse_request(payload)
+        if not parsed:
+            return False
+        reply_id, data = parsed
+        key = (topic, json.dumps(data, sort_keys=True))
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+            pending = self._joinable.get(key)
+            if pending and pending.created + self.window > now:
+                pending.followers.append(reply_id)
+                self.coalesced += 1
+                return True
+
+            pending = Pending(key, now)
+            self._joinable[key] = pending
+            self._pending[reply_id] = pending
+            self.forwarded += 1
+            return False
+
+    def reply(self, topic: str, payload: bytes) -> typing.List[topics.Reply]:
+        """Returns copies of the reply for the joined requests"""
+        prefix, _, reply_id = topic.rpartition("/")
+        with self._lock:
+            pending = self._pending.pop(reply_id, None)
+            if not pending:
+                return []
+            self._forget(pending)
+            return [topics.Reply(f"{prefix}/{follower}", payload) for follower in pending.followers]
+
+    def _expire(self, now: float):
+        while self._pending:
+            reply_id, pending = next(iter(self._pending.items()))
+            if pending.created + PENDING_MAX_AGE > now and len(self._pending) < PENDING_MAX_ENTRIES:
+                break
+            self._pending.popitem(last=False)
+            self._forget(pending)
+            if pending.followers:
+                self.debug(f"Reply to '{reply_id}' not received, {len(pending.followers)} requests left unanswered")
+
+    def _forget(self, pending: Pending):
+        if self._joinable.get(pending.key) is pending:
+            del self._joinable[pending.key]
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self._lock:
+            return {"pending": len(self._pending), "forwarded": self.forwarded, "coalesced": self.coalesced}
@@ -27,7 +27,9 @@ from ipaddress import IPv4Address
 
 from euci import EUci
 
+from . import topics
 from .client import CertificateSettings, PasswordSettings, Settings
+from .itemqueue import DROP_OLDEST
 from .logger import LoggingMixin
 
 
@@ -75,11 +77,16 @@ class Subordinate(BaseBus):
         port: int,
         enabled: bool,
         fosquitto_data_dir: pathlib.Path,
+        fast_fail: bool = False,
     ):
+        """
+        :param fast_fail: reply to requests with an error while the subordinate is unreachable
+        """
         super().__init__(controller_id)
         self.ip = ip
         self.port = port
         self.enabled = enabled
+        self.fast_fail = fast_fail
 
         self.fosquitto_data_dir = fosquitto_data_dir
         self.ca_path = fosquitto_data_dir / self.controller_id / "ca.crt"
@@ -118,6 +125,7 @@ class Subordinate(BaseBus):
             port=port or self.port,
             enabled=self.enabled,
             fosquitto_data_dir=self.fosquitto_data_dir,
+            fast_fail=self.fast_fail,
         )
 
 
@@ -133,6 +141,97 @@ class Subsubordinate:
         return f"{super.__str__(self)} (via {self.via})"
 
 
+class ForwarderOptions:
+    """Tunables which are shared by all forwarders"""
+
+    def __init__(
+        self,
+        inflight_window: int = 0,
+        publish_timeout: float = 10.0,
+        queue_max_items: int = 0,
+        queue_max_bytes: int = 0,
+        queue_overflow_policy: str = DROP_OLDEST,
+        ttl_request: float = 0.0,
+        ttl_reply: float = 0.0,
+        ttl_notification: float = 0.0,
+        retry_max_attempts: int = 0,
+        retry_base_delay: float = 0.5,
+        retry_max_delay: float = 30.0,
+        shared_host: bool = False,
+        reactor: bool = False,
+        consolidated_subscriptions: bool = False,
+        subscribe_batch_size: int = 100,
+        spool_dir: typing.Optional[pathlib.Path] = None,
+        spool_segment_size: int = 1024 * 1024,
+        spool_max_bytes: int = 16 * 1024 * 1024,
+        spool_batch_size: int = 32,
+        reply_cache_size: int = 0,
+        reply_cache_max_age: float = 300.0,
+        coalesce_actions: typing.Sequence[str] = (),
+        coalesce_window: float = 1.0,
+        notification_rate: float = 0.0,
+        notification_burst: int = 5,
+        notification_window: float = 0.0,
+    ):
+        """
+        :param inflight_window: max number of unconfirmed publishes per direction (0 = wait for each message)
+        :param publish_timeout: how long to wait for a confirmation of a single publish
+        :param queue_max_items: max number of queued messages per direction (0 = unlimited)
+        :param queue_max_bytes: max payload bytes of queued messages per direction (0 = unlimited)
+        :param queue_overflow_policy: what to drop when a queue is full (see itemqueue.OVERFLOW_POLICIES)
+        :param ttl_request: how long can a request (incl. list/schema) wait in the queue (0 = forever)
+        :param ttl_reply: how long can a reply wait in the queue (0 = forever)
+        :param ttl_notification: how long can a notification wait in the queue (0 = forever)
+        :param retry_max_attempts: how many times a failed item is retried (0 = unlimited)
+        :param retry_base_delay: delay before the first retry (doubled with each attempt)
+        :param retry_max_delay: max delay between two retries
+        :param shared_host: use a single connection to the host for all forwarders
+        :param reactor: drive network I/O and queues of all connections from a fixed number of threads
+        :param consolidated_subscriptions: subscribe for all controllers using wildcards and filter messages locally
+        :param subscribe_batch_size: max number of topics in a single (un)subscribe packet (0 = unlimited)
+        :param spool_dir: store messages for disconnected subordinates in this directory (None = disabled)
+        :param spool_segment_size: size of a single spool segment (two segments are mapped to memory)
+        :param spool_max_bytes: max disk usage of the spool per subordinate
+        :param spool_batch_size: how many spooled messages are read at once
+        :param reply_cache_size: max number of cached list/schema replies per subordinate (0 = disabled)
+        :param reply_cache_max_age: how long can be a cached reply used (0 = till the subordinate reconnects)
+        :param coalesce_actions: "module/action" pairs of read requests which are forwarded only once (empty = disabled)
+        :param coalesce_window: how long after forwarding can be an identical request joined
+        :param notification_rate: max notifications per second per topic passed to the host (0 = unlimited)
+        :param notification_burst: how many notifications of a topic can exceed the rate at once
+        :param notification_window: notifications of a topic within the window are merged (0 = drop over the rate)
+        """
+        self.inflight_window = inflight_window
+        self.publish_timeout = publish_timeout
+        self.queue_max_items = queue_max_items
+        self.queue_max_bytes = queue_max_bytes
+        self.queue_overflow_policy = queue_overflow_policy
+        self.ttls: typing.Dict[str, float] = {
+            topics.REQUEST: ttl_request,
+            topics.LIST: ttl_request,
+            topics.REPLY: ttl_reply,
+            topics.NOTIFICATION: ttl_notification,
+        }
+        self.retry_max_attempts = retry_max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.shared_host = shared_host
+        self.reactor = reactor
+        self.consolidated_subscriptions = consolidated_subscriptions
+        self.subscribe_batch_size = subscribe_batch_size
+        self.spool_dir = spool_dir
+        self.spool_segment_size = spool_segment_size
+        self.spool_max_bytes = spool_max_bytes
+        self.spool_batch_size = spool_batch_size
+        self.reply_cache_size = reply_cache_size
+        self.reply_cache_max_age = reply_cache_max_age
+        self.coalesce_actions = coalesce_actions
+        self.coalesce_window = coalesce_window
+        self.notification_rate = notification_rate
+        self.notification_burst = notification_burst
+        self.notification_window = notification_window
+
+
 class Configuration(LoggingMixin):
     logger = logging.getLogger(__file__)
 
@@ -175,9 +274,10 @@ class Configuration(LoggingMixin):
                     default=IPv4Address("192.0.0.8"),  # IPv4 dummy address (according to IANA)
                 )
                 port = eu.get("fosquitto", controller_id, "port", dtype=int, default=11884)
+                fast_fail = eu.get("fosquitto", controller_id, "fast_fail", dtype=bool, default=False)
 
                 try:
-                    subordinate = Subordinate(controller_id, ip, port, enabled, self.fosquitto_data_dir)
+                    subordinate = Subordinate(controller_id, ip, port, enabled, self.fosquitto_data_dir, fast_fail)
                 except ValueError as exc:
                     self.warning(f"Error loading subordinate '{controller_id}': {exc}")
                     continue
@@ -0,0 +1,132 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+import ipaddress
+import json
+import logging
+import os
+import socketserver
+import threading
+import typing
+
+from .logger import LoggingMixin
+
+if typing.TYPE_CHECKING:
+    from .app import App
+
+MAX_LINE = 64 * 1024
+
+
+class ControlError(Exception):
+    pass
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Reads json commands (one per line) and writes json responses (one per line)"""
+
+    server: "UnixServer"
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_LINE)
+            if not line:
+                return
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ControlError("request needs to be an object")
+                response = {"ok": True, "result": self.server.owner.execute(request)}
+            except (ValueError, ControlError) as exc:
+                response = {"ok": False, "error": str(exc)}
+            except Exception as exc:
+                self.server.owner.error(f"Command {line!r} failed: {exc!r}")
+                response = {"ok": False, "error": repr(exc)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    owner: "ControlServer"
+
+    def server_bind(self):
+        super().server_bind()
+        # the socket is created according to the umask, only the owner may control the forwarder
+        # (nobody can connect before listen() is called)
+        os.chmod(self.server_address, 0o600)
+
+
+class ControlServer(LoggingMixin):
+    """Control API on a Unix socket (json lines)
+
+    Commands:
+    {"command": "status"} -> snapshot of all forwarders (see App.status)
+    {"command": "switch_netloc", "controller_id": "...", ["netloc": "<ip>:<port>"]}
+    {"command": "reload", "controller_id": "..."}
+    """
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, path: str, app: "App"):
+        self.path = path
+        self.app = app
+        if os.path.exists(path):
+            os.unlink(path)  # stale socket of the previous run
+        self.server = UnixServer(path, Handler)
+        self.server.owner = self
+        self.thread = threading.Thread(name="control-server", target=self.server.serve_forever, daemon=True)
+
+    def __str__(self):
+        return f"control-{self.path}"
+
+    def start(self):
+        self.debug("Listening for commands")
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    @staticmethod
+    def parse_netloc(netloc: str) -> typing.Tuple[ipaddress.IPv4Address, int]:
+        ip, _, port = netloc.rpartition(":")
+        return ipaddress.IPv4Address(ip), int(port)
+
+    def execute(self, request: typing.Dict[str, typing.Any]) -> typing.Any:
+        command = request.get("command")
+        if command == "status":
+            return self.app.current_status()
+
+        supervisor = self.app.supervisor(request.get("controller_id", ""))
+        if supervisor is None:
+            raise ControlError(f"unknown controller_id '{request.get('controller_id')}'")
+
+        if command == "switch_netloc":
+            netloc = self.parse_netloc(request["netloc"]) if request.get("netloc") else None
+            self.info(f"Switching netloc of {supervisor.subordinate_controller_id} to {netloc or 'next one'}")
+            self.app.call(supervisor.switch_netloc, netloc)
+        elif command == "reload":
+            self.info(f"Reloading {supervisor.subordinate_controller_id}")
+            self.app.call(supervisor.reload)
+        else:
+            raise ControlError(f"unknown command '{command}'")
+        return self.app.call(supervisor.status)
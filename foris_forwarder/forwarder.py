@@ -17,158 +17,39 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 #
 
-import abc
+import collections
 import logging
-import queue
 import threading
 import time
 import typing
 
-from paho.mqtt.client import MQTT_ERR_SUCCESS, MQTTMessage
+from paho.mqtt.client import MQTTMessage
 
+from . import topics
+from .cache import ReplyCache
 from .client import Client
+from .coalescer import RequestCoalescer
+from .configuration import ForwarderOptions
 from .configuration import Host as HostConf
 from .configuration import Subordinate as SubordinateConf
 from .configuration import Subsubordinate as SubsubordinateConf
-from .logger import LoggingMixin
+from .inflight import InflightWindow
+from .itemqueue import EXPIRED, ItemQueue
+from .items import Connect, Disconnect, ItemProcessor, Publish, QueueItem, Reload, Replay, Subscribe, Unsubscribe
+from .latency import LatencyTracker
+from .metrics import DirectionMetrics
+from .multiplexer import HostMultiplexer
+from .reactor import Reactor
+from .spool import Spool
+from .throttle import NotificationThrottle
+from .workers import Wait
 
 SLEEP_STEP = 0.2
-QUEUE_TIMEOUT = 10.0
+REPLAY_DELAY = 1.0  # how often is the spool replay attempted while the subordinate is disconnected
+RELOAD_TIMEOUT = 10.0  # how long to wait for the old subordinate connection to disconnect
 
 
-class QueueItem(metaclass=abc.ABCMeta):
-    priority = 0
-
-    def __init__(self):
-        self.attempt_number = 0
-        self.first_attempt = time.monotonic()
-        self.last_attempt = self.first_attempt
-
-    def retry(self):
-        self.attempt_number += 1
-        self.last_attempt = time.monotonic()
-
-    @abc.abstractmethod
-    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
-        pass
-
-
-class Connect(QueueItem):
-    priority = 10
-
-    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
-        event = threading.Event()
-
-        res = {}
-
-        def connect(client, userdata, flags, rc):
-            res["rc"] = rc
-            event.set()
-
-        prev_hook = client.connect_hook
-        client.set_connect_hook(connect)
-        client.connect()
-
-        finished = event.wait(timeout)
-        client.set_connect_hook(prev_hook)
-
-        return res["rc"] == MQTT_ERR_SUCCESS if finished else None
-
-
-class Disconnect(QueueItem):
-    priority = 10
-
-    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
-        event = threading.Event()
-
-        res = {}
-
-        def disconnect(client, userdata, rc):
-            res["rc"] = rc
-            event.set()
-
-        prev_hook = client.disconnect_hook
-        client.set_disconnect_hook(disconnect)
-        client.disconnect()
-
-        finished = event.wait(timeout)
-        client.set_disconnect_hook(prev_hook)
-
-        return res["rc"] == MQTT_ERR_SUCCESS if finished else None
-
-
-class Publish(QueueItem):
-    priority = 1
-
-    def __init__(self, message: MQTTMessage):
-        super().__init__()
-        self.message = message
-
-    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
-        event = threading.Event()
-
-        def publish(client, userdata, mid):
-            event.set()
-
-        prev_hook = client.publish_hook
-        client.set_publish_hook(publish)
-        client.publish(self.message.topic, self.message.payload)
-
-        finished = event.wait(timeout)
-        client.set_publish_hook(prev_hook)
-
-        return True if finished else None
-
-
-class Subscribe(QueueItem):
-    priority = 5
-
-    def __init__(self, topics_with_qos: typing.List[typing.Tuple[str, int]]):
-        super().__init__()
-        self.topics_with_qos = topics_with_qos
-
-    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
-        event = threading.Event()
-
-        def subscribe(client, userdata, mid, granted_qos):
-            event.set()
-
-        prev_hook = client.subscribe_hook
-        client.set_subscribe_hook(subscribe)
-        if not client.subscribe(self.topics_with_qos):
-            return False
-
-        finished = event.wait(timeout)
-        client.set_subscribe_hook(prev_hook)
-
-        return True if finished else None
-
-
-class Unsubscribe(QueueItem):
-    priority = 5
-
-    def __init__(self, topics: typing.List[str]):
-        super().__init__()
-        self.topics = topics
-
-    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
-        event = threading.Event()
-
-        def unsubscribe(client, userdata, mid):
-            event.set()
-
-        prev_hook = client.unsubscribe_hook
-        client.set_unsubscribe_hook(unsubscribe)
-        if not client.unsubscribe(self.topics):
-            return False
-
-        finished = event.wait(timeout)
-        client.set_unsubscribe_hook(prev_hook)
-
-        return True if finished else None
-
-
-class Forwarder(LoggingMixin):
+class Forwarder(ItemProcessor):
     """Class responsible for passing messages between host and a single subordinate"""
 
     logger = logging.getLogger(__file__)
@@ -178,30 +59,119 @@ class Forwarder(LoggingMixin):
         host_conf: HostConf,
         subordinate_conf: SubordinateConf,
         subsubordinate_confs: typing.List[SubsubordinateConf] = None,
+        options: typing.Optional[ForwarderOptions] = None,
+        multiplexer: typing.Optional[HostMultiplexer] = None,
+        reactor: typing.Optional[Reactor] = None,
     ):
-        """Initializes forwarder"""
+        """Initializes forwarder
+        :param multiplexer: share a single host connection instead of opening a new one
+        :param reactor: drive network I/O of the connections from the shared reactor thread
+        """
 
+        self.options = options or ForwarderOptions()
         self.host_conf = host_conf
-        self.host = Client(
-            host_conf.client_settings(),
-            f"{host_conf.controller_id}->{subordinate_conf.controller_id}",
-        )
+        self.multiplexer = multiplexer
+        self.reactor = reactor
+        if self.multiplexer:
+            self.host = self.multiplexer.client
+        else:
+            self.host = Client(
+                host_conf.client_settings(),
+                f"{host_conf.controller_id}->{subordinate_conf.controller_id}",
+                reactor=reactor,
+            )
         self.subordinate_conf = subordinate_conf
         self.subordinate = Client(
             subordinate_conf.client_settings(),
             f"{subordinate_conf.controller_id}->{host_conf.controller_id}",
+            reactor=reactor,
         )
         self.subsubordinate_confs: typing.List[SubsubordinateConf] = subsubordinate_confs or []
+        # called when the subordinate connects or disconnects
+        self.state_hook: typing.Optional[typing.Callable[[], None]] = None
+
+        # messages of wildcard subscriptions are filtered by controller id
+        self.controller_filter: typing.Optional[typing.FrozenSet[str]] = None
+        if self.options.consolidated_subscriptions:
+            self.controller_filter = frozenset(self.controller_ids)
+
+        # pipelined publishing (messages are not confirmed one by one)
+        self.host_window: typing.Optional[InflightWindow] = None
+        self.subordinate_window: typing.Optional[InflightWindow] = None
+        if self.options.inflight_window > 0:
+            self.host_window = InflightWindow(
+                f"{self}-host", self.options.inflight_window, self.options.publish_timeout
+            )
+            self.subordinate_window = InflightWindow(
+                f"{self}-subordinate", self.options.inflight_window, self.options.publish_timeout
+            )
 
-        # initialize forwarder threads and queues
-        self.host_queue: queue.Queue[typing.Union[QueueItem, bool]] = queue.Queue()
+        # messages for disconnected subordinate are stored on the disk
+        self.spool: typing.Optional[Spool] = None
+        if self.options.spool_dir:
+            self.spool = Spool(
+                self.options.spool_dir / subordinate_conf.controller_id,
+                self.options.spool_segment_size,
+                self.options.spool_max_bytes // self.options.spool_segment_size,
+            )
+        self._replay_planned = False
+        self._replay_lock = threading.Lock()
+
+        # subordinate reload is performed by the subordinate queue worker
+        self._reload_conf: typing.Optional[SubordinateConf] = None
+        self._reload_deadline = 0.0
+        self._reload_planned = False
+        self._reload_item: typing.Optional[Reload] = None
+        self._reload_lock = threading.Lock()
+        self._stopping = False
+
+        # list and schema requests are answered locally when possible
+        self.reply_cache: typing.Optional[ReplyCache] = None
+        if self.options.reply_cache_size > 0:
+            self.reply_cache = ReplyCache(
+                subordinate_conf.controller_id, self.options.reply_cache_size, self.options.reply_cache_max_age
+            )
+
+        # identical read requests are forwarded only once
+        self.coalescer: typing.Optional[RequestCoalescer] = None
+        if self.options.coalesce_actions:
+            self.coalescer = RequestCoalescer(
+                subordinate_conf.controller_id, self.options.coalesce_actions, self.options.coalesce_window
+            )
+
+        # notifications passed to the host are limited per topic
+        self.throttle: typing.Optional[NotificationThrottle] = None
+        if self.options.notification_rate > 0 or self.options.notification_window > 0:
+            self.throttle = NotificationThrottle(
+                subordinate_conf.controller_id,
+                self.options.notification_rate,
+                self.options.notification_burst,
+                self.options.notification_window,
+            )
+
+        # round trip of forwarded requests
+        self.latency = LatencyTracker(subordinate_conf.controller_id)
+
+        # requests answered with an error while the subordinate was disconnected
+        self.fast_failed = 0
+
+        # published messages, bytes, ...
+        self.host_metrics = DirectionMetrics()
+        self.subordinate_metrics = DirectionMetrics()
+
+        # failures, retries, gave_up
+        self.host_retries: typing.Counter[str] = collections.Counter()
+        self.subordinate_retries: typing.Counter[str] = collections.Counter()
+
+        # initialize forwarder threads and queues (queues are processed by the reactor workers in reactor mode)
+        self.host_queue: ItemQueue = ItemQueue(*self.queue_limits)
         self.host_queue_worker = threading.Thread(
             name="host-queue-worker",
             target=self.handle_host_queue,
             daemon=True,
         )
 
-        self.subordinate_queue: queue.Queue[typing.Union[QueueItem, bool]] = queue.Queue()
+        self.subordinate_queue: ItemQueue = ItemQueue(*self.queue_limits)
         self.subordinate_queue_worker = threading.Thread(
             name="subordinate-queue-worker",
             target=self.handle_subordinate_queue,
@@ -214,10 +184,11 @@ class Forwarder(LoggingMixin):
         self.debug("Workers initialized")
 
         self.subordinate_queue.put(Connect())
-        self.host_queue.put(Connect())
-        self.plan_subscribe(subordinate_conf.controller_id)
-        for subsubordinate_conf in self.subsubordinate_confs:
-            self.plan_subscribe(subsubordinate_conf.controller_id)
+        if not self.multiplexer:
+            self.host_queue.put(Connect())
+        self.plan_subscriptions()
+        if self.spool and not self.spool.empty:
+            self.plan_replay()  # messages stored before restart
         self.host_queue.put(True)  # Initialized
         self.subordinate_queue.put(True)  # Initialized
 
@@ -227,23 +198,47 @@ class Forwarder(LoggingMixin):
     def ready(self):
         return self.subordinate_ready and self.host_ready
 
+    @property
+    def controller_ids(self) -> typing.List[str]:
+        """Controllers which are reachable via the subordinate"""
+        return [self.subordinate_conf.controller_id] + [e.controller_id for e in self.subsubordinate_confs]
+
+    @property
+    def subscription_ids(self) -> typing.List[str]:
+        """Controller ids used in subscribed topics (a single wildcard in consolidated mode)"""
+        if self.options.consolidated_subscriptions:
+            return [topics.WILDCARD]
+        return self.controller_ids
+
+    @property
+    def queue_limits(self) -> typing.Tuple[int, int, str]:
+        return self.options.queue_max_items, self.options.queue_max_bytes, self.options.queue_overflow_policy
+
+    def queue_stats(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """Returns depth, byte usage and drop counters of both queues (and of the spool)"""
+        stats = {"host": self.host_queue.stats(), "subordinate": self.subordinate_queue.stats()}
+        if self.spool:
+            stats["spool"] = self.spool.stats()
+        if self.reply_cache:
+            stats["reply_cache"] = self.reply_cache.stats()
+        if self.coalescer:
+            stats["coalescer"] = self.coalescer.stats()
+        if self.throttle:
+            stats["throttle"] = self.throttle.stats()
+        if self.fast_failed:
+            stats["fast_failed"] = {"requests": self.fast_failed}
+        stats["latency"] = self.latency.stats(time.monotonic())
+        return stats
+
     @staticmethod
     def suboridnate_topics_for_controller(
         controller_id: str,
     ) -> typing.List[typing.Tuple[str, int]]:
-        return [
-            (f"foris-controller/{controller_id}/notification/+/action/+", 0),
-            (f"foris-controller/{controller_id}/reply/+", 0),
-        ]
+        return topics.subordinate_topics(controller_id)
 
     @staticmethod
     def host_topics_for_controller(controller_id: str) -> typing.List[typing.Tuple[str, int]]:
-        return [
-            (f"foris-controller/{controller_id}/request/+/action/+", 0),
-            (f"foris-controller/{controller_id}/request/+/list", 0),
-            (f"foris-controller/{controller_id}/list", 0),
-            (f"foris-controller/{controller_id}/schema", 0),
-        ]
+        return topics.host_topics(controller_id)
 
     def __str__(self):
         return f"{self.host}->{self.subordinate}"
@@ -253,44 +248,164 @@ class Forwarder(LoggingMixin):
         while True:
             item: typing.Optional[QueueItem] = self.subordinate_queue.get()
             self.subordinate_queue.task_done()
+            if not self.handle_subordinate_item(item):
+                return
 
-            if item is True:
-                self.subordinate_ready = True
-                continue
+    def handle_subordinate_item(self, item: typing.Union[QueueItem, bool]) -> typing.Union[bool, Wait]:
+        """
+        :returns: False when the queue should not be processed anymore
+        """
+        if item is True:
+            self.subordinate_ready = True
+            return True
+
+        if item is False:
+            self.subordinate_ready = False
+            if self.spool:
+                self.spool.close()
+            # terminating on empty message
+            return False
 
-            if item is False:
-                self.subordinate_ready = False
-                # terminating on empty message
-                return
-            # TODO perhaps flush the queue if connection fails
-            item.perform(self.subordinate, timeout=QUEUE_TIMEOUT)
+        if self.reactor and isinstance(item, Connect):
+            # the reactor workers are shared, don't block them till the broker replies
+            return self.process_connect(item, self.subordinate_queue, self.subordinate, self.subordinate_retries)
+
+        self.process(
+            item,
+            self.subordinate_queue,
+            self.subordinate,
+            self.subordinate_window,
+            self.subordinate_retries,
+            self.subordinate_metrics,
+        )
+        return True
 
     def handle_host_queue(self):
         self.debug("Host queue feeder started")
         while True:
             item: typing.Optional[QueueItem] = self.host_queue.get()
             self.host_queue.task_done()
+            if not self.handle_host_item(item):
+                return
+
+    def handle_host_item(self, item: typing.Union[QueueItem, bool]) -> typing.Union[bool, Wait]:
+        """
+        :returns: False when the queue should not be processed anymore
+        """
+        if item is True:
+            self.host_ready = True
+            return True
+
+        if item is False:
+            self.host_ready = False
+            # terminating on empty message
+            return False
+
+        if self.reactor and isinstance(item, Connect):
+            return self.process_connect(item, self.host_queue, self.host, self.host_retries)
 
-            if item is True:
-                self.host_ready = True
-                continue
+        self.process(item, self.host_queue, self.host, self.host_window, self.host_retries, self.host_metrics)
+        return True
 
-            if item is False:
-                self.host_ready = False
-                # terminating on empty message
+    def retry_stats(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        """Returns failure, retry and give up counts of both directions"""
+        return {"host": dict(self.host_retries), "subordinate": dict(self.subordinate_retries)}
+
+    def new_publish(self, message: MQTTMessage, age: float = 0.0) -> Publish:
+        """
+        :param age: how long ago was the message received (e.g. when stored in the spool)
+        """
+        item = Publish(message)
+        item.first_attempt -= age
+        item.expire_in(self.options.ttls.get(item.message_class))
+        return item
+
+    def host_to_subordinate(self, client, userdata, message: MQTTMessage):
+        if self.controller_filter is not None and not topics.is_routed(message.topic, self.controller_filter):
+            return
+        self.debug(f"Msg from host to subordinate (len={len(message.payload)})")
+        item = self.new_publish(message)
+        if self.reply_cache and item.message_class == topics.LIST:
+            # replies are cached per connection (subordinate may be updated meanwhile)
+            cached = self.reply_cache.request(message.topic, message.payload, self.subordinate.connect_count)
+            if cached:
+                self.debug(f"Replying to '{message.topic}' from cache")
+                reply = MQTTMessage(topic=cached.topic.encode())
+                reply.payload = cached.payload
+                self.host_queue.put(self.new_publish(reply))
                 return
-            # TODO perhaps flush the queue if connection fails
-            item.perform(self.host, timeout=QUEUE_TIMEOUT)
+        if self.subordinate_conf.fast_fail and not self.subordinate.connected:
+            # don't let the caller wait for a timeout
+            error = topics.error_reply(
+                message.topic, message.payload, f"Controller '{self.subordinate_conf.controller_id}' is unreachable"
+            )
+            if error:
+                self.debug(f"Failing '{message.topic}' (subordinate disconnected)")
+                self.fast_failed += 1
+                reply = MQTTMessage(topic=error.topic.encode())
+                reply.payload = error.payload
+                self.host_queue.put(self.new_publish(reply))
+                return
+        if self.coalescer and self.coalescer.request(message.topic, message.payload):
+            self.debug(f"Request '{message.topic}' joined to a forwarded one")
+            return
+        if item.message_class in (topics.REQUEST, topics.LIST):
+            self.latency.request(message.topic, message.payload, time.monotonic())
+        if self.spool and (not self.subordinate.connected or not self.spool.empty):
+            # messages are passed via the spool till it is drained to keep the order
+            if self.spool.append(message.topic, message.payload, time.time()):
+                self.plan_replay()
+                return
+        self.subordinate_queue.put(item)
+
+    def plan_replay(self, delay: float = 0.0):
+        with self._replay_lock:
+            if self._replay_planned:
+                return
+            self._replay_planned = True
+
+        if delay:
+            self.subordinate_queue.put_later(Replay(self.replay), delay)
+        else:
+            self.subordinate_queue.put(Replay(self.replay))
+
+    def replay(self) -> bool:
+        """Sends a batch of spooled messages and plans the next one"""
+        assert self.spool
+        with self._replay_lock:
+            self._replay_planned = False
+
+        if not self.subordinate.connected:
+            self.plan_replay(REPLAY_DELAY)
+            return True
+
+        now = time.time()
+        for record in self.spool.read(self.options.spool_batch_size):
+            message = MQTTMessage(topic=record.topic.encode())
+            message.payload = record.payload
+            item = self.new_publish(message, max(now - record.created, 0.0))
+            started = time.monotonic()
+            completed = self.publish_completion(self.subordinate_metrics, item, started)
+            if item.expired(started):
+                self.subordinate_queue.record_drop(EXPIRED)
+            elif not self.perform(item, self.subordinate, self.subordinate_window, completed):
+                # not committed => it will be sent again
+                self.plan_replay(REPLAY_DELAY)
+                return True
+            self.spool.commit(record.position)
+
+        if not self.spool.empty:
+            self.plan_replay()
+        return True
 
     def register_message_handlers(self):
         """Register message handlers for forwarding"""
 
-        # setting message hooks
-        def host_to_subordinate(client, userdata, message: MQTTMessage):
-            self.debug(f"Msg from host to subordinate (len={len(message.payload)})")
-            self.subordinate_queue.put(Publish(message))
-
-        self.host.set_message_hook(host_to_subordinate)
+        # setting message hooks (multiplexer routes messages according to subscriptions)
+        if not self.multiplexer:
+            self.host.set_message_hook(self.host_to_subordinate)
+            self.host.set_state_hook(lambda connected: self.connection_changed(self.host_queue, connected))
+            self.host.set_resubscribe_hook(lambda lost: self.host_queue.put(Subscribe(lost)))
 
         self.register_subordinate_message_handlers()
 
@@ -298,17 +413,68 @@ class Forwarder(LoggingMixin):
         """Registers subordinate message handlers"""
 
         def subordinate_to_host(client, userdata, message: MQTTMessage):
+            if self.controller_filter is not None and not topics.is_routed(message.topic, self.controller_filter):
+                return
             self.debug(f"Msg from subordinate to host (len={len(message.payload)})")
-            self.host_queue.put(Publish(message))
+            item = self.new_publish(message)
+            if item.message_class == topics.REPLY:
+                self.latency.reply(message.topic, time.monotonic())
+            if self.reply_cache:
+                if item.message_class == topics.REPLY:
+                    self.reply_cache.reply(message.topic, message.payload)
+                elif item.message_class == topics.NOTIFICATION:
+                    self.reply_cache.notification(message.topic)
+            if self.throttle and item.message_class == topics.NOTIFICATION:
+                delay = self.throttle.offer(message.topic, item, time.monotonic(), self.host_queue.merge_delayed)
+                if delay is None:
+                    return  # merged to a held notification or dropped
+                if delay:
+                    self.host_queue.put_later(item, delay)
+                    return
+            self.host_queue.put(item)
+            if self.coalescer and item.message_class == topics.REPLY:
+                for copy in self.coalescer.reply(message.topic, message.payload):
+                    reply = MQTTMessage(topic=copy.topic.encode())
+                    reply.payload = copy.payload
+                    self.host_queue.put(self.new_publish(reply))
 
         self.subordinate.set_message_hook(subordinate_to_host)
+        self.subordinate.set_state_hook(lambda connected: self.connection_changed(self.subordinate_queue, connected))
+        self.subordinate.set_resubscribe_hook(lambda lost: self.subordinate_queue.put(Subscribe(lost)))
+
+    def connection_changed(self, item_queue: ItemQueue, connected: bool):
+        if connected:
+            # retries were planned for the previous connection
+            self.retry_now(item_queue)
+        if self.state_hook:
+            self.state_hook()
+
+    def plan_subscriptions(self):
+        """Plans subscriptions of all controllers which are reachable via the subordinate"""
+        if not self.options.consolidated_subscriptions:
+            for controller_id in self.controller_ids:
+                self.plan_subscribe(controller_id)
+            return
+
+        if self.multiplexer:
+            for controller_id in self.controller_ids:
+                self.multiplexer.register(controller_id, self.host_to_subordinate)
+        else:
+            self.host_queue.put(Subscribe(Forwarder.host_topics_for_controller(topics.WILDCARD)))
+        self.subordinate_queue.put(Subscribe(Forwarder.suboridnate_topics_for_controller(topics.WILDCARD)))
 
     def plan_subscribe(self, controller_id: str):
-        self.host_queue.put(Subscribe(Forwarder.host_topics_for_controller(controller_id)))
+        if self.multiplexer:
+            self.multiplexer.register(controller_id, self.host_to_subordinate)
+        else:
+            self.host_queue.put(Subscribe(Forwarder.host_topics_for_controller(controller_id)))
         self.subordinate_queue.put(Subscribe(Forwarder.suboridnate_topics_for_controller(controller_id)))
 
     def plan_unsubscribe(self, controller_id: str):
-        self.host_queue.put(Unsubscribe([e[0] for e in Forwarder.host_topics_for_controller(controller_id)]))
+        if self.multiplexer:
+            self.multiplexer.unregister(controller_id)
+        else:
+            self.host_queue.put(Unsubscribe([e[0] for e in Forwarder.host_topics_for_controller(controller_id)]))
         self.subordinate_queue.put(
             Unsubscribe([e[0] for e in Forwarder.suboridnate_topics_for_controller(controller_id)])
         )
@@ -318,15 +484,26 @@ class Forwarder(LoggingMixin):
 
         # start the workers
         self.debug("Starting workers")
-        self.host_queue_worker.start()
-        self.subordinate_queue_worker.start()
+        if self.reactor:
+            # a fixed number of workers is shared by all forwarders
+            self.reactor.queue_workers.add(self.host_queue, self.handle_host_item)
+            self.reactor.queue_workers.add(self.subordinate_queue, self.handle_subordinate_item)
+        else:
+            self.host_queue_worker.start()
+            self.subordinate_queue_worker.start()
 
     def stop(self):
         """Send request to disconnect"""
         self.debug("Stopping")
-
-        # Disconnect
-        self.host_queue.put(Disconnect())
+        with self._reload_lock:
+            self._stopping = True  # pending reload must not connect again
+
+        # Disconnect (shared host connection is only unsubscribed)
+        if self.multiplexer:
+            for controller_id in self.controller_ids:
+                self.multiplexer.unregister(controller_id)
+        else:
+            self.host_queue.put(Disconnect())
         self.subordinate_queue.put(Disconnect())
 
         # Terminate workers
@@ -347,7 +524,7 @@ class Forwarder(LoggingMixin):
     def wait_for_disconnected(self, timeout: typing.Optional[float] = None) -> bool:
 
         start = time.monotonic()
-        while self.subordinate.connected or self.host.connected:
+        while self.subordinate.connected or (self.host.connected and not self.multiplexer):
             if timeout:
                 if time.monotonic() - start > timeout:
                     return False
@@ -355,41 +532,114 @@ class Forwarder(LoggingMixin):
 
         return True
 
-    def reload_subordinate(self, subordinate_conf: SubordinateConf):
-        self.debug(f"Reloading subordinate {subordinate_conf} ({subordinate_conf.ip}:{subordinate_conf.port})")
-
-        # disconnect current subordinate
-        self.subordinate_queue.put(Disconnect())
+    @property
+    def reloading(self) -> bool:
+        return self._reload_planned
 
-        # wait till subordinate disconnected
-        while self.subordinate.connected:
-            time.sleep(SLEEP_STEP)
+    def reload_subordinate(self, subordinate_conf: SubordinateConf):
+        """Plans to replace the subordinate connection (returns immediately)
 
-        self.debug("Current Subordinate disconnected")
+        When a reload is already planned only its configuration is updated.
+        """
+        self.debug(f"Reloading subordinate {subordinate_conf} ({subordinate_conf.ip}:{subordinate_conf.port})")
 
-        # Clear suboridnate queue
-        try:
-            while self.subordinate_queue.get(False):
-                self.subordinate_queue.task_done()
-        except queue.Empty:
-            pass
+        with self._reload_lock:
+            self._reload_conf = subordinate_conf
+            self._reload_deadline = time.monotonic() + RELOAD_TIMEOUT
+            if self._reload_planned:
+                return
+            self._reload_planned = True
+            self._reload_item = Reload(self.perform_reload)
+        self.subordinate_queue.put(self._reload_item)
+
+    def perform_reload(self) -> bool:
+        """Disconnects the current subordinate and connects the new one"""
+        with self._reload_lock:
+            subordinate_conf = self._reload_conf
+            deadline = self._reload_deadline
+            reload_sequence = self._reload_item.sequence if self._reload_item else None
+            self._reload_conf = None
+        assert subordinate_conf
+
+        previous = self.subordinate
+        if self.reactor:
+            # the reactor only writes the packet to a nonblocking socket
+            previous.disconnect()
+            disconnecting = None
+        else:
+            # disconnect current subordinate (the disconnection itself may block)
+            disconnecting = threading.Thread(
+                name="subordinate-disconnect",
+                target=previous.disconnect,
+                daemon=True,
+            )
+            disconnecting.start()
+            disconnecting.join(max(deadline - time.monotonic(), 0.0))
+        if disconnecting and disconnecting.is_alive():
+            self.warning(f"Subordinate {previous} was not disconnected in time, abandoning the connection")
+            previous.set_message_hook(None)
+            previous.set_state_hook(None)
+            previous.set_resubscribe_hook(None)
+        else:
+            self.debug("Current Subordinate disconnected")
+
+        with self._reload_lock:
+            if self._stopping:
+                # the forwarder was stopped meanwhile, don't connect again
+                self._reload_conf = None
+                self._reload_planned = False
+                return True
+
+        # confirmations from the old connection won't arrive
+        if self.subordinate_window is not None:
+            self.subordinate_window.clear()
+
+        # Control items of the old connection are stale, pending messages (incl. retries) are
+        # kept with their original timestamps and they are sent via the new connection.
+        # Items planned after the reload (e.g. by stop()) are kept as well.
+        def stale(item) -> bool:
+            if isinstance(item, (bool, Publish)):
+                return False
+            return reload_sequence is None or item.sequence is None or item.sequence < reload_sequence
+
+        dropped = self.subordinate_queue.remove_if(stale)
+        self.debug(f"Dropped {dropped} control items, keeping {self.subordinate_queue.stats()['messages']} messages")
+        # the backoff of the old connection doesn't apply to the new one
+        self.retry_now(self.subordinate_queue)
+
+        # planned replay was dropped as well
+        with self._replay_lock:
+            self._replay_planned = False
+        if self.spool and not self.spool.empty:
+            self.plan_replay()
 
         self.subordinate_conf = subordinate_conf
         self.subordinate = Client(
             subordinate_conf.client_settings(),
             f"{subordinate_conf.controller_id}->{self.host_conf.controller_id}",
+            reactor=self.reactor,
         )
+        # same controller => same broker session (reconciled once connected)
+        self.subordinate.subscriptions = previous.subscriptions
+        self.subordinate_metrics.connects += previous.connect_count
+        if self.reply_cache:
+            self.reply_cache.invalidate()
 
         # new subordinate message handlers needs to be registered
         self.register_subordinate_message_handlers()
         self.debug("Message handlers connected")
         self.subordinate_queue.put(Connect())
-        self.subordinate_queue.put(
-            Subscribe(Forwarder.suboridnate_topics_for_controller(subordinate_conf.controller_id))
-        )
 
         self.debug("Planning for new topic subscription")
-        for subsubordinate_conf in self.subsubordinate_confs:
-            self.subordinate_queue.put(
-                Subscribe(Forwarder.suboridnate_topics_for_controller(subsubordinate_conf.controller_id))
-            )
+        for controller_id in self.subscription_ids:
+            self.subordinate_queue.put(Subscribe(Forwarder.suboridnate_topics_for_controller(controller_id)))
+
+        with self._reload_lock:
+            if self._reload_conf:
+                # reloaded again meanwhile
+                self._reload_item = Reload(self.perform_reload)
+                self.subordinate_queue.put(self._reload_item)
+            else:
+                self._reload_planned = False
+
+        return True
@@ -0,0 +1,140 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import collections
+import itertools
+import logging
+import threading
+import time
+import typing
+
+from .client import Client
+from .logger import LoggingMixin
+
+
+class InflightWindow(LoggingMixin):
+    """Limits the number of publishes which were passed to paho and wait for on_publish
+
+    Completions are matched by mid (see Client.publish) so several messages
+    can be in flight at once. Every message has its own deadline, message which
+    is not confirmed in time only releases its slot and doesn't block the others.
+
+    Messages are passed to a single connection in the order in which they were
+    dequeued, so the order of messages within a topic is kept.
+    """
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, name: str, size: int, timeout: float):
+        """Initializes the window
+        :param name: used in logs
+        :param size: maximal number of unconfirmed messages
+        :param timeout: how long to wait for a confirmation of a single message
+        """
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        # sequence -> deadline (deadlines are increasing so the oldest record is the first to expire)
+        self._inflight: typing.Dict[int, float] = collections.OrderedDict()
+
+        self.completed = 0
+        self.expired = 0
+
+    def __str__(self):
+        return f"window-{self.name}"
+
+    @property
+    def inflight(self) -> int:
+        with self._condition:
+            return len(self._inflight)
+
+    def _expire(self, now: float):
+        while self._inflight:
+            sequence, deadline = next(iter(self._inflight.items()))
+            if deadline > now:
+                break
+            del self._inflight[sequence]
+            self.expired += 1
+            self.debug(f"Publish confirmation timed out ({len(self._inflight)} in flight)")
+
+    def _complete(self, sequence: int, completed: typing.Optional[typing.Callable[[], None]]):
+        with self._condition:
+            if self._inflight.pop(sequence, None) is None:
+                return  # expired meanwhile
+            self.completed += 1
+            self._condition.notify()
+        if completed:
+            completed()
+
+    def _acquire(self, timeout: typing.Optional[float]) -> typing.Optional[int]:
+        """Waits for a free slot and reserves it"""
+        now = time.monotonic()
+        end = None if timeout is None else now + timeout
+        with self._condition:
+            while True:
+                self._expire(now)
+                if len(self._inflight) < self.size:
+                    sequence = next(self._sequence)
+                    self._inflight[sequence] = now + self.timeout
+                    return sequence
+
+                # wake up when the oldest record expires at the latest
+                wait_for = next(iter(self._inflight.values())) - now
+                if end is not None:
+                    if end <= now:
+                        return None
+                    wait_for = min(wait_for, end - now)
+                self._condition.wait(wait_for)
+                now = time.monotonic()
+
+    def publish(
+        self,
+        client: Client,
+        topic: str,
+        payload: bytes,
+        timeout: typing.Optional[float] = None,
+        completed: typing.Optional[typing.Callable[[], None]] = None,
+    ) -> typing.Optional[bool]:
+        """Passes a message to the client without waiting for its confirmation
+
+        :param timeout: how long to wait for a free slot
+        :param completed: called once the message is confirmed in time
+        :returns: True when published, False when client refused the message and None on timeout
+        """
+        sequence = self._acquire(timeout)
+        if sequence is None:
+            self.warning(f"No free slot for '{topic}'")
+            return None
+
+        if client.publish(topic, payload, lambda mid: self._complete(sequence, completed)) is None:
+            with self._condition:
+                self._inflight.pop(sequence, None)
+                self._condition.notify()
+            return False
+
+        return True
+
+    def clear(self):
+        """Forgets all messages in flight (e.g. when the connection is replaced)"""
+        with self._condition:
+            self._inflight.clear()
+            self._condition.notify_all()
@@ -0,0 +1,539 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import collections
+import heapq
+import itertools
+import queue
+import time
+import typing
+
+from . import topics
+
+# True (initialized) and False (terminate) markers are ordered among Subscribe/Unsubscribe items
+MARKER_PRIORITY = 5
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DROP_NOTIFICATIONS_FIRST = "drop-notifications-first"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, DROP_NOTIFICATIONS_FIRST)
+EXPIRED = "expired"
+
+FLUSH_PERIOD = 1.0  # min delay between two flushes of expired items (in seconds)
+
+# messages of the same priority are dequeued from per class lanes according to these weights
+LANE_WEIGHTS: typing.Dict[str, int] = {topics.REPLY: 8, topics.REQUEST: 4, topics.LIST: 2, topics.NOTIFICATION: 1}
+DEFAULT_LANE_WEIGHT = 4  # other items of the same priority (e.g. spool replay)
+
+
+def item_priority(item) -> int:
+    if isinstance(item, bool):
+        return MARKER_PRIORITY
+    return item.priority
+
+
+def is_droppable(item) -> bool:
+    return getattr(item, "droppable", False)
+
+
+def item_expired(item, now: float) -> bool:
+    expires_at = getattr(item, "expires_at", None)
+    return expires_at is not None and expires_at <= now
+
+
+class Bucket:
+    """Items of a single priority
+
+    Items are split to lanes according to their message class. Lanes are dequeued using
+    smooth weighted round robin so a lane with a lower weight can't starve the others.
+    Items within a lane are returned in FIFO order. A lane can be held (e.g. while
+    its first message waits for a retry) so that the order within the lane is kept.
+    """
+
+    def __init__(self, weights: typing.Mapping[str, int]):
+        self.weights = weights
+        self._lanes: typing.Dict[typing.Optional[str], typing.Deque[typing.Tuple[int, typing.Any]]] = {}
+        self._credits: typing.Dict[typing.Optional[str], int] = {}
+        self._held: typing.Counter[typing.Optional[str]] = collections.Counter()  # lanes which are not dequeued
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _weight(self, lane: typing.Optional[str]) -> int:
+        return self.weights.get(lane, DEFAULT_LANE_WEIGHT) if lane is not None else DEFAULT_LANE_WEIGHT
+
+    def lane(self, item) -> typing.Optional[str]:
+        lane = getattr(item, "message_class", None)
+        return lane if lane in self.weights else None
+
+    def _items(self, lane: typing.Optional[str]) -> typing.Deque[typing.Tuple[int, typing.Any]]:
+        items = self._lanes.get(lane)
+        if items is None:
+            items = self._lanes[lane] = collections.deque()
+            self._credits[lane] = 0
+        return items
+
+    def append(self, sequence: int, item):
+        self._items(self.lane(item)).append((sequence, item))
+        self._size += 1
+
+    def insert(self, sequence: int, item):
+        """Puts an item to its original position within its lane (e.g. a retried message)"""
+        items = self._items(self.lane(item))
+        idx = 0
+        while idx < len(items) and items[idx][0] < sequence:
+            idx += 1
+        items.insert(idx, (sequence, item))
+        self._size += 1
+
+    def hold(self, lane: typing.Optional[str]):
+        """Stops dequeuing the lane till it is released (multiple holds are counted)"""
+        self._held[lane] += 1
+
+    def release(self, lane: typing.Optional[str]):
+        self._held[lane] -= 1
+        if self._held[lane] <= 0:
+            del self._held[lane]
+
+    def release_all(self):
+        self._held.clear()
+
+    def _active(self) -> typing.List[typing.Optional[str]]:
+        return [lane for lane, items in self._lanes.items() if items and lane not in self._held]
+
+    def available(self) -> bool:
+        """Whether an item can be dequeued (some items may be in held lanes)"""
+        return bool(self._active())
+
+    def _next_lane(self) -> typing.Optional[str]:
+        active = self._active()
+        if len(active) == 1:
+            return active[0]
+        return max(active, key=lambda lane: self._credits[lane] + self._weight(lane))
+
+    def peek(self):
+        return self._lanes[self._next_lane()][0][1]
+
+    def popleft(self):
+        active = self._active()
+        if len(active) == 1:
+            lane = active[0]
+        else:
+            for e in active:
+                self._credits[e] += self._weight(e)
+            lane = max(active, key=lambda lane: self._credits[lane])
+            self._credits[lane] -= sum(self._weight(e) for e in active)
+
+        items = self._lanes[lane]
+        _, item = items.popleft()
+        if not items:
+            self._credits[lane] = 0
+        self._size -= 1
+        return item
+
+    def remove_first(self, predicate: typing.Callable[[typing.Any], bool]) -> typing.Any:
+        """Removes the oldest item which matches the predicate
+        :returns: the item or None
+        """
+        found: typing.Optional[typing.Tuple[int, typing.Deque, int]] = None  # sequence, lane, index
+        for items in self._lanes.values():
+            for idx, (sequence, item) in enumerate(items):
+                if predicate(item):
+                    if found is None or sequence < found[0]:
+                        found = (sequence, items, idx)
+                    break
+        if found is None:
+            return None
+
+        _, items, idx = found
+        item = items[idx][1]
+        del items[idx]
+        self._size -= 1
+        return item
+
+    def remove_matching(self, predicate: typing.Callable[[typing.Any], bool]) -> typing.List[typing.Any]:
+        """Removes all matching items"""
+        removed = []
+        for items in self._lanes.values():
+            kept = collections.deque()
+            for entry in items:
+                if predicate(entry[1]):
+                    removed.append(entry[1])
+                else:
+                    kept.append(entry)
+            if len(kept) != len(items):
+                items.clear()
+                items.extend(kept)
+        self._size -= len(removed)
+        return removed
+
+
+class ItemQueue(queue.Queue):
+    """Queue which returns items with the highest priority first
+
+    Items with the same priority are split to lanes according to their
+    message class (see Bucket), items within a lane are returned in FIFO order.
+    Each priority has its own bucket and a heap of non-empty priorities
+    is kept so both put and get are O(log n) at worst.
+
+    Droppable items (messages) can be limited by count and by size.
+    Control items (connect, subscribe, markers, ...) are never dropped
+    and are not counted to the limits.
+
+    Items can be also put with a delay (see put_later). These are kept
+    in a heap ordered by their due time and get() sleeps till the first
+    one is due. A retried message holds its lane while it waits, so it is
+    not overtaken by the newer messages.
+    """
+
+    def __init__(
+        self,
+        max_items: int = 0,
+        max_bytes: int = 0,
+        overflow_policy: str = DROP_OLDEST,
+        lane_weights: typing.Optional[typing.Mapping[str, int]] = None,
+    ):
+        """
+        :param max_items: max number of droppable items in the queue (0 = unlimited)
+        :param max_bytes: max size of droppable items in the queue (0 = unlimited)
+        :param overflow_policy: which item should be dropped when a limit is exceeded
+        :param lane_weights: weights of message classes (None = LANE_WEIGHTS, empty = a single FIFO lane)
+        """
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow_policy}'")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.overflow_policy = overflow_policy
+        self.lane_weights = LANE_WEIGHTS if lane_weights is None else lane_weights
+        # called (with the mutex held) whenever an item may be available, see QueueWorkers
+        self.ready_hook: typing.Optional[typing.Callable[[], None]] = None
+        super().__init__()
+
+    def _init(self, maxsize: int):
+        self._buckets: typing.Dict[int, Bucket] = {}
+        self._priorities: typing.List[int] = []  # heap of negated non-empty priorities
+        self._size = 0
+        self._droppable_count = 0
+        self._droppable_bytes = 0
+        self.drops: typing.Counter[str] = collections.Counter()
+        self._last_flush: typing.Optional[float] = None
+        # heap of (due, sequence, item, whether the item holds its lane)
+        self._delayed: typing.List[typing.Tuple[float, int, typing.Any, bool]] = []
+        self._delayed_ids: typing.Set[int] = set()  # ids of the delayed items
+        self._sequence = itertools.count()
+
+    def _qsize(self) -> int:
+        return self._size
+
+    def _put(self, item, sequence: typing.Optional[int] = None):
+        """
+        :param sequence: original sequence of a retried item (it is put back to its position)
+        """
+        if is_droppable(item):
+            if self._over_limit(1, item.size) and self.overflow_policy == DROP_NEWEST:
+                self.drops[DROP_NEWEST] += 1
+                self._discarded(1)
+                return
+            self._droppable_count += 1
+            self._droppable_bytes += item.size
+
+        priority = item_priority(item)
+        bucket = self._bucket(priority)
+        if not bucket:
+            heapq.heappush(self._priorities, -priority)
+        if sequence is None:
+            sequence = next(self._sequence)
+            bucket.append(sequence, item)
+        else:
+            bucket.insert(sequence, item)
+        if hasattr(item, "sequence"):
+            item.sequence = sequence
+        self._size += 1
+
+        while self._over_limit(0, 0):
+            self._drop()
+
+        if self.ready_hook:
+            self.ready_hook()
+
+    def _promote(self, now: float):
+        """Moves delayed items which are due to the queue"""
+        while self._delayed and self._delayed[0][0] <= now:
+            self._put_delayed(heapq.heappop(self._delayed))
+
+    def _put_delayed(self, entry: typing.Tuple[float, int, typing.Any, bool]):
+        _, _, item, held = entry
+        self._delayed_ids.discard(id(item))
+        if held:
+            bucket = self._bucket(item_priority(item))
+            bucket.release(bucket.lane(item))
+            self._put(item, item.sequence)
+        else:
+            self._put(item)
+
+    def _bucket(self, priority: int) -> Bucket:
+        bucket = self._buckets.get(priority)
+        if bucket is None:
+            bucket = self._buckets[priority] = Bucket(self.lane_weights)
+        return bucket
+
+    def put_later(self, item, delay: float, hold_lane: bool = False):
+        """Puts an item to the queue after a delay
+        :param hold_lane: newer items of the lane wait as well, the item is put back to its original position
+                          (the item needs to be dequeued from this queue before)
+        """
+        with self.mutex:
+            if hold_lane:
+                bucket = self._bucket(item_priority(item))
+                bucket.hold(bucket.lane(item))
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._sequence), item, hold_lane))
+            self._delayed_ids.add(id(item))
+            self.unfinished_tasks += 1
+            # get() needs to recalculate how long to sleep
+            self.not_empty.notify()
+            if self.ready_hook:
+                self.ready_hook()
+
+    def set_ready_hook(self, hook: typing.Optional[typing.Callable[[], None]]):
+        with self.mutex:
+            self.ready_hook = hook
+
+    def next_due(self) -> typing.Optional[float]:
+        """When the first delayed item should be put to the queue (None = no delayed items)"""
+        with self.mutex:
+            return self._delayed[0][0] if self._delayed else None
+
+    def _release_delayed(self, entries: typing.Iterable[typing.Tuple[float, int, typing.Any, bool]]):
+        """Releases lanes held by removed delayed items"""
+        for _, _, item, held in entries:
+            self._delayed_ids.discard(id(item))
+            if held:
+                bucket = self._bucket(item_priority(item))
+                bucket.release(bucket.lane(item))
+
+    def merge_delayed(self, item, other) -> bool:
+        """Merges a newer item to an item which waits to be put to the queue
+
+        Delayed items are not counted to the limits yet, so the size of the item may change.
+        :returns: False when the item is not delayed anymore (it was put to the queue or removed)
+        """
+        with self.mutex:
+            if id(item) not in self._delayed_ids:
+                return False
+            item.merge(other)
+            return True
+
+    def promote_delayed(self, predicate: typing.Callable[[typing.Any], bool]) -> int:
+        """Puts matching delayed items to the queue at once (lanes held by them are released)
+        :param predicate: called with the mutex held
+        :returns: number of promoted items
+        """
+        with self.mutex:
+            promoted, kept = [], []
+            for entry in self._delayed:
+                (promoted if predicate(entry[2]) else kept).append(entry)
+            if not promoted:
+                return 0
+            heapq.heapify(kept)
+            self._delayed = kept
+            for entry in sorted(promoted, key=lambda entry: entry[:2]):
+                self._put_delayed(entry)
+            self.not_empty.notify()
+            return len(promoted)
+
+    def clear_delayed(self) -> int:
+        """Drops all items which are waiting to be put to the queue
+        :returns: number of dropped items
+        """
+        with self.mutex:
+            count = len(self._delayed)
+            self._release_delayed(self._delayed)
+            self._delayed = []
+            self._discarded(count)
+            return count
+
+    def get(self, block: bool = True, timeout: typing.Optional[float] = None):
+        """Same as queue.Queue.get, but it also wakes up when a delayed item is due"""
+        with self.not_empty:
+            end = None if timeout is None else time.monotonic() + timeout
+            while True:
+                now = time.monotonic()
+                self._promote(now)
+                priority = self._next_priority()
+                if priority is not None:
+                    item = self._get(priority)
+                    self.not_full.notify()
+                    return item
+
+                if not block:
+                    raise queue.Empty
+
+                wait_for = self._delayed[0][0] - now if self._delayed else None
+                if end is not None:
+                    if end <= now:
+                        raise queue.Empty
+                    wait_for = end - now if wait_for is None else min(wait_for, end - now)
+                self.not_empty.wait(wait_for)
+
+    def get_next_if(self, predicate: typing.Callable[[typing.Any], bool]) -> typing.Any:
+        """Removes and returns the next item only if it matches the predicate (never blocks)
+        :returns: the item or None
+        """
+        with self.mutex:
+            priority = self._next_priority()
+            if priority is None or not predicate(self._buckets[priority].peek()):
+                return None
+            item = self._get(priority)
+            self.not_full.notify()
+            return item
+
+    def _next_priority(self) -> typing.Optional[int]:
+        """The highest priority with an item which can be dequeued (None = nothing to dequeue)"""
+        if not self._priorities:
+            return None
+        if self._buckets[-self._priorities[0]].available():
+            return -self._priorities[0]
+        for negated in sorted(self._priorities)[1:]:
+            if self._buckets[-negated].available():
+                return -negated
+        return None
+
+    def _get(self, priority: typing.Optional[int] = None):
+        if priority is None:
+            priority = -self._priorities[0]
+        bucket = self._buckets[priority]
+        item = bucket.popleft()
+        if not bucket:
+            if self._priorities[0] == -priority:
+                heapq.heappop(self._priorities)
+            else:
+                self._priorities.remove(-priority)
+                heapq.heapify(self._priorities)
+        self._removed(item)
+        return item
+
+    def _removed(self, item):
+        self._size -= 1
+        if is_droppable(item):
+            self._droppable_count -= 1
+            self._droppable_bytes -= item.size
+
+    def _discarded(self, count: int):
+        """Items which were removed without being dequeued don't wait for task_done()"""
+        self.unfinished_tasks -= count
+        if not self.unfinished_tasks:
+            self.all_tasks_done.notify_all()
+
+    def _over_limit(self, extra_count: int, extra_bytes: int) -> bool:
+        if self.max_items and self._droppable_count + extra_count > self.max_items:
+            return True
+        if self.max_bytes and self._droppable_bytes + extra_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _drop(self):
+        """Drops a single droppable item according to overflow policy"""
+        if self.overflow_policy == DROP_NOTIFICATIONS_FIRST:
+            if self._remove_first(lambda item: is_droppable(item) and item.message_class == topics.NOTIFICATION):
+                self.drops[DROP_NOTIFICATIONS_FIRST] += 1
+                return
+        # DROP_NEWEST is handled when the item is put, but the incomming item may be
+        # a single item which exceeds the byte limit on its own
+        self._remove_first(is_droppable)
+        self.drops[DROP_OLDEST] += 1
+
+    def _remove_first(self, predicate: typing.Callable[[typing.Any], bool]) -> bool:
+        """Removes the oldest item which matches the predicate (lower priorities first)"""
+        for priority in sorted(self._buckets):
+            bucket = self._buckets[priority]
+            item = bucket.remove_first(predicate)
+            if item is not None:
+                if not bucket:
+                    self._priorities.remove(-priority)
+                    heapq.heapify(self._priorities)
+                self._removed(item)
+                self._discarded(1)
+                return True
+        return False
+
+    def _remove_matching(self, predicate: typing.Callable[[typing.Any], bool]) -> int:
+        """Goes through the whole queue and removes matching items"""
+        removed = 0
+        for bucket in self._buckets.values():
+            for item in bucket.remove_matching(predicate):
+                self._removed(item)
+                removed += 1
+
+        if removed:
+            self._priorities = [-priority for priority, bucket in self._buckets.items() if bucket]
+            heapq.heapify(self._priorities)
+            self._discarded(removed)
+
+        return removed
+
+    def remove_if(self, predicate: typing.Callable[[typing.Any], bool]) -> int:
+        """Removes all items (including the delayed ones) which match the predicate
+        :returns: number of removed items
+        """
+        with self.mutex:
+            removed = self._remove_matching(predicate)
+
+            delayed, removed_entries = [], []
+            for entry in self._delayed:
+                (removed_entries if predicate(entry[2]) else delayed).append(entry)
+            removed_delayed = len(removed_entries)
+            if removed_delayed:
+                self._release_delayed(removed_entries)
+                heapq.heapify(delayed)
+                self._delayed = delayed
+                self._discarded(removed_delayed)
+
+            return removed + removed_delayed
+
+    def record_drop(self, reason: str):
+        with self.mutex:
+            self.drops[reason] += 1
+
+    def flush_expired(self, now: float) -> int:
+        """Removes all expired items at once
+
+        It is performed at most once per FLUSH_PERIOD, because it needs to go through the whole queue.
+        :returns: number of removed items
+        """
+        with self.mutex:
+            if self._last_flush is not None and self._last_flush + FLUSH_PERIOD > now:
+                return 0
+            self._last_flush = now
+
+            flushed = self._remove_matching(lambda item: item_expired(item, now))
+            if flushed:
+                self.drops[EXPIRED] += flushed
+            return flushed
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """Returns current queue depth, size of droppable items and drop counters"""
+        with self.mutex:
+            return {
+                "depth": self._size,
+                "messages": self._droppable_count,
+                "bytes": self._droppable_bytes,
+                "delayed": len(self._delayed),
+                "drops": dict(self.drops),
+            }
@@ -0,0 +1,425 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import abc
+import random
+import threading
+import time
+import typing
+
+from paho.mqtt.client import MQTT_ERR_CONN_LOST, MQTT_ERR_SUCCESS, MQTTMessage
+
+from . import topics
+from .client import SUBSCRIBE_FAILURE, Client
+from .configuration import ForwarderOptions
+from .inflight import InflightWindow
+from .itemqueue import EXPIRED, ItemQueue
+from .logger import LoggingMixin
+from .metrics import DirectionMetrics
+from .workers import Wait
+
+QUEUE_TIMEOUT = 10.0
+
+
+class QueueItem(metaclass=abc.ABCMeta):
+    priority = 0
+    droppable = False  # can be dropped when the queue is full
+    retriable = True  # can be performed again when it fails
+    size = 0
+    sequence: typing.Optional[int] = None  # position in the queue (set by the queue)
+
+    def __init__(self):
+        self.attempt_number = 0
+        self.first_attempt = time.monotonic()
+        self.last_attempt = self.first_attempt
+        self.expires_at: typing.Optional[float] = None
+
+    def retry(self):
+        self.attempt_number += 1
+        self.last_attempt = time.monotonic()
+
+    def reset_backoff(self):
+        self.attempt_number = 0
+
+    def expire_in(self, ttl: typing.Optional[float]):
+        """Sets time to live (counted from the item creation, None or 0 = never expires)"""
+        self.expires_at = self.first_attempt + ttl if ttl else None
+
+    def expired(self, now: float) -> bool:
+        return self.expires_at is not None and self.expires_at <= now
+
+    @abc.abstractmethod
+    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
+        pass
+
+
+class Connect(QueueItem):
+    priority = 10
+
+    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
+        if client.connected:
+            # previous attempt timed out, but the client managed to connect later
+            return True
+
+        event = threading.Event()
+        end = self.begin(client, event.set)
+        event.wait(timeout)
+        return end()
+
+    def begin(self, client: Client, finished: typing.Callable[[], None]) -> typing.Callable[[], typing.Optional[bool]]:
+        """Starts to connect without waiting for the reply
+        :param finished: called once the broker replied or the connection was closed
+        :returns: function which ends the attempt and returns the same as perform
+        """
+        res = {}
+
+        def connect(client, userdata, flags, rc):
+            res["rc"] = rc
+            finished()
+
+        def disconnect(mqtt_client, userdata, rc):
+            if mqtt_client is client.client:
+                # connection was closed before the broker replied
+                res.setdefault("rc", rc or MQTT_ERR_CONN_LOST)
+                finished()
+
+        prev_hook = client.connect_hook
+        prev_disconnect_hook = client.disconnect_hook
+        client.set_connect_hook(connect)
+        client.connect()
+        # set afterwards, the previous connection is closed by connect()
+        client.set_disconnect_hook(disconnect)
+
+        def end() -> typing.Optional[bool]:
+            client.set_connect_hook(prev_hook)
+            client.set_disconnect_hook(prev_disconnect_hook)
+            return res["rc"] == MQTT_ERR_SUCCESS if "rc" in res else None
+
+        return end
+
+
+class Disconnect(QueueItem):
+    priority = 10
+    retriable = False
+
+    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
+        if not client.connected:
+            # nothing would confirm the disconnection
+            client.disconnect()
+            return True
+
+        event = threading.Event()
+
+        res = {}
+
+        def disconnect(client, userdata, rc):
+            res["rc"] = rc
+            event.set()
+
+        prev_hook = client.disconnect_hook
+        client.set_disconnect_hook(disconnect)
+        client.disconnect()
+
+        finished = event.wait(timeout)
+        client.set_disconnect_hook(prev_hook)
+
+        return res["rc"] == MQTT_ERR_SUCCESS if finished else None
+
+
+class Publish(QueueItem):
+    priority = 1
+    droppable = True
+
+    def __init__(self, message: MQTTMessage):
+        super().__init__()
+        self.message = message
+        self.message_class = topics.message_class(message.topic)
+        self.size = len(message.payload)
+
+    def merge(self, other: "Publish"):
+        """Newer message of the same topic replaces the current one (while it waits)"""
+        self.message = other.message
+        self.size = other.size
+
+    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
+        event = threading.Event()
+
+        def publish(mid):
+            event.set()
+
+        if client.publish(self.message.topic, self.message.payload, publish) is None:
+            return False
+
+        return True if event.wait(timeout) else None
+
+
+class Subscribe(QueueItem):
+    priority = 5
+
+    def __init__(self, topics_with_qos: typing.List[typing.Tuple[str, int]]):
+        super().__init__()
+        self.topics_with_qos = list(topics_with_qos)
+
+    @property
+    def topic_count(self) -> int:
+        return len(self.topics_with_qos)
+
+    def merge(self, other: "Subscribe"):
+        self.topics_with_qos.extend(other.topics_with_qos)
+
+    @staticmethod
+    def rejected(
+        topics_with_qos: typing.List[typing.Tuple[str, int]], granted_qos: typing.Sequence[int]
+    ) -> typing.List[typing.Tuple[str, int]]:
+        """Topics which were refused by the broker"""
+        return [topic for topic, granted in zip(topics_with_qos, granted_qos) if granted == SUBSCRIBE_FAILURE]
+
+    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
+        event = threading.Event()
+
+        res = {}
+
+        def subscribe(mid, granted_qos):
+            res["granted_qos"] = granted_qos
+            event.set()
+
+        # topics which are kept within the broker session are not subscribed again
+        topics_with_qos = client.subscriptions.missing(self.topics_with_qos)
+        if not topics_with_qos:
+            return True
+
+        if not client.subscribe(topics_with_qos, subscribe):
+            return False
+
+        if not event.wait(timeout):
+            # it is not clear whether the broker got the subscription (a late confirmation registers it)
+            return None
+
+        rejected = Subscribe.rejected(topics_with_qos, res["granted_qos"])
+        if rejected:
+            # only the rejected topics are retried
+            self.topics_with_qos = rejected
+            return False
+
+        return True
+
+
+class Unsubscribe(QueueItem):
+    priority = 5
+
+    def __init__(self, topics: typing.List[str]):
+        super().__init__()
+        self.topics = list(topics)
+
+    @property
+    def topic_count(self) -> int:
+        return len(self.topics)
+
+    def merge(self, other: "Unsubscribe"):
+        self.topics.extend(other.topics)
+
+    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
+        event = threading.Event()
+
+        def unsubscribe(mid):
+            event.set()
+
+        if not client.unsubscribe(self.topics, unsubscribe):
+            return False
+
+        return True if event.wait(timeout) else None
+
+
+class Replay(QueueItem):
+    """Sends messages stored in the spool (ordered among publishes)"""
+
+    priority = 1
+    retriable = False
+
+    def __init__(self, callback: typing.Callable[[], typing.Optional[bool]]):
+        super().__init__()
+        self.callback = callback
+
+    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
+        return self.callback()
+
+
+class Reload(QueueItem):
+    """Replaces the connection (performed by the queue worker so that nobody has to wait for it)"""
+
+    priority = 10
+    retriable = False
+
+    def __init__(self, callback: typing.Callable[[], typing.Optional[bool]]):
+        super().__init__()
+        self.callback = callback
+
+    def perform(self, client: Client, timeout: typing.Optional[float] = None) -> typing.Optional[bool]:
+        return self.callback()
+
+
+class ItemProcessor(LoggingMixin):
+    """Performs queue items and plans retries of the failed ones
+
+    Requires `options` (ForwarderOptions) attribute.
+    """
+
+    options: ForwarderOptions
+
+    def process(
+        self,
+        item: QueueItem,
+        item_queue: ItemQueue,
+        client: Client,
+        window: typing.Optional[InflightWindow],
+        retries: typing.Counter[str],
+        metrics: typing.Optional[DirectionMetrics] = None,
+    ) -> typing.Optional[bool]:
+        now = time.monotonic()
+        if item.expired(now):
+            # nobody is waiting for the message anymore
+            item_queue.record_drop(EXPIRED)
+            self.debug(f"Dropping expired {item.__class__.__name__}")
+            return None
+
+        if isinstance(item, (Subscribe, Unsubscribe)):
+            self.coalesce(item, item_queue)
+
+        res = self.perform(item, client, window, self.publish_completion(metrics, item, now))
+        return self.processed(item, item_queue, client, retries, now, res)
+
+    def process_connect(
+        self, item: Connect, item_queue: ItemQueue, client: Client, retries: typing.Counter[str]
+    ) -> typing.Union[bool, Wait]:
+        """Same as process, but the reply is awaited by QueueWorkers instead of blocking the thread"""
+        if client.connected:
+            return True
+
+        now = time.monotonic()
+
+        def resume(finished: bool) -> bool:
+            self.processed(item, item_queue, client, retries, now, end())
+            return True
+
+        wait = Wait(QUEUE_TIMEOUT, resume)
+        end = item.begin(client, wait.finish)
+        return wait
+
+    def processed(
+        self,
+        item: QueueItem,
+        item_queue: ItemQueue,
+        client: Client,
+        retries: typing.Counter[str],
+        now: float,
+        res: typing.Optional[bool],
+    ) -> typing.Optional[bool]:
+        """Plans a retry of the failed item"""
+        if not res and not client.connected:
+            # the connection failed, get rid of the stale items at once
+            flushed = item_queue.flush_expired(now)
+            if flushed:
+                self.debug(f"Flushed {flushed} expired items")
+
+        if not res:
+            retries["failures"] += 1
+            self.plan_retry(item, item_queue, retries)
+
+        return res
+
+    def coalesce(self, item: typing.Union[Subscribe, Unsubscribe], item_queue: ItemQueue):
+        """Merges directly following items of the same kind so they are sent in a single packet"""
+        limit = self.options.subscribe_batch_size
+
+        def mergeable(other) -> bool:
+            if type(other) is not type(item):
+                return False
+            return not limit or item.topic_count + other.topic_count <= limit
+
+        while True:
+            other = item_queue.get_next_if(mergeable)
+            if other is None:
+                return
+            item.merge(other)
+            item_queue.task_done()
+
+    def retry_delay(self, attempt_number: int) -> float:
+        """Exponential backoff with jitter (random value between half and full delay)"""
+        delay = min(self.options.retry_max_delay, self.options.retry_base_delay * 2 ** (attempt_number - 1))
+        return random.uniform(delay / 2, delay)
+
+    def retry_now(self, item_queue: ItemQueue) -> int:
+        """Performs retried items at once and starts their backoff again (e.g. the connection was restored)
+        :returns: number of items which were retried
+        """
+
+        def retried(item) -> bool:
+            if not item.attempt_number:
+                return False  # not a retry (e.g. a throttled notification)
+            item.reset_backoff()
+            return True
+
+        count = item_queue.promote_delayed(retried)
+        if count:
+            self.debug(f"Retrying {count} delayed items at once")
+        return count
+
+    def plan_retry(self, item: QueueItem, item_queue: ItemQueue, retries: typing.Counter[str]):
+        name = item.__class__.__name__
+        max_attempts = self.options.retry_max_attempts
+        if not item.retriable or (max_attempts and item.attempt_number >= max_attempts):
+            retries["gave_up"] += 1
+            self.warning(f"{name} failed (attempts={item.attempt_number + 1}), giving up")
+            return
+
+        item.retry()
+        delay = self.retry_delay(item.attempt_number)
+        retries["retries"] += 1
+        self.debug(f"{name} failed, retrying in {delay:.2f}s (attempt={item.attempt_number})")
+        # newer messages of the same class wait so that the order of messages is kept
+        item_queue.put_later(item, delay, hold_lane=isinstance(item, Publish))
+
+    @staticmethod
+    def publish_completion(
+        metrics: typing.Optional[DirectionMetrics], item: QueueItem, started: float
+    ) -> typing.Optional[typing.Callable[[], None]]:
+        """Returns a callback which records the message once it is confirmed (None = nothing to record)"""
+        if metrics is None or not isinstance(item, Publish):
+            return None
+        return lambda: metrics.published(item.size, time.monotonic() - started)
+
+    @staticmethod
+    def perform(
+        item: QueueItem,
+        client: Client,
+        window: typing.Optional[InflightWindow],
+        completed: typing.Optional[typing.Callable[[], None]] = None,
+    ) -> typing.Optional[bool]:
+        """
+        :param completed: called once the item is confirmed (later on when published via the window)
+        """
+        if window is not None and isinstance(item, Publish):
+            # don't wait for the confirmation, the window takes care of it
+            return window.publish(
+                client, item.message.topic, item.message.payload, timeout=QUEUE_TIMEOUT, completed=completed
+            )
+        res = item.perform(client, timeout=QUEUE_TIMEOUT)
+        if res and completed:
+            completed()
+        return res
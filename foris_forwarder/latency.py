@@ -0,0 +1,157 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+import bisect
+import collections
+import logging
+import threading
+import typing
+
+from . import topics
+from .logger import LoggingMixin
+
+# upper bounds of histogram buckets in seconds (1 ms .. ~65 s), the last bucket is unbounded
+BUCKETS: typing.List[float] = [0.001 * 2**i for i in range(17)]
+
+REPLY_TIMEOUT = 120.0  # requests without a reply are counted as unanswered afterwards
+MAX_PENDING = 4096
+MAX_SERIES = 1024  # other (controller, module, action) are counted together
+OTHER = "other"
+
+Key = typing.Tuple[str, str, str]  # controller id, module, action
+
+
+class Histogram:
+    """Latency histogram with fixed log-scale buckets"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.unanswered = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        """Upper bound of the bucket which contains the quantile (inf for the last bucket)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[idx] if idx < len(BUCKETS) else float("inf")
+        return float("inf")
+
+    def copy(self) -> "Histogram":
+        res = Histogram()
+        res.counts = list(self.counts)
+        res.count, res.sum, res.unanswered = self.count, self.sum, self.unanswered
+        return res
+
+
+class LatencyTracker(LoggingMixin):
+    """Matches requests to replies according to the reply id and measures the round trip
+
+    The latency is measured from the moment the request is received from the host
+    till its reply is received from the subordinate (i.e. it includes queueing).
+    """
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, name: str):
+        self.name = name
+        self._histograms: typing.Dict[Key, Histogram] = {}
+        # reply id -> (key, received at)
+        self._pending: typing.OrderedDict[str, typing.Tuple[Key, float]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"latency-{self.name}"
+
+    @staticmethod
+    def request_key(topic: str) -> Key:
+        names = topics.module_action(topic)
+        if names:
+            return topics.controller_id(topic) or "", names[0], names[1]
+        # foris-controller/<id>/list or schema
+        return topics.controller_id(topic) or "", "", topic.rsplit("/", 1)[-1]
+
+    def request(self, topic: str, payload: bytes, now: float):
+        parsed = topics.parse_request(payload)
+        if not parsed:
+            return
+        key = self.request_key(topic)
+        with self._lock:
+            self._expire(now)
+            self._pending[parsed[0]] = (key, now)
+
+    def reply(self, topic: str, now: float):
+        reply_id = topic.rsplit("/", 1)[-1]
+        with self._lock:
+            pending = self._pending.pop(reply_id, None)
+            if pending:
+                key, received_at = pending
+                self._histogram(key).observe(now - received_at)
+
+    def _histogram(self, key: Key) -> Histogram:
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            if len(self._histograms) >= MAX_SERIES:
+                key = (key[0], OTHER, OTHER)
+                histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+        return histogram
+
+    def _expire(self, now: float):
+        while self._pending:
+            key, received_at = next(iter(self._pending.values()))
+            if received_at + REPLY_TIMEOUT > now and len(self._pending) < MAX_PENDING:
+                break
+            self._pending.popitem(last=False)
+            self._histogram(key).unanswered += 1
+
+    def histograms(self, now: float) -> typing.Dict[Key, Histogram]:
+        """Returns a copy of histograms (requests which timed out are counted as unanswered)"""
+        with self._lock:
+            self._expire(now)
+            return {key: histogram.copy() for key, histogram in self._histograms.items()}
+
+    def stats(self, now: float) -> typing.Dict[str, typing.Any]:
+        """Returns summary of all histograms"""
+        histograms = self.histograms(now)
+        total = Histogram()
+        for histogram in histograms.values():
+            total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+            total.count += histogram.count
+            total.sum += histogram.sum
+            total.unanswered += histogram.unanswered
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "answered": total.count,
+            "unanswered": total.unanswered,
+            "pending": pending,
+            "p50": total.quantile(0.5),
+            "p99": total.quantile(0.99),
+        }
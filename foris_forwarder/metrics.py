@@ -0,0 +1,234 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+import http.server
+import logging
+import os
+import socketserver
+import threading
+import time
+import typing
+
+from .latency import BUCKETS, Histogram
+from .logger import LoggingMixin
+
+if typing.TYPE_CHECKING:
+    from .multiplexer import HostMultiplexer
+    from .supervisor import ForwarderSupervisor
+
+PREFIX = "foris_forwarder"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = typing.Dict[str, str]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class DirectionMetrics:
+    """Counters of a single direction of a forwarder
+
+    Each instance is updated only from a single thread (the queue worker, or the network thread
+    of the client when publishing via the in-flight window) and it is read without locking
+    by the metrics server, so values may be a bit out of sync.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.publish_latency = Histogram()
+        self.connects = 0  # connects of the clients which were replaced
+
+    def published(self, size: int, duration: float):
+        self.messages += 1
+        self.bytes += size
+        self.publish_latency.observe(duration)
+
+
+class Exposition:
+    """Prometheus text format builder"""
+
+    def __init__(self):
+        self._families: typing.Dict[str, typing.Tuple[str, str, typing.List[str]]] = {}
+
+    @staticmethod
+    def _labels(labels: Labels) -> str:
+        if not labels:
+            return ""
+        escaped = (f'{k}="{escape(str(v))}"' for k, v in labels.items())
+        return "{" + ",".join(escaped) + "}"
+
+    def _family(self, name: str, kind: str, help: str) -> typing.List[str]:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help, [])
+        return family[2]
+
+    def add(self, name: str, kind: str, help: str, value: float, labels: Labels):
+        self._family(name, kind, help).append(f"{PREFIX}_{name}{self._labels(labels)} {value}")
+
+    def add_histogram(self, name: str, help: str, histogram: Histogram, labels: Labels):
+        lines = self._family(name, "histogram", help)
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f"{PREFIX}_{name}_bucket{self._labels({**labels, 'le': repr(bound)})} {cumulative}")
+        lines.append(f"{PREFIX}_{name}_bucket{self._labels({**labels, 'le': '+Inf'})} {histogram.count}")
+        lines.append(f"{PREFIX}_{name}_sum{self._labels(labels)} {histogram.sum}")
+        lines.append(f"{PREFIX}_{name}_count{self._labels(labels)} {histogram.count}")
+
+    def render(self) -> str:
+        res = []
+        for name, (kind, help, lines) in self._families.items():
+            res.append(f"# HELP {PREFIX}_{name} {help}")
+            res.append(f"# TYPE {PREFIX}_{name} {kind}")
+            res.extend(lines)
+        return "\n".join(res) + "\n"
+
+
+def collect(supervisors: typing.Iterable["ForwarderSupervisor"]) -> str:
+    """Renders metrics of all forwarders"""
+    now = time.monotonic()
+    exposition = Exposition()
+    multiplexers: typing.Dict[int, "HostMultiplexer"] = {}
+    for supervisor in supervisors:
+        forwarder = supervisor.forwarder
+        controller_id = forwarder.subordinate_conf.controller_id
+        queues = forwarder.queue_stats()
+
+        directions = (
+            ("to_subordinate", forwarder.subordinate_metrics, queues["subordinate"]),
+            ("to_host", forwarder.host_metrics, queues["host"]),
+        )
+        for direction, metrics, queue in directions:
+            labels = {"controller_id": controller_id, "direction": direction}
+            exposition.add("messages_total", "counter", "Published messages", metrics.messages, labels)
+            exposition.add("bytes_total", "counter", "Published payload bytes", metrics.bytes, labels)
+            exposition.add("queue_depth", "gauge", "Items in the queue", queue["depth"], labels)
+            exposition.add("queue_bytes", "gauge", "Payload bytes in the queue", queue["bytes"], labels)
+            for reason, count in queue["drops"].items():
+                exposition.add("queue_drops_total", "counter", "Dropped messages", count, {**labels, "reason": reason})
+            exposition.add_histogram(
+                "publish_duration_seconds", "Time to publish a single message", metrics.publish_latency, labels
+            )
+
+        clients = [("subordinate", forwarder.subordinate, forwarder.subordinate_metrics)]
+        if forwarder.multiplexer:
+            # shared host connection is reported only once
+            multiplexers[id(forwarder.multiplexer)] = forwarder.multiplexer
+        else:
+            clients.insert(0, ("host", forwarder.host, forwarder.host_metrics))
+        for side, client, metrics in clients:
+            labels = {"controller_id": controller_id, "connection": side}
+            exposition.add("connected", "gauge", "Connection state", int(client.connected), labels)
+            exposition.add(
+                "connects_total", "counter", "Successful connects", metrics.connects + client.connect_count, labels
+            )
+
+        labels = {"controller_id": controller_id}
+        exposition.add("netloc_switches_total", "counter", "Subordinate address changes", supervisor.switches, labels)
+
+        for (target, module, action), histogram in forwarder.latency.histograms(now).items():
+            labels = {"controller_id": target, "module": module, "action": action}
+            exposition.add_histogram("request_duration_seconds", "Request/reply round trip", histogram, labels)
+            exposition.add(
+                "requests_unanswered_total", "counter", "Requests without a reply", histogram.unanswered, labels
+            )
+
+    for multiplexer in multiplexers.values():
+        labels = {"controller_id": multiplexer.host_conf.controller_id, "connection": "host"}
+        exposition.add("connected", "gauge", "Connection state", int(multiplexer.client.connected), labels)
+        exposition.add("connects_total", "counter", "Successful connects", multiplexer.client.connect_count, labels)
+
+    return exposition.render()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    server: "typing.Union[HTTPServer, UnixHTTPServer]"
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collect().encode()
+        except Exception as exc:
+            self.server.owner.error(f"Failed to collect metrics: {exc!r}")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        self.server.owner.debug(format % args)
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    collect: typing.Callable[[], str]
+    owner: "MetricsServer"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    collect: typing.Callable[[], str]
+    owner: "MetricsServer"
+
+
+class MetricsServer(LoggingMixin):
+    """Serves metrics in Prometheus text format via HTTP on a TCP port or on a Unix socket"""
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, listen: str, collect: typing.Callable[[], str]):
+        """
+        :param listen: [host:]port or path to a Unix socket (contains "/")
+        :param collect: renders the metrics
+        """
+        self.listen = listen
+        self.server: typing.Union[HTTPServer, UnixHTTPServer]
+        if "/" in listen:
+            if os.path.exists(listen):
+                os.unlink(listen)  # stale socket of the previous run
+            self.server = UnixHTTPServer(listen, Handler)
+        else:
+            host, _, port = listen.rpartition(":")
+            self.server = HTTPServer((host or "127.0.0.1", int(port)), Handler)
+        self.server.collect = collect
+        self.server.owner = self
+        self.thread = threading.Thread(name="metrics-server", target=self.server.serve_forever, daemon=True)
+
+    def __str__(self):
+        return f"metrics-{self.listen}"
+
+    def start(self):
+        self.debug("Serving metrics")
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if "/" in self.listen and os.path.exists(self.listen):
+            os.unlink(self.listen)
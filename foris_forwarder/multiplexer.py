@@ -0,0 +1,124 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import collections
+import logging
+import threading
+import typing
+
+from paho.mqtt.client import MQTTMessage
+
+from . import topics
+from .client import Client
+from .configuration import ForwarderOptions
+from .configuration import Host as HostConf
+from .itemqueue import ItemQueue
+from .items import Connect, Disconnect, ItemProcessor, Subscribe, Unsubscribe
+from .reactor import Reactor
+
+
+class HostMultiplexer(ItemProcessor):
+    """Single connection to the host shared by all forwarders
+
+    Messages from the host are routed to forwarders according to
+    the controller id which is a part of the topic.
+    """
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(
+        self,
+        host_conf: HostConf,
+        options: typing.Optional[ForwarderOptions] = None,
+        reactor: typing.Optional[Reactor] = None,
+    ):
+        self.options = options or ForwarderOptions()
+        self.host_conf = host_conf
+        self.client = Client(host_conf.client_settings(), f"{host_conf.controller_id}->multiplexer", reactor=reactor)
+        self.client.set_message_hook(self.route)
+        self.client.set_resubscribe_hook(lambda lost: self.queue.put(Subscribe(lost)))
+        self.client.set_state_hook(self.connection_changed)
+        # called when the client connects or disconnects
+        self.state_hook: typing.Optional[typing.Callable[[], None]] = None
+
+        # controller_id -> message handler of a forwarder
+        self._routes: typing.Dict[str, typing.Callable[[typing.Any, typing.Any, MQTTMessage], None]] = {}
+        self._routes_lock = threading.Lock()
+
+        self.retries: typing.Counter[str] = collections.Counter()
+        self.queue: ItemQueue = ItemQueue()
+        self.worker = threading.Thread(name="host-multiplexer-worker", target=self.handle_queue, daemon=True)
+        self.queue.put(Connect())
+        if self.options.consolidated_subscriptions:
+            # routes are added by forwarders, topics are subscribed only once
+            self.queue.put(Subscribe(topics.host_topics(topics.WILDCARD)))
+
+    def __str__(self):
+        return f"multiplexer-{self.host_conf.controller_id}"
+
+    def connection_changed(self, connected: bool):
+        if connected:
+            # retries were planned for the previous connection
+            self.retry_now(self.queue)
+        if self.state_hook:
+            self.state_hook()
+
+    def route(self, client, userdata, message: MQTTMessage):
+        handler = self._routes.get(topics.controller_id(message.topic))
+        if handler:
+            handler(client, userdata, message)
+        else:
+            self.debug(f"No forwarder for '{message.topic}'")
+
+    def register(self, controller_id: str, handler: typing.Callable[[typing.Any, typing.Any, MQTTMessage], None]):
+        """Routes host messages of the controller to the handler"""
+        with self._routes_lock:
+            self._routes[controller_id] = handler
+        if not self.options.consolidated_subscriptions:
+            self.queue.put(Subscribe(topics.host_topics(controller_id)))
+
+    def unregister(self, controller_id: str):
+        with self._routes_lock:
+            self._routes.pop(controller_id, None)
+        if not self.options.consolidated_subscriptions:
+            self.queue.put(Unsubscribe([topic for topic, _ in topics.host_topics(controller_id)]))
+
+    def handle_queue(self):
+        self.debug("Multiplexer queue handler started")
+        while True:
+            item = self.queue.get()
+            self.queue.task_done()
+
+            if item is True:
+                continue
+
+            if item is False:
+                # terminating on empty message
+                return
+
+            self.process(item, self.queue, self.client, None, self.retries)
+
+    def start(self):
+        self.debug("Starting worker")
+        self.worker.start()
+
+    def stop(self):
+        self.debug("Stopping")
+        self.queue.put(Disconnect())
+        self.queue.put(False)
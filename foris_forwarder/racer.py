@@ -0,0 +1,253 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import concurrent.futures
+import logging
+import socket
+import ssl
+import struct
+import threading
+import time
+import typing
+
+from .client import Settings
+from .logger import LoggingMixin
+
+RACE_STAGGER = 0.25  # delay between starts of two attempts (unless the previous one failed sooner)
+RACE_TIMEOUT = 10.0  # a single attempt (TCP + TLS + MQTT handshake)
+RACE_WORKERS = 8  # attempts of all races are run by a shared pool of threads
+KEEPALIVE = 60
+
+CONNACK = 0x20
+DISCONNECT = b"\xe0\x00"
+
+Netloc = typing.Hashable
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode()
+    return struct.pack("!H", len(data)) + data
+
+
+def connect_packet(client_id: str, username: typing.Optional[str] = None, password: typing.Optional[str] = None):
+    """MQTT 3.1.1 CONNECT with a clean session (the probe must not touch the session of the forwarder)"""
+    flags = 0x02
+    payload = encode_string(client_id)
+    if username:
+        flags |= 0x80
+        payload += encode_string(username)
+        if password:
+            flags |= 0x40
+            payload += encode_string(password)
+    body = encode_string("MQTT") + struct.pack("!BBH", 4, flags, KEEPALIVE) + payload
+
+    length = b""
+    remaining = len(body)
+    while True:
+        byte, remaining = remaining % 128, remaining // 128
+        length += bytes([byte | 0x80 if remaining else byte])
+        if not remaining:
+            break
+    return b"\x10" + length + body
+
+
+def tls_context(settings: Settings) -> typing.Optional[ssl.SSLContext]:
+    """Same TLS setup as the client uses (pinned certificate, host name is not checked)"""
+    if not (settings.ca_certs and settings.certfile and settings.keyfile):
+        return None
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.load_verify_locations(str(settings.ca_certs))
+    context.load_cert_chain(str(settings.certfile), str(settings.keyfile))
+    return context
+
+
+class Attempt:
+    """Connection attempt to a single netloc"""
+
+    def __init__(self, netloc: Netloc, settings: Settings, client_id: str):
+        self.netloc = netloc
+        self.settings = settings
+        self.client_id = client_id
+        self.started: typing.Optional[float] = None
+        self.latency: typing.Optional[float] = None  # set when the handshake is completed
+        self.error: typing.Optional[str] = None  # set when the attempt failed
+        self.cancelled = False
+        self.cancelled_after: typing.Optional[float] = None  # the latency is at least this long
+        self._sock: typing.Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.latency is not None or self.error is not None
+
+    def _register(self, sock: socket.socket):
+        with self._lock:
+            self._sock = sock
+            if self.cancelled:
+                sock.shutdown(socket.SHUT_RDWR)
+
+    def cancel(self):
+        """Interrupts the attempt (its socket is shut down)"""
+        with self._lock:
+            self.cancelled = True
+            if self.started is not None:
+                self.cancelled_after = time.monotonic() - self.started
+            if self._sock:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass  # not connected yet or already closed
+
+    def run(self, timeout: float):
+        with self._lock:
+            if self.cancelled:
+                return  # cancelled while waiting for a free worker
+            self.started = time.monotonic()
+
+        sock: typing.Optional[socket.socket] = None
+        try:
+            context = tls_context(self.settings)
+            sock = socket.create_connection((self.settings.host, self.settings.port), timeout)
+            self._register(sock)
+            if context:
+                sock = context.wrap_socket(sock)
+                self._register(sock)
+            sock.settimeout(max(self.started + timeout - time.monotonic(), 0.001))
+            sock.sendall(connect_packet(self.client_id, self.settings.username, self.settings.password))
+            connack = b""
+            while len(connack) < 4:
+                chunk = sock.recv(4 - len(connack))
+                if not chunk:
+                    raise ConnectionError("connection closed")
+                connack += chunk
+            if connack[0] != CONNACK or connack[3] != 0:
+                raise ConnectionRefusedError(f"connection refused (rc={connack[3]})")
+            self.latency = time.monotonic() - self.started
+            sock.sendall(DISCONNECT)
+        except (OSError, ssl.SSLError) as exc:
+            if self.latency is None:
+                self.error = str(exc) or exc.__class__.__name__
+        finally:
+            if sock is not None:
+                # the wrapped socket is not closed together with the plain one
+                sock.close()
+
+
+class ConnectionRace(LoggingMixin):
+    """Connects to several netlocs concurrently and keeps the first one which completes MQTT handshake
+
+    Attempts are started one after another in `stagger` intervals (the next one is started at once
+    when all started attempts failed). The remaining attempts are cancelled once there is a winner.
+    Probes use their own client ids and clean sessions, the actual connection is established
+    by the forwarder afterwards.
+
+    Attempts are run by a pool shared by all races, so the number of threads is bounded.
+    """
+
+    logger = logging.getLogger(__file__)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=RACE_WORKERS, thread_name_prefix="race-attempt")
+
+    def __init__(
+        self,
+        name: str,
+        candidates: typing.List[typing.Tuple[Netloc, Settings]],
+        finished: typing.Callable[["ConnectionRace"], None] = lambda race: None,
+        stagger: float = RACE_STAGGER,
+        timeout: float = RACE_TIMEOUT,
+        executor: typing.Optional[concurrent.futures.Executor] = None,
+    ):
+        """
+        :param candidates: netlocs with their settings (best ranked first)
+        :param finished: called from the race thread when the race is over
+        :param executor: runs the attempts (the shared pool by default)
+        """
+        self.name = name
+        self.attempts = [
+            Attempt(netloc, settings, f"{name}-race-{index}") for index, (netloc, settings) in enumerate(candidates)
+        ]
+        self.finished = finished
+        self.stagger = stagger
+        self.timeout = timeout
+        self.executor = executor or ConnectionRace.executor
+        self.winner: typing.Optional[Attempt] = None
+        self.done = False
+        self.cancelled = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(name=f"race-{name}", target=self._run, daemon=True)
+
+    def __str__(self):
+        return f"race-{self.name}"
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        """Stops the race (`finished` is still called)"""
+        with self._condition:
+            self.cancelled = True
+            self._condition.notify()
+
+    def join(self, timeout: typing.Optional[float] = None):
+        self._thread.join(timeout)
+
+    def losers(self) -> typing.List[Attempt]:
+        return [attempt for attempt in self.attempts if attempt is not self.winner and attempt.started is not None]
+
+    def _attempt(self, attempt: Attempt):
+        attempt.run(self.timeout)
+        with self._condition:
+            if attempt.latency is not None and self.winner is None:
+                self.winner = attempt
+            self._condition.notify()
+
+    def _over(self, started: typing.List[Attempt]) -> bool:
+        return (
+            self.cancelled
+            or self.winner is not None
+            or (len(started) == len(self.attempts) and all(attempt.finished for attempt in started))
+        )
+
+    def _run(self):
+        started: typing.List[Attempt] = []
+        deadline = time.monotonic()
+        with self._condition:
+            while not self._over(started):
+                now = time.monotonic()
+                failed = not started or started[-1].error is not None
+                if len(started) < len(self.attempts) and (now >= deadline or failed):
+                    attempt = self.attempts[len(started)]
+                    started.append(attempt)
+                    self.debug(f"Connecting to {attempt.settings.host}:{attempt.settings.port}")
+                    self.executor.submit(self._attempt, attempt)
+                    deadline = now + self.stagger
+                    continue
+                self._condition.wait(max(deadline - now, 0.0) if len(started) < len(self.attempts) else None)
+
+            for attempt in started:
+                if not attempt.finished:
+                    attempt.cancel()
+            self.done = True
+
+        if self.winner:
+            self.debug(f"Winner {self.winner.settings.host}:{self.winner.settings.port} ({self.winner.latency:.3f}s)")
+        else:
+            self.debug("No netloc is reachable")
+        self.finished(self)
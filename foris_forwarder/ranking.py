@@ -0,0 +1,229 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import heapq
+import itertools
+import math
+import typing
+
+LATENCY_ALPHA = 0.3  # weight of a new connect latency sample
+SUCCESS_ALPHA = 0.2  # weight of a new attempt outcome
+DECAY = 3600.0  # older statistics weigh less (in seconds)
+REFRESH_PERIOD = 60.0  # how often are the ranking keys recomputed (statistics decay over time)
+UNKNOWN_LATENCY = 1.0  # expected connect latency of netlocs which were not measured yet
+FAILURE_COST = 10.0  # time wasted by a failed attempt (in seconds)
+MIN_SUCCESS = 0.05
+
+Netloc = typing.Hashable
+Key = typing.Tuple[int, float, float]
+
+
+def ewma(value: float, sample: float, alpha: float, age: float) -> float:
+    """Moving average where the history weighs less the older it is"""
+    weight = (1.0 - alpha) * math.exp(-max(age, 0.0) / DECAY)
+    return weight * value + (1.0 - weight) * sample
+
+
+class NetlocStat:
+    """Netloc triage statistics used for sorting netlocs
+
+    Netlocs are ordered by consecutive failures, expected connect cost (latency and the time
+    wasted by failed attempts according to the success ratio) and the last time they were
+    seen working or announced.
+    """
+
+    def __init__(self, fail_count: int, when: float, latency: typing.Optional[float] = None):
+        self._fail_count = fail_count
+        self._when = when
+        self.latency = latency  # EWMA of connect latency (None = not measured)
+        self.success = 1.0  # EWMA of attempt outcomes (1 = success, 0 = failure)
+        self.updated: typing.Optional[float] = None  # last observation
+        self.changed: typing.Callable[[], None] = lambda: None  # set by the ranker
+
+    @property
+    def fail_count(self) -> int:
+        return self._fail_count
+
+    @fail_count.setter
+    def fail_count(self, value: int):
+        self._fail_count = value
+        self.changed()
+
+    @property
+    def when(self) -> float:
+        return self._when
+
+    @when.setter
+    def when(self, value: float):
+        self._when = value
+        self.changed()
+
+    @property
+    def cost(self) -> float:
+        return self.cost_at(None)
+
+    def cost_at(self, now: typing.Optional[float]) -> float:
+        """Expected connect cost, statistics which were not updated for a long time return to the defaults
+        :param now: None = no decay
+        """
+        weight = 1.0 if now is None else math.exp(-max(self._age(now), 0.0) / DECAY)
+        latency = UNKNOWN_LATENCY if self.latency is None else self.latency
+        latency = UNKNOWN_LATENCY + (latency - UNKNOWN_LATENCY) * weight
+        success = max(1.0 - (1.0 - self.success) * weight, MIN_SUCCESS)
+        return latency + (1.0 - success) / success * FAILURE_COST
+
+    def key(self, now: typing.Optional[float] = None) -> Key:
+        return (self.fail_count, self.cost_at(now), -self.when)
+
+    def _age(self, now: float) -> float:
+        return 0.0 if self.updated is None else now - self.updated
+
+    def observe(self, now: float, success: bool, latency: typing.Optional[float] = None):
+        """Records an outcome of a connection attempt"""
+        age = self._age(now)
+        if latency is not None:
+            self.latency = latency if self.latency is None else ewma(self.latency, latency, LATENCY_ALPHA, age)
+        self.success = ewma(self.success, 1.0 if success else 0.0, SUCCESS_ALPHA, age)
+        self.updated = now
+        self.changed()
+
+    def observe_slower(self, now: float, latency: float):
+        """Records that the connect latency is at least `latency` (the attempt was cancelled)"""
+        if self.latency is not None and self.latency >= latency:
+            return
+        age = self._age(now)
+        self.latency = latency if self.latency is None else ewma(self.latency, latency, LATENCY_ALPHA, age)
+        self.updated = now
+        self.changed()
+
+    def __lt__(self, other):
+        return self.key() < other.key()
+
+    def __str__(self):
+        return f"{self.fail_count}-{self.when}"
+
+
+class NetlocRanker:
+    """Keeps netlocs ordered by their statistics
+
+    Ranking keys are kept in a heap which is updated whenever a statistic changes.
+    Replaced keys are skipped when they reach the top, so the best netlocs are
+    selected in O(log n) without sorting all of them.
+
+    With a clock the keys are computed with time decay, all of them are recomputed
+    every REFRESH_PERIOD (statistics which are not updated return to the defaults).
+    """
+
+    def __init__(self, clock: typing.Optional[typing.Callable[[], float]] = None):
+        """
+        :param clock: time of the observations (None = no time decay)
+        """
+        self.stats: typing.Dict[Netloc, NetlocStat] = {}
+        self._heap: typing.List[typing.Tuple[Key, int, Netloc]] = []
+        self._current: typing.Dict[Netloc, int] = {}  # netloc -> sequence of its valid heap entry
+        self._sequence = itertools.count()
+        self.clock = clock
+        self.now: typing.Optional[float] = clock() if clock else None  # keys are computed for this time
+
+    def __len__(self) -> int:
+        return len(self.stats)
+
+    def __contains__(self, netloc: Netloc) -> bool:
+        return netloc in self.stats
+
+    def get(self, netloc: Netloc) -> typing.Optional[NetlocStat]:
+        return self.stats.get(netloc)
+
+    def add(self, netloc: Netloc, stat: NetlocStat):
+        self.stats[netloc] = stat
+        stat.changed = lambda: self.update(netloc)
+        self.update(netloc)
+
+    def remove(self, netloc: Netloc):
+        stat = self.stats.pop(netloc, None)
+        if stat:
+            stat.changed = lambda: None
+            del self._current[netloc]
+
+    def update(self, netloc: Netloc):
+        """Replaces the heap entry of the netloc (called when its statistics change)"""
+        stat = self.stats.get(netloc)
+        if not stat:
+            return
+        sequence = next(self._sequence)
+        self._current[netloc] = sequence
+        heapq.heappush(self._heap, (stat.key(self.now), sequence, netloc))
+        if len(self._heap) > 2 * len(self.stats) + 16:
+            self._heap = [entry for entry in self._heap if self._current.get(entry[2]) == entry[1]]
+            heapq.heapify(self._heap)
+
+    def refresh(self, now: typing.Optional[float] = None):
+        """Recomputes keys of all netlocs (e.g. to apply the time decay)"""
+        self.now = now
+        self._current.clear()
+        self._heap = []
+        for netloc in self.stats:
+            self.update(netloc)
+
+    def _refresh_if_stale(self):
+        if self.clock is None:
+            return
+        now = self.clock()
+        if self.now is None or now - self.now >= REFRESH_PERIOD:
+            self.refresh(now)
+
+    def _pop(self) -> typing.Optional[typing.Tuple[Key, int, Netloc]]:
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if self._current.get(entry[2]) == entry[1]:
+                return entry
+        return None
+
+    def best(self) -> typing.Optional[Netloc]:
+        self._refresh_if_stale()
+        while self._heap:
+            _, sequence, netloc = self._heap[0]
+            if self._current.get(netloc) == sequence:
+                return netloc
+            heapq.heappop(self._heap)
+        return None
+
+    def top(self, count: int) -> typing.List[Netloc]:
+        """Returns `count` best netlocs (best first)"""
+        self._refresh_if_stale()
+        entries = []
+        while len(entries) < count:
+            entry = self._pop()
+            if entry is None:
+                break
+            entries.append(entry)
+        for entry in entries:
+            heapq.heappush(self._heap, entry)
+        return [netloc for _, _, netloc in entries]
+
+    def ranked(self) -> typing.List[Netloc]:
+        """Returns all netlocs (best first)"""
+        return self.top(len(self.stats))
+
+    def trim(self, count: int):
+        """Keeps only `count` best netlocs"""
+        if len(self.stats) <= count:
+            return
+        for netloc in self.ranked()[count:]:
+            self.remove(netloc)
@@ -0,0 +1,264 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import collections
+import concurrent.futures
+import heapq
+import logging
+import selectors
+import socket
+import threading
+import time
+import typing
+
+from paho.mqtt import client as mqtt
+
+from .logger import LoggingMixin
+from .workers import QueueWorkers
+
+
+class Reactor(LoggingMixin):
+    """Drives network I/O of all paho clients from a single thread
+
+    Instead of running one network thread per connection (loop_start) the sockets
+    of all registered clients are multiplexed using selectors. Blocking operations
+    (TCP connect, TLS handshake) are performed in a small fixed pool of threads
+    and queue items of the forwarders are processed by `queue_workers`,
+    so the number of threads doesn't grow with the number of subordinates.
+    """
+
+    MISC_PERIOD = 1.0
+    RECONNECT_DELAY = 1.0
+    CONNECT_WORKERS = 2
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, connect_workers: int = CONNECT_WORKERS, queue_workers: int = QueueWorkers.WORKERS):
+        self.selector = selectors.DefaultSelector()
+        self.clients: typing.Set[mqtt.Client] = set()
+        self._released: typing.Set[mqtt.Client] = set()
+
+        # callbacks which has to be performed within the reactor thread (selector is not thread-safe)
+        self._calls: typing.Deque[typing.Callable[[], None]] = collections.deque()
+        # (due, seq, client) of planned reconnects
+        self._reconnects: typing.List[typing.Tuple[float, int, mqtt.Client]] = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+        self.connector = concurrent.futures.ThreadPoolExecutor(
+            max_workers=connect_workers, thread_name_prefix="reactor-connect"
+        )
+        self.queue_workers = QueueWorkers(queue_workers)
+        self.thread = threading.Thread(name="reactor", target=self.run, daemon=True)
+        self._running = False
+
+    def __str__(self):
+        return "reactor"
+
+    def start(self):
+        self.debug("Starting")
+        self._running = True
+        self.thread.start()
+        self.queue_workers.start()
+
+    def stop(self):
+        self.debug("Stopping")
+        self._running = False
+        self._wakeup()
+        self.connector.shutdown(wait=False)
+        self.queue_workers.stop()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # reactor is already woken up
+
+    def call_soon(self, callback: typing.Callable[[], None]):
+        """Performs the callback within the reactor thread"""
+        self._calls.append(callback)
+        self._wakeup()
+
+    def attach(self, client: mqtt.Client):
+        """Starts to drive network I/O of the client"""
+
+        def on_socket_open(client, userdata, sock):
+            self.call_soon(lambda: self._register(client, sock))
+
+        def on_socket_close(client, userdata, sock):
+            self.call_soon(lambda: self._unregister(client, sock))
+
+        def on_socket_register_write(client, userdata, sock):
+            self.call_soon(lambda: self._modify(client, sock, selectors.EVENT_READ | selectors.EVENT_WRITE))
+
+        def on_socket_unregister_write(client, userdata, sock):
+            self.call_soon(lambda: self._modify(client, sock, selectors.EVENT_READ))
+
+        client.on_socket_open = on_socket_open
+        client.on_socket_close = on_socket_close
+        client.on_socket_register_write = on_socket_register_write
+        client.on_socket_unregister_write = on_socket_unregister_write
+
+        with self._lock:
+            self.clients.add(client)
+
+    def release(self, client: mqtt.Client):
+        """Stops to drive the client once its socket is closed (it won't be reconnected)"""
+        with self._lock:
+            self._released.add(client)
+        if client.socket() is None:
+            self.call_soon(lambda: self._forget(client))
+
+    def connect(
+        self,
+        client: mqtt.Client,
+        host: str,
+        port: int,
+        keepalive: int,
+        failed: typing.Optional[typing.Callable[[], None]] = None,
+    ):
+        """Connects the client in the background (socket is registered once it is opened)
+        :param failed: called when the connection can't be opened (it is retried later)
+        """
+        self.attach(client)
+
+        def connect():
+            try:
+                client.connect(host, port, keepalive)
+            except Exception as exc:
+                self.warning(f"Failed to connect to {host}:{port}: {exc}")
+                self.call_soon(lambda: self._plan_reconnect(client))
+                if failed:
+                    failed()
+
+        self.connector.submit(connect)
+
+    def _forget(self, client: mqtt.Client):
+        with self._lock:
+            self.clients.discard(client)
+            self._released.discard(client)
+
+    def _register(self, client: mqtt.Client, sock):
+        try:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.want_write() else 0)
+            self.selector.register(sock, events, client)
+        except (KeyError, ValueError, OSError) as exc:
+            self.debug(f"Failed to register socket: {exc}")
+
+    def _unregister(self, client: mqtt.Client, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError, OSError):
+            pass  # not registered or already closed
+
+        with self._lock:
+            released = client in self._released
+        if released:
+            self._forget(client)
+        else:
+            self._plan_reconnect(client)
+
+    def _modify(self, client: mqtt.Client, sock, events: int):
+        try:
+            self.selector.modify(sock, events, client)
+        except (KeyError, ValueError, OSError):
+            pass  # socket was closed meanwhile
+
+    def _plan_reconnect(self, client: mqtt.Client):
+        with self._lock:
+            if client in self._released or client not in self.clients:
+                return
+        self._seq += 1
+        heapq.heappush(self._reconnects, (time.monotonic() + Reactor.RECONNECT_DELAY, self._seq, client))
+
+    def _reconnect(self, client: mqtt.Client):
+        def reconnect():
+            try:
+                client.reconnect()
+            except Exception as exc:
+                self.debug(f"Failed to reconnect: {exc}")
+                self.call_soon(lambda: self._plan_reconnect(client))
+
+        self.connector.submit(reconnect)
+
+    def _process_calls(self):
+        while self._calls:
+            self._calls.popleft()()
+
+    def _process_reconnects(self, now: float):
+        while self._reconnects and self._reconnects[0][0] <= now:
+            _, _, client = heapq.heappop(self._reconnects)
+            with self._lock:
+                if client in self._released or client not in self.clients:
+                    continue
+            if client.socket() is None:
+                self._reconnect(client)
+
+    def _process_misc(self):
+        with self._lock:
+            clients = list(self.clients)
+        for client in clients:
+            if client.socket() is not None:
+                client.loop_misc()
+
+    def _handle(self, client: mqtt.Client, sock, events: int):
+        if events & selectors.EVENT_READ:
+            client.loop_read()
+            # TLS layer may hold already decrypted data which won't trigger the selector
+            while client.socket() is sock and getattr(sock, "pending", lambda: 0)():
+                client.loop_read()
+        if events & selectors.EVENT_WRITE and client.socket() is sock:
+            client.loop_write()
+
+    def run(self):
+        self.debug("Reactor started")
+        next_misc = time.monotonic() + Reactor.MISC_PERIOD
+        while self._running:
+            timeout = next_misc
+            if self._reconnects:
+                timeout = min(timeout, self._reconnects[0][0])
+            timeout = max(0.0, timeout - time.monotonic())
+
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self._wakeup_r.recv(1024):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    self._handle(key.data, key.fileobj, events)
+                except Exception as exc:
+                    self.error(f"Failed to handle network event: {exc}")
+
+            self._process_calls()
+
+            now = time.monotonic()
+            self._process_reconnects(now)
+            if now >= next_misc:
+                self._process_misc()
+                next_misc = now + Reactor.MISC_PERIOD
+
+        self.debug("Reactor terminated")
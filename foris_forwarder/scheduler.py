@@ -0,0 +1,103 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+import heapq
+import itertools
+import threading
+import time
+import typing
+
+Key = typing.Hashable
+
+
+class Scheduler:
+    """Plans when something (e.g. a supervisor) should be checked
+
+    Each key has at most one deadline (the earliest one planned wins, so a check
+    can't be postponed by a stale plan), keys can be also notified to be checked
+    at once (from any thread). Deadlines are kept in a heap, replaced deadlines
+    are skipped when they reach the top.
+    """
+
+    def __init__(self, wakeup: typing.Callable[[], None] = lambda: None):
+        """
+        :param wakeup: called when a key is notified (e.g. to wake up an event loop)
+        """
+        self.wakeup = wakeup
+        self._heap: typing.List[typing.Tuple[float, int, Key]] = []
+        self._deadlines: typing.Dict[Key, float] = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def schedule(self, key: Key, due: typing.Optional[float]):
+        """Plans a check of the key at due time (monotonic, None = nothing to plan)"""
+        if due is None:
+            return
+        with self._condition:
+            planned = self._deadlines.get(key)
+            if planned is not None and planned <= due:
+                return
+            self._deadlines[key] = due
+            heapq.heappush(self._heap, (due, next(self._sequence), key))
+            self._condition.notify()
+
+    def notify(self, key: Key):
+        """Plans an immediate check of the key"""
+        self.schedule(key, time.monotonic())
+        self.wakeup()
+
+    def next_due(self) -> typing.Optional[float]:
+        with self._condition:
+            self._skip_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> typing.List[Key]:
+        """Removes and returns keys which are due"""
+        res = []
+        with self._condition:
+            while True:
+                self._skip_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    return res
+                _, _, key = heapq.heappop(self._heap)
+                del self._deadlines[key]
+                res.append(key)
+
+    def wait(self, timeout: typing.Optional[float] = None) -> typing.List[Key]:
+        """Sleeps till some keys are due and returns them (empty list on timeout)"""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                due = self.pop_due(now)
+                if due:
+                    return due
+                if end is not None and end <= now:
+                    return []
+                self._skip_stale()
+                wait_for = self._heap[0][0] - now if self._heap else None
+                if end is not None:
+                    wait_for = end - now if wait_for is None else min(wait_for, end - now)
+                self._condition.wait(wait_for)
+
+    def _skip_stale(self):
+        while self._heap:
+            due, _, key = self._heap[0]
+            if self._deadlines.get(key) == due:
+                return
+            heapq.heappop(self._heap)
@@ -0,0 +1,248 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import collections
+import logging
+import mmap
+import pathlib
+import struct
+import threading
+import typing
+import zlib
+
+from .logger import LoggingMixin
+
+MAGIC = b"FFS1"
+HEADER = struct.Struct("<4sII")  # magic, read offset, write offset
+RECORD = struct.Struct("<IIHd")  # crc32, payload length, topic length, created (wall clock)
+SEGMENT_SUFFIX = ".seg"
+
+DROP_SPOOL_FULL = "spool-full"
+DROP_TOO_LARGE = "too-large"
+
+
+class SpoolRecord(typing.NamedTuple):
+    topic: str
+    payload: bytes
+    created: float
+    position: typing.Tuple[int, int]  # (segment number, offset after the record)
+
+
+class Segment:
+    """Single memory mapped file of the spool
+
+    Records are only appended. Read and write offsets are kept in the header
+    so the segment can be reopened after a restart.
+    """
+
+    def __init__(self, path: pathlib.Path, number: int, size: int, create: bool):
+        self.path = path
+        self.number = number
+        if create:
+            with path.open("wb") as f:
+                f.truncate(size)
+        self._file = path.open("r+b")
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self.size = len(self._mmap)
+        if create:
+            HEADER.pack_into(self._mmap, 0, MAGIC, HEADER.size, HEADER.size)
+        elif HEADER.unpack_from(self._mmap, 0)[0] != MAGIC:
+            self.close()
+            raise ValueError(f"'{path}' is not a spool segment")
+
+    @property
+    def read_offset(self) -> int:
+        return HEADER.unpack_from(self._mmap, 0)[1]
+
+    @property
+    def write_offset(self) -> int:
+        return HEADER.unpack_from(self._mmap, 0)[2]
+
+    @property
+    def exhausted(self) -> bool:
+        return self.read_offset >= self.write_offset
+
+    def append(self, topic: bytes, payload: bytes, created: float) -> bool:
+        """Appends a record (the write offset is updated afterwards, so a partial record is never read)"""
+        offset = self.write_offset
+        end = offset + RECORD.size + len(topic) + len(payload)
+        if end > self.size:
+            return False
+        crc = zlib.crc32(payload, zlib.crc32(topic))
+        RECORD.pack_into(self._mmap, offset, crc, len(payload), len(topic), created)
+        start = offset + RECORD.size
+        self._mmap[start : start + len(topic)] = topic
+        self._mmap[start + len(topic) : end] = payload
+        HEADER.pack_into(self._mmap, 0, MAGIC, self.read_offset, end)
+        return True
+
+    def read(self, max_count: int) -> typing.List[SpoolRecord]:
+        records: typing.List[SpoolRecord] = []
+        offset, end = self.read_offset, self.write_offset
+        while offset < end and len(records) < max_count:
+            crc, payload_len, topic_len, created = RECORD.unpack_from(self._mmap, offset)
+            start = offset + RECORD.size
+            topic = self._mmap[start : start + topic_len]
+            payload = self._mmap[start + topic_len : start + topic_len + payload_len]
+            if zlib.crc32(payload, zlib.crc32(topic)) != crc:
+                # damaged (e.g. by a power outage), the rest of the segment is skipped
+                HEADER.pack_into(self._mmap, 0, MAGIC, end, end)
+                break
+            offset = start + topic_len + payload_len
+            records.append(SpoolRecord(topic.decode(), payload, created, (self.number, offset)))
+        return records
+
+    def consume(self, offset: int):
+        HEADER.pack_into(self._mmap, 0, MAGIC, offset, self.write_offset)
+
+    def rewind(self):
+        """Reuses an exhausted segment from the beginning"""
+        HEADER.pack_into(self._mmap, 0, MAGIC, HEADER.size, HEADER.size)
+
+    def close(self):
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        self.path.unlink()
+
+
+class Spool(LoggingMixin):
+    """Persistent store of messages which can't be delivered at the moment
+
+    Messages are appended to a ring of fixed size memory mapped segments.
+    Only the segment which is read and the segment which is written are mapped,
+    so both the disk usage (segment_size * max_segments) and the memory usage
+    (2 * segment_size) are bounded. When the ring is full the oldest segment
+    is dropped.
+    """
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, directory: pathlib.Path, segment_size: int, max_segments: int):
+        """
+        :param directory: where the segments are stored (created if missing)
+        :param segment_size: size of a single segment file in bytes
+        :param max_segments: max number of segment files
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(max_segments, 1)
+        self.drops: typing.Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._numbers: typing.Deque[int] = collections.deque(
+            sorted(int(path.stem) for path in self.directory.glob(f"*{SEGMENT_SUFFIX}") if path.stem.isdigit())
+        )
+        self._head: typing.Optional[Segment] = None  # segment which is read
+        self._tail: typing.Optional[Segment] = None  # segment which is written
+        if self._numbers:
+            self._head = self._open(self._numbers[0])
+            self._tail = self._head if len(self._numbers) == 1 else self._open(self._numbers[-1])
+            self.debug(f"Spool loaded ({len(self._numbers)} segments)")
+
+    def __str__(self):
+        return f"spool-{self.directory.name}"
+
+    def _path(self, number: int) -> pathlib.Path:
+        return self.directory / f"{number:012d}{SEGMENT_SUFFIX}"
+
+    def _open(self, number: int, create: bool = False) -> Segment:
+        return Segment(self._path(number), number, self.segment_size, create)
+
+    @property
+    def empty(self) -> bool:
+        with self._lock:
+            return self._empty()
+
+    def _empty(self) -> bool:
+        return self._head is None or (len(self._numbers) == 1 and self._head.exhausted)
+
+    def append(self, topic: str, payload: bytes, created: float) -> bool:
+        """Stores a message (returns False when it doesn't fit into a segment)"""
+        encoded_topic = topic.encode()
+        if RECORD.size + len(encoded_topic) + len(payload) > self.segment_size - HEADER.size:
+            self.drops[DROP_TOO_LARGE] += 1
+            return False
+
+        with self._lock:
+            if self._closed:
+                return False
+            if self._tail is None or not self._tail.append(encoded_topic, payload, created):
+                self._rotate()
+                assert self._tail
+                self._tail.append(encoded_topic, payload, created)
+        return True
+
+    def _rotate(self):
+        """Starts a new segment and drops the oldest one when the ring is full"""
+        number = self._numbers[-1] + 1 if self._numbers else 0
+        if self._tail is not None and self._tail is not self._head:
+            self._tail.close()
+        self._tail = self._open(number, create=True)
+        self._numbers.append(number)
+        if self._head is None:
+            self._head = self._tail
+
+        while len(self._numbers) > self.max_segments:
+            self.warning("Spool is full, dropping the oldest segment")
+            self.drops[DROP_SPOOL_FULL] += 1
+            self._drop_head()
+
+    def _drop_head(self):
+        assert self._head
+        self._head.remove()
+        self._numbers.popleft()
+        self._head = self._tail if self._numbers[0] == self._tail.number else self._open(self._numbers[0])
+
+    def read(self, max_count: int) -> typing.List[SpoolRecord]:
+        """Returns the oldest records (they are kept till they are committed)"""
+        with self._lock:
+            while self._head is not None and self._head.exhausted and len(self._numbers) > 1:
+                # segment was processed
+                self._drop_head()
+            if self._head is None:
+                return []
+            return self._head.read(max_count)
+
+    def commit(self, position: typing.Tuple[int, int]):
+        """Marks records till the position as processed"""
+        number, offset = position
+        with self._lock:
+            if self._head is not None and self._head.number == number:
+                self._head.consume(offset)
+                if len(self._numbers) == 1 and self._head.exhausted:
+                    self._head.rewind()
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {"segments": len(self._numbers), "drops": dict(self.drops)}
+
+    def close(self):
+        with self._lock:
+            if self._tail is not None and self._tail is not self._head:
+                self._tail.close()
+            if self._head is not None:
+                self._head.close()
+            self._head = self._tail = None
+            self._closed = True
@@ -7,6 +7,11 @@ import typing
 from .configuration import Subordinate as SubordinateConf
 from .forwarder import Forwarder
 from .logger import LoggingMixin
+from .racer import ConnectionRace
+from .ranking import NetlocRanker, NetlocStat
+
+if typing.TYPE_CHECKING:
+    from .aio import AsyncForwarder
 
 
 class ForwarderSupervisor(LoggingMixin):
@@ -17,47 +22,40 @@ class ForwarderSupervisor(LoggingMixin):
 
     NEXT_IP_TIMEOUT = 30.0  # in seconds
     ZCONF_BUFFER_COUNT = 100
-
-    class NetlocStat:
-        """Netloc triage statistics used for sorting netloc in the list"""
-
-        def __init__(self, fail_count: int, when: float):
-            self.fail_count = fail_count
-            self.when = when
-
-        def __eq__(self, other):
-            return self.fail_count == other.fail_count and self.when == other.when
-
-        def __gt__(self, other):
-            return not (self.__eq__(other)) and not (self.__lt__(other))
-
-        def __lt__(self, other):
-            if self.fail_count == other.fail_count:
-                return self.when > other.when  # youngest first
-            else:
-                return self.fail_count < other.fail_count  # lowest count first
-
-        def __str__(self):
-            return f"{self.fail_count}-{self.when}"
+    RACE_COUNT = 5  # how many best ranked netlocs are raced when the subordinate is disconnected
 
     logger = logging.getLogger(__file__)
 
-    def __init__(self, forwarder: Forwarder):
+    def __init__(
+        self,
+        forwarder: typing.Union[Forwarder, "AsyncForwarder"],
+        wakeup: typing.Optional[typing.Callable[[], None]] = None,
+    ):
+        """
+        :param wakeup: called when the supervisor should be checked (e.g. the subordinate disconnected)
+        """
         self.subordinate_controller_id = forwarder.subordinate.controller_id
         self.forwarder = forwarder
+        self.wakeup = wakeup
+        self.forwarder.state_hook = wakeup
         self.lock = threading.RLock()
         self.connected = False
 
-        # (IP, port) -> (failed_attempt_count, time)
+        # (IP, port) -> statistics
         # initalizes with subordinate netloc
-        self._netlocs: typing.Dict[typing.Tuple[ipaddress.IPv4Address, int], ForwarderSupervisor.NetlocStat] = {
-            (
-                ipaddress.ip_address(self.forwarder.subordinate.settings.host),
-                self.forwarder.subordinate.settings.port,
-            ): ForwarderSupervisor.NetlocStat(0, 0.0)
-        }
-        self.current_netloc: typing.Tuple[ipaddress.IPv4Address, int] = self.netlocs[0]
+        self.ranker = NetlocRanker(time.monotonic)
+        self._netlocs: typing.Dict[typing.Tuple[ipaddress.IPv4Address, int], NetlocStat] = self.ranker.stats
+        self.current_netloc: typing.Tuple[ipaddress.IPv4Address, int] = (
+            ipaddress.ip_address(self.forwarder.subordinate.settings.host),
+            self.forwarder.subordinate.settings.port,
+        )
+        self.ranker.add(self.current_netloc, NetlocStat(0, 0.0))
         self.current_netloc_start: float = time.monotonic()
+        self.switches = 0  # how many times was the netloc changed
+        self.race: typing.Optional[ConnectionRace] = None
+        # netlocs whose failure was counted since current_netloc_start (by a race or by the timeout)
+        self._failed: typing.Set[typing.Tuple[ipaddress.IPv4Address, int]] = set()
+        self.races = 0
 
         # start forwarder in background
         self.forwarder.start()
@@ -66,6 +64,9 @@ class ForwarderSupervisor(LoggingMixin):
         """causes that forwarder eventually terminates"""
         self.debug("Supervisor terminating")
 
+        with self.lock:
+            if self.race:
+                self.race.cancel()
         self.forwarder.stop()
 
     def zconf_update(self, ips: typing.List[ipaddress.IPv4Address], port: int):
@@ -76,28 +77,30 @@ class ForwarderSupervisor(LoggingMixin):
 
         with self.lock:
             # merge two lists
+            added = False
             for ip in ips:
-                count = self._netlocs.get((ip, port), ForwarderSupervisor.NetlocStat(0, 0.0)).fail_count
-                self._netlocs[(ip, port)] = ForwarderSupervisor.NetlocStat(count, now)
+                record = self.ranker.get((ip, port))
+                if record:
+                    record.when = now
+                else:
+                    self.ranker.add((ip, port), NetlocStat(0, now))
+                    added = True
 
-            # sort and fit to buffer
-            sorted_netlocs = sorted(((ip, stat) for ip, stat in self._netlocs.items()), key=lambda x: x[1])[
-                : ForwarderSupervisor.ZCONF_BUFFER_COUNT
-            ]
-            res = {}
-            for (ip, port), stat in sorted_netlocs:
-                res[(ip, port)] = stat
+            # fit to buffer
+            self.ranker.trim(ForwarderSupervisor.ZCONF_BUFFER_COUNT)
 
-            self._netlocs = res
+            if added and not self.connected:
+                # e.g. at startup, don't wait for NEXT_IP_TIMEOUT to try the new netlocs
+                self.start_race()
 
     @property
     def netlocs(self) -> typing.List[typing.Tuple[ipaddress.IPv4Address, int]]:
         """Return current network locations where subordinate server might be running
 
-        Addresses with better score first (min fail_count + most reacent)
+        Addresses with better score first (min fail_count, lowest expected connect latency, most recent)
         """
         with self.lock:
-            return [e[0] for e in sorted([(k, v) for k, v in self._netlocs.items()], key=lambda x: x[1])]
+            return self.ranker.ranked()
 
     def subsubordinates_config_update(self, subordinates):
         # TODO
@@ -106,34 +109,157 @@ class ForwarderSupervisor(LoggingMixin):
     def subordinate_config_update(self, subordinate_conf: SubordinateConf):
         self.forwarder.reload_subordinate(subordinate_conf)
 
-    def check(self):
+    def check(self) -> typing.Optional[float]:
+        """Switches the netloc of the subordinate when it is disconnected for too long
+        :returns: when the supervisor should be checked again (None = when the connection state changes)
+        """
         now = time.monotonic()
 
         if self.forwarder.subordinate.connected:
             # clean attempts for current netloc to keep working address high in the list
             with self.lock:
-                self.current_netloc_start = now
                 record = self._netlocs.get(self.current_netloc)
                 if record:
+                    if not self.connected:
+                        record.observe(now, True)
                     record.fail_count = 0
-                    record.when = time.monotonic()
-            return
+                    record.when = now
+                self.connected = True
+                self.current_netloc_start = now
+                self._failed.clear()
+                if self.race:
+                    self.race.cancel()
+                    self.race = None
+            return None
 
         with self.lock:
-            if self.current_netloc_start + ForwarderSupervisor.NEXT_IP_TIMEOUT < now:
-                # time up, lets use new netloc
+            if self.race and self.race.done:
+                self.race_finished(self.race, now)
+                self.race = None
+
+            if self.connected:
+                # just disconnected, current netloc was working till now
+                self.connected = False
+                self.current_netloc_start = now
+                self._failed.clear()
                 record = self._netlocs.get(self.current_netloc)
                 if record:
-                    record.fail_count += 1
+                    record.when = now
+                self.start_race()
+
+            if self.current_netloc_start + ForwarderSupervisor.NEXT_IP_TIMEOUT < now:
+                # time up, lets use new netloc (unless a race has already counted the failure)
+                self.count_failure(self.current_netloc, now)
 
-                # Lets try new address
-                self.current_netloc = self.netlocs[0]
+                # Lets try new address (and look for a reachable one meanwhile)
+                self.switch_netloc(self.ranker.best())
+                self.start_race()
+
+            return self.current_netloc_start + ForwarderSupervisor.NEXT_IP_TIMEOUT
+
+    def start_race(self):
+        """Starts connecting to the best ranked netlocs concurrently (the winner is used by `check`)"""
+        with self.lock:
+            if self.race or len(self._netlocs) < 2:
+                return  # the client reconnects to a single netloc on its own
+            candidates = [
+                (netloc, self.forwarder.subordinate_conf.clone_with_overrides(*netloc).client_settings())
+                for netloc in self.ranker.top(ForwarderSupervisor.RACE_COUNT)
+            ]
+            self.race = ConnectionRace(
+                self.subordinate_controller_id, candidates, lambda race: self.wakeup and self.wakeup()
+            )
+            self.races += 1
+            self.race.start()
+
+    def race_finished(self, race: ConnectionRace, now: float):
+        """Updates netloc statistics according to the race and switches to the winner"""
+        with self.lock:
+            for attempt in race.losers():
+                record = self._netlocs.get(attempt.netloc)
+                if not record:
+                    continue
+                if attempt.cancelled_after is not None:
+                    # slower than the winner
+                    record.observe_slower(now, attempt.cancelled_after)
+                elif attempt.latency is not None:
+                    record.observe(now, True, attempt.latency)
+                elif attempt.error is not None:
+                    self.count_failure(attempt.netloc, now)
+
+            if not race.winner:
+                return
+            record = self._netlocs.get(race.winner.netloc)
+            if record:
+                record.fail_count = 0
+                record.when = now
+                record.observe(now, True, race.winner.latency)
+            if race.winner.netloc != self.current_netloc:
+                self.info(f"Switching to reachable netloc {race.winner.settings.host}:{race.winner.settings.port}")
+                self.switch_netloc(race.winner.netloc)
+            else:
                 self.current_netloc_start = now
+                self._failed.clear()
+
+    def count_failure(self, netloc: typing.Tuple[ipaddress.IPv4Address, int], now: float):
+        """Records a failed connection to the netloc (at most once per NEXT_IP_TIMEOUT period)"""
+        with self.lock:
+            record = self._netlocs.get(netloc)
+            if not record or netloc in self._failed:
+                return
+            self._failed.add(netloc)
+            record.fail_count += 1
+            record.observe(now, False)
+
+    def switch_netloc(self, netloc: typing.Optional[typing.Tuple[ipaddress.IPv4Address, int]] = None):
+        """Reconnects the subordinate to a netloc (the best one other than the current one by default)"""
+        with self.lock:
+            if netloc is None:
+                others = [e for e in self.ranker.top(2) if e != self.current_netloc]
+                netloc = others[0] if others else self.current_netloc
+            self.current_netloc = netloc
+            self.current_netloc_start = time.monotonic()
+            self._failed.clear()
+            self.switches += 1
+            self.reload()
+
+        if self.wakeup:
+            self.wakeup()  # deadline has changed
+
+    def reload(self):
+        """Reloads the subordinate with the current netloc"""
+        with self.lock:
+            ip, port = self.current_netloc
+            new_config = self.forwarder.subordinate_conf.clone_with_overrides(ip=ip, port=port)
+            self.forwarder.reload_subordinate(new_config)
 
-                # Reload subordinate with a new config
-                ip, port = self.current_netloc
-                new_config = self.forwarder.subordinate_conf.clone_with_overrides(ip=ip, port=port)
-                self.forwarder.reload_subordinate(new_config)
+    def status(self) -> typing.Dict[str, typing.Any]:
+        """Returns state of the forwarder (it can be serialized to json)"""
+        with self.lock:
+            netlocs = []
+            for ip, port in self.ranker.ranked():
+                stat = self._netlocs[ip, port]
+                netlocs.append(
+                    {
+                        "netloc": f"{ip}:{port}",
+                        "fail_count": stat.fail_count,
+                        "when": stat.when,
+                        "latency": stat.latency,
+                        "success": stat.success,
+                    }
+                )
+            current = f"{self.current_netloc[0]}:{self.current_netloc[1]}"
+        return {
+            "forwarder": str(self.forwarder),
+            "host_connected": self.forwarder.host.connected,
+            "subordinate_connected": self.forwarder.subordinate.connected,
+            "current_netloc": current,
+            "netlocs": netlocs,
+            "switches": self.switches,
+            "races": self.races,
+            "queues": self.forwarder.queue_stats(),
+            "retries": self.forwarder.retry_stats(),
+        }
 
     def __str__(self):
         return f"supervisor-{self.forwarder.subordinate.controller_id}"
@@ -0,0 +1,143 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+import logging
+import threading
+import typing
+
+from .logger import LoggingMixin
+
+MAX_TOPICS = 1024  # idle topics are forgotten when there are more topics
+
+
+class Mergeable(typing.Protocol):
+    def merge(self, other: typing.Any):
+        """Takes the value of a newer item"""
+
+
+def merge_items(held: Mergeable, item: Mergeable) -> bool:
+    held.merge(item)
+    return True
+
+
+class TopicState:
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.held: typing.Optional[Mergeable] = None
+        self.held_until = 0.0
+
+
+class NotificationThrottle(LoggingMixin):
+    """Per topic rate limit (token bucket) of notifications
+
+    Without a coalescing window notifications over the limit are dropped.
+    With the window the first notification of a topic is held back for the window
+    (or till the limit allows it to pass) and the following notifications of the topic
+    are merged to it (the latest value wins).
+    """
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, name: str, rate: float, burst: int, window: float):
+        """
+        :param rate: notifications per second per topic (0 = unlimited)
+        :param burst: how many notifications can pass at once
+        :param window: coalescing window (0 = drop notifications over the limit)
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.window = window
+        self.passed = 0
+        self.held = 0
+        self.merged = 0
+        self.dropped = 0
+
+        self._topics: typing.Dict[str, TopicState] = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"throttle-{self.name}"
+
+    def _tokens(self, state: TopicState, at: float) -> float:
+        if not self.rate:
+            return self.burst
+        return min(self.burst, state.tokens + (at - state.updated) * self.rate)
+
+    def offer(
+        self,
+        topic: str,
+        item: Mergeable,
+        now: float,
+        merge: typing.Callable[[Mergeable, Mergeable], bool] = merge_items,
+    ) -> typing.Optional[float]:
+        """Decides what to do with a notification
+        :param merge: merges the item to the held one (returns False when the held one is not waiting anymore)
+        :returns: None when the item was merged or dropped, otherwise delay before it can be sent
+        """
+        with self._lock:
+            state = self._topics.get(topic)
+            if state is None:
+                if len(self._topics) >= MAX_TOPICS:
+                    self._prune(now)
+                state = self._topics[topic] = TopicState(self.burst, now)
+
+            if state.held is not None and now < state.held_until:
+                if merge(state.held, item):
+                    self.merged += 1
+                    return None
+                state.held = None  # already sent or removed from the queue
+
+            tokens = self._tokens(state, now)
+            if tokens >= 1 and not self.window:
+                state.tokens, state.updated = tokens - 1, now
+                self.passed += 1
+                return 0.0
+
+            if not self.window:
+                self.dropped += 1
+                return None
+
+            # held till the end of the window and till a token is available
+            due = now + self.window
+            if tokens < 1:
+                due = max(due, now + (1 - tokens) / self.rate)
+            state.tokens, state.updated = self._tokens(state, due) - 1, due
+            state.held, state.held_until = item, due
+            self.held += 1
+            return due - now
+
+    def _prune(self, now: float):
+        idle = [
+            topic
+            for topic, state in self._topics.items()
+            if state.held_until <= now and self._tokens(state, now) >= self.burst
+        ]
+        for topic in idle:
+            del self._topics[topic]
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self._lock:
+            return {
+                "topics": len(self._topics),
+                "passed": self.passed,
+                "held": self.held,
+                "merged": self.merged,
+                "dropped": self.dropped,
+            }
@@ -0,0 +1,133 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import json
+import typing
+
+REQUEST = "request"
+REPLY = "reply"
+NOTIFICATION = "notification"
+LIST = "list"  # list and schema requests
+UNKNOWN = "unknown"
+
+WILDCARD = "+"  # matches any controller id
+
+# 3rd level of the topic -> message class
+KINDS = {REQUEST: REQUEST, REPLY: REPLY, NOTIFICATION: NOTIFICATION, "list": LIST, "schema": LIST}
+
+
+def message_class(topic: str) -> str:
+    """Determines the kind of a foris-controller message from its topic
+
+    foris-controller/<id>/request/<module>/action/<action> -> REQUEST
+    foris-controller/<id>/request/<module>/list -> LIST
+    foris-controller/<id>/list -> LIST
+    foris-controller/<id>/schema -> LIST
+    foris-controller/<id>/reply/<reply_id> -> REPLY
+    foris-controller/<id>/notification/<module>/action/<action> -> NOTIFICATION
+
+    It is called for each message so only a single lookup of the 3rd level is performed.
+    """
+    parts = topic.split("/", 3)
+    if len(parts) < 3:
+        return UNKNOWN
+
+    kind = KINDS.get(parts[2], UNKNOWN)
+    if kind == REQUEST:
+        return LIST if topic.endswith("/list") else REQUEST
+    if kind == LIST and len(parts) > 3:
+        return UNKNOWN  # list and schema are the last level
+    return kind
+
+
+def controller_id(topic: str) -> typing.Optional[str]:
+    """Extracts controller id from foris-controller/<id>/..."""
+    parts = topic.split("/", 2)
+    return parts[1] if len(parts) > 2 else None
+
+
+def is_routed(topic: str, controller_ids: typing.AbstractSet[str]) -> bool:
+    """Whether the message belongs to one of the controllers (used to filter wildcard subscriptions)"""
+    return controller_id(topic) in controller_ids
+
+
+class Reply(typing.NamedTuple):
+    topic: str
+    payload: bytes
+
+
+def parse_request(payload: bytes) -> typing.Optional[typing.Tuple[str, dict]]:
+    """Splits request payload to reply id and the rest of the data"""
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("reply_msg_id"), str):
+        return None
+    reply_id = data.pop("reply_msg_id")
+    return reply_id, data
+
+
+def module_action(topic: str) -> typing.Optional[typing.Tuple[str, str]]:
+    """Extracts module and action from a request topic
+
+    foris-controller/<id>/request/<module>/action/<action> -> (module, action)
+    foris-controller/<id>/request/<module>/list -> (module, "list")
+    """
+    parts = topic.split("/")
+    if len(parts) == 6 and parts[2] == REQUEST and parts[4] == "action":
+        return parts[3], parts[5]
+    if len(parts) == 5 and parts[2] == REQUEST and parts[4] == "list":
+        return parts[3], "list"
+    return None
+
+
+def error_reply(request_topic: str, payload: bytes, description: str) -> typing.Optional[Reply]:
+    """Creates an error reply to a request (None if the request can't be replied)"""
+    parsed = parse_request(payload)
+    names = module_action(request_topic)
+    if not parsed or not names:
+        return None
+    module, action = names
+    data = {"errors": [{"description": description, "stacktrace": ""}]}
+    reply = {"module": module, "action": action, "kind": "reply", "data": data}
+    return Reply(reply_topic(request_topic, parsed[0]), json.dumps(reply).encode())
+
+
+def reply_topic(request_topic: str, reply_id: str) -> str:
+    """Topic where the reply to the request is expected"""
+    return f"foris-controller/{controller_id(request_topic)}/reply/{reply_id}"
+
+
+def host_topics(controller_id: str) -> typing.List[typing.Tuple[str, int]]:
+    """Topics which are forwarded from the host to the subordinate"""
+    return [
+        (f"foris-controller/{controller_id}/request/+/action/+", 0),
+        (f"foris-controller/{controller_id}/request/+/list", 0),
+        (f"foris-controller/{controller_id}/list", 0),
+        (f"foris-controller/{controller_id}/schema", 0),
+    ]
+
+
+def subordinate_topics(controller_id: str) -> typing.List[typing.Tuple[str, int]]:
+    """Topics which are forwarded from the subordinate to the host"""
+    return [
+        (f"foris-controller/{controller_id}/notification/+/action/+", 0),
+        (f"foris-controller/{controller_id}/reply/+", 0),
+    ]
@@ -0,0 +1,221 @@
+#
+# foris-forwarder
+# Copyright (C) 2020 CZ.NIC, z.s.p.o. (http://www.nic.cz/)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+#
+
+import collections
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+import typing
+
+from .itemqueue import ItemQueue
+from .logger import LoggingMixin
+
+IDLE = "idle"
+READY = "ready"
+RUNNING = "running"
+WAITING = "waiting"
+DONE = "done"
+
+
+class Wait:
+    """Returned by a handler instead of blocking the worker
+
+    Items of the queue are not processed till the wait is finished
+    (or till it times out), then `resume` is called by a worker.
+    """
+
+    def __init__(self, timeout: float, resume: typing.Callable[[bool], typing.Any]):
+        """
+        :param timeout: how long to wait for `finish`
+        :param resume: called with False on timeout, returns the same as a handler
+        """
+        self.deadline = time.monotonic() + timeout
+        self.resume = resume
+        self.finished: typing.Optional[bool] = None
+        self._lock = threading.Lock()
+        self._wakeup: typing.Optional[typing.Callable[[], None]] = None
+
+    def finish(self):
+        """Can be called from any thread (e.g. from a paho callback)"""
+        self._set(True)
+
+    def _set(self, finished: bool):
+        with self._lock:
+            if self.finished is not None:
+                return
+            self.finished = finished
+            wakeup = self._wakeup
+        if wakeup:
+            wakeup()
+
+    def _attach(self, wakeup: typing.Callable[[], None]) -> bool:
+        """:returns: True when the wait is already finished"""
+        with self._lock:
+            self._wakeup = wakeup
+            return self.finished is not None
+
+
+class QueueJob:
+    """Queue served by QueueWorkers (at most one worker processes its items at a time)"""
+
+    def __init__(self, item_queue: ItemQueue, handler: typing.Callable[[typing.Any], typing.Any]):
+        self.item_queue = item_queue
+        self.handler = handler
+        self.state = IDLE
+        self.dirty = False  # an item may have been put while the job was running
+        self.wait: typing.Optional[Wait] = None
+
+
+class QueueWorkers(LoggingMixin):
+    """Processes items of many queues using a fixed number of threads
+
+    A queue is picked up when an item is put to it or when its first delayed
+    item is due. Queues take turns after every item and a single queue is never
+    processed by two workers at once, so the order of its items is kept.
+
+    Handlers must not block for long (the workers are shared), a handler
+    which needs to wait for a reply returns `Wait` instead.
+    """
+
+    WORKERS = 4
+
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, workers: int = WORKERS):
+        self._condition = threading.Condition()
+        self._ready: typing.Deque[QueueJob] = collections.deque()
+        self._timers: typing.List[typing.Tuple[float, int, QueueJob]] = []  # heap of (due, seq, job)
+        self._seq = itertools.count()
+        self._running = False
+        self.threads = [
+            threading.Thread(name=f"queue-worker-{number}", target=self.run, daemon=True) for number in range(workers)
+        ]
+
+    def __str__(self):
+        return "queue-workers"
+
+    def start(self):
+        self.debug(f"Starting {len(self.threads)} workers")
+        self._running = True
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.debug("Stopping")
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+    def add(self, item_queue: ItemQueue, handler: typing.Callable[[typing.Any], typing.Any]):
+        """Starts to process items of the queue
+        :param handler: processes a single item, returns False when the queue should not be processed anymore
+                        or Wait when the queue should be paused
+        """
+        job = QueueJob(item_queue, handler)
+        item_queue.set_ready_hook(lambda: self._wakeup(job))
+        self._wakeup(job)
+
+    def _wakeup(self, job: QueueJob):
+        # called with the mutex of the queue held, so the queue must not be touched here
+        with self._condition:
+            self._schedule(job)
+
+    def _schedule(self, job: QueueJob):
+        if job.state == IDLE or (job.state == WAITING and job.wait and job.wait.finished is not None):
+            job.state = READY
+            self._ready.append(job)
+            self._condition.notify()
+        elif job.state == RUNNING:
+            job.dirty = True
+
+    def _timer(self, due: float, job: QueueJob):
+        heapq.heappush(self._timers, (due, next(self._seq), job))
+        self._condition.notify()
+
+    def _next_job(self) -> typing.Optional[QueueJob]:
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, job = heapq.heappop(self._timers)
+                    if job.state == WAITING and job.wait and job.wait.deadline <= now:
+                        job.wait._set(False)  # timed out (the condition is reentrant)
+                    self._schedule(job)
+                if self._ready:
+                    job = self._ready.popleft()
+                    job.state = RUNNING
+                    job.dirty = False
+                    return job
+                self._condition.wait(self._timers[0][0] - now if self._timers else None)
+            return None
+
+    def _finished(self, job: QueueJob, result: typing.Any):
+        """Plans the next turn of the job according to the result of the handler"""
+        with self._condition:
+            if result is False:
+                job.state = DONE
+            elif isinstance(result, Wait):
+                job.state = WAITING
+                job.wait = result
+                if result._attach(lambda: self._wakeup(job)):
+                    self._schedule(job)
+                else:
+                    self._timer(result.deadline, job)
+            else:
+                # other queues take turns
+                job.state = IDLE
+                self._schedule(job)
+
+    def run(self):
+        self.debug("Worker started")
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            if job.wait is not None:
+                wait, job.wait = job.wait, None
+                self._finished(job, self._call(wait.resume, wait.finished))
+                continue
+
+            try:
+                item = job.item_queue.get(False)
+            except queue.Empty:
+                # queue lock can't be taken while holding the condition (see _wakeup)
+                due = job.item_queue.next_due()
+                with self._condition:
+                    job.state = IDLE
+                    if job.dirty:
+                        self._schedule(job)
+                    elif due is not None:
+                        self._timer(due, job)
+                continue
+
+            job.item_queue.task_done()
+            self._finished(job, self._call(job.handler, item))
+
+    def _call(self, function: typing.Callable[[typing.Any], typing.Any], arg: typing.Any) -> typing.Any:
+        try:
+            return function(arg)
+        except Exception as exc:
+            self.error(f"Failed to process {arg.__class__.__name__}: {exc}")
+            return True
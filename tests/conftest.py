@@ -7,8 +7,9 @@ import subprocess
 
 import pytest
 
-from foris_forwarder.configuration import Host, Subordinate, Subsubordinate
+from foris_forwarder.configuration import ForwarderOptions, Host, Subordinate, Subsubordinate
 from foris_forwarder.forwarder import Forwarder
+from foris_forwarder.multiplexer import HostMultiplexer
 
 BASE_DIR = pathlib.Path(__file__).parent
 CA_PATH = pathlib.Path("/tmp/mosquitto-ca")
@@ -279,6 +280,35 @@ def connected_forwarder(forwarder):
     forwarder.wait_for_disconnected()
 
 
+@pytest.fixture(scope="function")
+def shared_forwarder(token_dir, mosquitto_host, mosquitto_subordinate):
+    _, username, password, host_port, _, _, _, _ = mosquitto_host
+    host_conf = Host("000000050000005A", host_port, username, password)
+
+    _, subordinate_port, token_key_path, token_crt_path, ca_path = mosquitto_subordinate
+    subordinate_conf = Subordinate(
+        "000000050000006B",
+        ipaddress.ip_address("127.0.0.1"),
+        subordinate_port,
+        True,
+        token_dir,
+    )
+
+    options = ForwarderOptions(shared_host=True)
+    multiplexer = HostMultiplexer(host_conf, options)
+    multiplexer.start()
+
+    forwarder = Forwarder(host_conf, subordinate_conf, options=options, multiplexer=multiplexer)
+    forwarder.start()
+    forwarder.wait_for_ready()
+
+    yield forwarder
+
+    forwarder.stop()
+    forwarder.wait_for_disconnected()
+    multiplexer.stop()
+
+
 @pytest.fixture(scope="function")
 def super_forwarder(token_dir, mosquitto_host, mosquitto_super):
     _, username, password, host_port = mosquitto_super
@@ -0,0 +1,181 @@
+import asyncio
+import collections
+import ipaddress
+import pathlib
+import time
+
+from paho.mqtt.client import MQTTMessage
+
+from foris_forwarder.aio import AsyncClient, AsyncForwarder
+from foris_forwarder.configuration import ForwarderOptions, Host, Subordinate
+from foris_forwarder.itemqueue import ItemQueue
+from foris_forwarder.items import Publish
+
+TIMEOUT = 30.0
+FOSQUITTO_DIR = pathlib.Path(__file__).parent / "fosquitto"
+
+
+def test_messaging(mosquitto_host, mosquitto_subordinate, prepare_ca, connection_settings):
+    process, settings1, settings2 = connection_settings
+
+    async def messaging():
+        client_listener = AsyncClient(settings1)
+        client_publisher = AsyncClient(settings2)
+
+        received = asyncio.Event()
+
+        def message(client, userdata, message):
+            received.set()
+
+        client_listener.set_message_hook(message)
+
+        assert await client_listener.connect(TIMEOUT)
+        assert await client_publisher.connect(TIMEOUT)
+
+        assert await client_listener.subscribe([("/messaging-test/+", 0)], TIMEOUT) == (0,)
+        assert await client_publisher.publish("/messaging-test/first", '{"some": "data"}', TIMEOUT) is True
+        await asyncio.wait_for(received.wait(), TIMEOUT)
+
+        assert await client_listener.unsubscribe(["/messaging-test/+"], TIMEOUT)
+
+        await client_publisher.disconnect(TIMEOUT)
+        await client_listener.disconnect(TIMEOUT)
+        assert not client_publisher.connected
+        assert await client_publisher.publish("/messaging-test/first", '{"some": "data"}', TIMEOUT) is False
+
+    asyncio.run(messaging())
+
+    process.kill()
+    process.wait()
+
+
+def test_forwarder(host_settings, subordinate_settings, forwarder):
+    """Notifications should be passed from the subordinate to the host"""
+    _, host_settings, _ = host_settings
+    host_settings.controller_id = "1111111111111111"
+    _, subordinate_settings, _ = subordinate_settings
+    subordinate_settings.controller_id = "2222222222222222"
+    topic = f"foris-controller/{forwarder.subordinate_conf.controller_id}/notification/mod/action/act"
+
+    async def forward():
+        async_forwarder = AsyncForwarder(forwarder.host_conf, forwarder.subordinate_conf)
+        async_forwarder.start()
+        assert await async_forwarder.wait_for_ready(TIMEOUT)
+
+        host_client = AsyncClient(host_settings)
+        subordinate_client = AsyncClient(subordinate_settings)
+        messages = asyncio.Queue()
+        host_client.set_message_hook(lambda client, userdata, message: messages.put_nowait(message))
+
+        assert await host_client.connect(TIMEOUT)
+        assert await subordinate_client.connect(TIMEOUT)
+        assert await host_client.subscribe([(topic, 0)], TIMEOUT)
+
+        assert await subordinate_client.publish(topic, b'{"some": "notification"}', TIMEOUT)
+        message = await asyncio.wait_for(messages.get(), TIMEOUT)
+        assert message.topic == topic
+        assert message.payload == b'{"some": "notification"}'
+
+        await host_client.disconnect(TIMEOUT)
+        await subordinate_client.disconnect(TIMEOUT)
+        async_forwarder.stop()
+        assert await async_forwarder.wait_for_disconnected(TIMEOUT)
+
+    asyncio.run(forward())
+
+
+def test_fast_fail():
+    """Requests to a disconnected subordinate are answered with an error at once"""
+
+    async def fast_fail():
+        async_forwarder = AsyncForwarder(
+            Host("000000050000005A", 11883, "username", "password"),
+            Subordinate("0000000A00000214", ipaddress.ip_address("127.0.0.1"), 11884, True, FOSQUITTO_DIR, True),
+        )
+        message = MQTTMessage(topic=b"foris-controller/0000000A00000214/request/about/action/get")
+        message.payload = b'{"reply_msg_id": "abc"}'
+        async_forwarder.host_to_subordinate(None, None, message)
+
+        assert async_forwarder.subordinate_queue.empty()
+        reply = async_forwarder.host_queue.get(False)
+        assert reply.message.topic == "foris-controller/0000000A00000214/reply/abc"
+        assert async_forwarder.queue_stats()["fast_failed"] == {"requests": 1}
+
+    asyncio.run(fast_fail())
+
+
+def test_spool(tmp_path):
+    """Messages for a disconnected subordinate are stored in the spool"""
+
+    async def spool():
+        async_forwarder = AsyncForwarder(
+            Host("000000050000005A", 11883, "username", "password"),
+            Subordinate("0000000A00000214", ipaddress.ip_address("127.0.0.1"), 11884, True, FOSQUITTO_DIR),
+            options=ForwarderOptions(spool_dir=tmp_path),
+        )
+        message = MQTTMessage(topic=b"foris-controller/0000000A00000214/request/about/action/get")
+        message.payload = b'{"reply_msg_id": "abc"}'
+        async_forwarder.host_to_subordinate(None, None, message)
+
+        assert async_forwarder.subordinate_queue.empty()
+        assert not async_forwarder.spool.empty
+        record = async_forwarder.spool.read(1)[0]
+        assert (record.topic, record.payload) == (message.topic, message.payload)
+        assert "spool" in async_forwarder.queue_stats()
+        async_forwarder.stop()
+
+    asyncio.run(spool())
+
+
+class CountingQueue(ItemQueue):
+    gets = 0
+
+    def get(self, *args, **kwargs):
+        self.gets += 1
+        return super().get(*args, **kwargs)
+
+
+class PublishingClient:
+    connected = True
+
+    def __init__(self):
+        self.published = asyncio.Event()
+        self.published_at = None
+
+    async def publish(self, topic, payload, timeout=None):
+        self.published_at = time.monotonic()
+        self.published.set()
+        return True
+
+
+def test_pump_delayed():
+    """The pump sleeps till the delayed item is due instead of polling the queue"""
+
+    async def pump():
+        async_forwarder = AsyncForwarder(
+            Host("000000050000005A", 11883, "username", "password"),
+            Subordinate("0000000A00000214", ipaddress.ip_address("127.0.0.1"), 11884, True, FOSQUITTO_DIR),
+        )
+        item_queue = CountingQueue()
+        wakeup = asyncio.Event()
+        client = PublishingClient()
+        message = MQTTMessage(topic=b"foris-controller/0000000A00000214/notification/mod/action/act")
+        message.payload = b"{}"
+        start = time.monotonic()
+        item_queue.put_later(Publish(message), 1.0)
+
+        task = asyncio.ensure_future(
+            async_forwarder.pump(
+                item_queue, wakeup, lambda: client, collections.Counter(), async_forwarder.host_metrics
+            )
+        )
+        await asyncio.wait_for(client.published.wait(), 5.0)
+        assert client.published_at - start >= 1.0
+
+        item_queue.put(False)
+        wakeup.set()
+        await asyncio.wait_for(task, 5.0)
+        # empty, the item, empty and the terminating item (+1 when the timer fires a bit sooner)
+        assert item_queue.gets <= 5
+
+    asyncio.run(pump())
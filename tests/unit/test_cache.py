@@ -0,0 +1,59 @@
+import time
+
+from foris_forwarder.cache import ReplyCache
+
+SCHEMA = "foris-controller/0000000A00000214/schema"
+LIST = "foris-controller/0000000A00000214/request/wifi/list"
+
+
+def request(cache: ReplyCache, topic: str, reply_id: str, generation: int = 0):
+    return cache.request(topic, b'{"reply_msg_id": "%s"}' % reply_id.encode(), generation)
+
+
+def test_cached():
+    cache = ReplyCache("test", 10, 0.0)
+    assert request(cache, SCHEMA, "1") is None
+    cache.reply("foris-controller/0000000A00000214/reply/1", b'{"schema": 1}')
+
+    reply = request(cache, SCHEMA, "2")
+    assert reply.topic == "foris-controller/0000000A00000214/reply/2"
+    assert reply.payload == b'{"schema": 1}'
+
+    # different topic is not cached
+    assert request(cache, LIST, "3") is None
+    # unknown replies are ignored
+    cache.reply("foris-controller/0000000A00000214/reply/4", b"{}")
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 2}
+
+    # not parsable requests are not cached
+    assert cache.request(SCHEMA, b"garbage", 0) is None
+
+
+def test_invalidation():
+    cache = ReplyCache("test", 10, 0.0)
+    request(cache, SCHEMA, "1")
+    cache.reply("foris-controller/0000000A00000214/reply/1", b"{}")
+    assert request(cache, SCHEMA, "2")
+
+    # reconnected
+    assert request(cache, SCHEMA, "3", generation=1) is None
+    cache.reply("foris-controller/0000000A00000214/reply/3", b"{}")
+    assert request(cache, SCHEMA, "4", generation=1)
+
+    cache.notification("foris-controller/0000000A00000214/notification/wifi/action/update_settings")
+    assert request(cache, SCHEMA, "5", generation=1)
+    cache.notification("foris-controller/0000000A00000214/notification/updater/action/run")
+    assert request(cache, SCHEMA, "6", generation=1) is None
+
+
+def test_bounds():
+    cache = ReplyCache("test", 2, 0.05)
+    for i in range(3):
+        request(cache, f"foris-controller/0000000A0000021{i}/schema", str(i))
+        cache.reply(f"foris-controller/0000000A0000021{i}/reply/{i}", b"{}")
+    assert cache.stats()["entries"] == 2
+    assert request(cache, "foris-controller/0000000A00000210/schema", "a") is None  # the oldest was dropped
+    assert request(cache, "foris-controller/0000000A00000212/schema", "b")
+
+    time.sleep(0.1)
+    assert request(cache, "foris-controller/0000000A00000212/schema", "c") is None  # too old
@@ -1,6 +1,7 @@
 import threading
 
-from foris_forwarder.client import Client
+from foris_forwarder.client import SUBSCRIBE_FAILURE, Client, Settings, SubscriptionRegistry
+from foris_forwarder.reactor import Reactor
 
 TIMEOUT = 30.0
 
@@ -131,3 +132,79 @@ def test_messaging(mosquitto_host, mosquitto_subordinate, prepare_ca, connection
 
     process.kill()
     process.wait()
+
+
+def test_reactor(mosquitto_host, mosquitto_subordinate, prepare_ca, connection_settings, wait_for_disconnected):
+    process, settings1, settings2 = connection_settings
+
+    reactor = Reactor()
+    reactor.start()
+    threads_count = threading.active_count()
+
+    client_listener = Client(settings1, reactor=reactor)
+    client_publisher = Client(settings2, reactor=reactor)
+
+    message_event = threading.Event()
+
+    def message(client, userdata, message):
+        message_event.set()
+
+    client_listener.set_message_hook(message)
+
+    client_listener.connect()
+    client_listener.wait_until_connected(TIMEOUT)
+    client_publisher.connect()
+    client_publisher.wait_until_connected(TIMEOUT)
+    assert client_listener.connected and client_publisher.connected
+
+    subscribe_event = threading.Event()
+    assert client_listener.subscribe([("/reactor-test/+", 0)], lambda mid, granted_qos: subscribe_event.set())
+    assert subscribe_event.wait(TIMEOUT)
+
+    publish_event = threading.Event()
+    assert client_publisher.publish("/reactor-test/first", '{"some": "data"}', lambda mid: publish_event.set())
+    assert publish_event.wait(TIMEOUT)
+    assert message_event.wait(TIMEOUT)
+
+    # no network thread per client (only the connect pool may be started)
+    assert threading.active_count() <= threads_count + Reactor.CONNECT_WORKERS
+
+    wait_for_disconnected(client_publisher)
+    wait_for_disconnected(client_listener)
+
+    reactor.stop()
+    process.kill()
+    process.wait()
+
+
+def test_subscription_registry():
+    registry = SubscriptionRegistry()
+    registry.add([("a/+", 0), ("b/+", 0), ("c/+", 0)])
+    registry.confirm([("a/+", 0), ("b/+", 0)], [0, SUBSCRIBE_FAILURE])
+    registry.remove(["c/+"])
+
+    assert registry.topics == [("a/+", 0)]
+    assert registry.missing([("a/+", 0), ("b/+", 0), ("a/+", 1)]) == [("b/+", 0), ("a/+", 1)]
+
+    # registered once granted
+    registry.confirm([("d/+", 1)], [1])
+    assert registry.topics == [("a/+", 0), ("d/+", 1)]
+
+
+def test_reconcile_subscriptions():
+    settings = Settings()
+    settings.controller_id = "0000000A00000214"
+    client = Client(settings)
+    client.subscriptions.confirm([("a/+", 0), ("b/+", 0)], [0, 0])
+    lost = []
+    client.set_resubscribe_hook(lost.append)
+
+    client.session_present = True
+    client.reconcile_subscriptions()
+    assert lost == []
+
+    # the topics are subscribed again via the hook, they are not registered till granted
+    client.session_present = False
+    client.reconcile_subscriptions()
+    assert lost == [[("a/+", 0), ("b/+", 0)]]
+    assert client.subscriptions.missing([("a/+", 0)]) == [("a/+", 0)]
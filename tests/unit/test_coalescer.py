@@ -0,0 +1,53 @@
+import time
+
+from foris_forwarder import coalescer
+from foris_forwarder.coalescer import RequestCoalescer
+
+GET = "foris-controller/0000000A00000214/request/wifi/action/get_settings"
+UPDATE = "foris-controller/0000000A00000214/request/wifi/action/update_settings"
+REPLY = "foris-controller/0000000A00000214/reply/"
+
+
+def request(requests: RequestCoalescer, topic: str, reply_id: str, data: str = "{}"):
+    return requests.request(topic, b'{"reply_msg_id": "%s", "data": %s}' % (reply_id.encode(), data.encode()))
+
+
+def test_coalesced():
+    requests = RequestCoalescer("test", ["wifi/get_*", "about/get"], 10.0)
+    assert request(requests, GET, "1") is False
+    assert request(requests, GET, "2") is True
+    assert request(requests, GET, "3") is True
+    # different data
+    assert request(requests, GET, "4", '{"a": 1}') is False
+    # not on the allowlist
+    assert request(requests, UPDATE, "5") is False
+    assert request(requests, UPDATE, "6") is False
+
+    assert requests.reply(REPLY + "1", b"{}") == [(REPLY + "2", b"{}"), (REPLY + "3", b"{}")]
+    assert requests.reply(REPLY + "4", b"{}") == []
+    assert requests.reply(REPLY + "6", b"{}") == []
+    assert requests.stats() == {"pending": 0, "forwarded": 2, "coalesced": 2}
+
+    # answered => forwarded again
+    assert request(requests, GET, "7") is False
+
+
+def test_window():
+    requests = RequestCoalescer("test", ["wifi/get_settings"], 0.05)
+    assert request(requests, GET, "1") is False
+    time.sleep(0.06)
+    assert request(requests, GET, "2") is False
+    assert request(requests, GET, "3") is True
+
+    # both forwarded requests are answered
+    assert requests.reply(REPLY + "1", b"{}") == []
+    assert requests.reply(REPLY + "2", b"{}") == [(REPLY + "3", b"{}")]
+
+
+def test_unanswered(monkeypatch):
+    monkeypatch.setattr(coalescer, "PENDING_MAX_ENTRIES", 2)
+    requests = RequestCoalescer("test", ["wifi/*"], 10.0)
+    for reply_id in "123":
+        assert request(requests, GET, reply_id, f'{{"n": {reply_id}}}') is False
+    assert requests.stats()["pending"] == 2
+    assert request(requests, GET, "4", '{"n": 1}') is False, "the oldest one was forgotten"
@@ -26,10 +26,12 @@ def test_uci():
     assert subordinate.enabled is True
     assert subordinate.controller_id == controller_id == "0000000A00000214"
     assert subordinate.address == "192.168.15.158:11884"
+    assert subordinate.fast_fail is True
     controller_id, subordinate = subordinates[1]
     assert subordinate.enabled is True
     assert subordinate.controller_id == controller_id == "0000000D30000010"
     assert subordinate.address == "192.0.0.8:11881", "Dummy ipv4 address"
+    assert subordinate.fast_fail is False
 
     assert len(conf.subsubordinates) == 1
     controller_id, subsubordinate = list(conf.subsubordinates.items())[0]
@@ -0,0 +1,107 @@
+import ipaddress
+import json
+import os
+import socket
+import stat
+
+import pytest
+
+from foris_forwarder.control import ControlServer
+
+CONTROLLER_ID = "0000000A00000214"
+
+
+class Supervisor:
+    subordinate_controller_id = CONTROLLER_ID
+
+    def __init__(self):
+        self.calls = []
+
+    def switch_netloc(self, netloc=None):
+        self.calls.append(("switch_netloc", netloc))
+
+    def reload(self):
+        self.calls.append(("reload",))
+
+    def status(self):
+        return {"calls": len(self.calls)}
+
+
+class App:
+    def __init__(self):
+        self.status = {"updated": 1.0, "forwarders": {CONTROLLER_ID: {"subordinate_connected": True}}}
+        self.supervisors = {CONTROLLER_ID: Supervisor()}
+
+    def current_status(self):
+        return self.status
+
+    def supervisor(self, controller_id):
+        return self.supervisors.get(controller_id)
+
+    def call(self, function, *args):
+        return function(*args)
+
+
+@pytest.fixture
+def control(tmp_path):
+    app = App()
+    path = str(tmp_path / "control.sock")
+    server = ControlServer(path, app)
+    server.start()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    stream = sock.makefile("rwb")
+
+    def command(request):
+        stream.write(request if isinstance(request, bytes) else json.dumps(request).encode() + b"\n")
+        stream.flush()
+        return json.loads(stream.readline())
+
+    yield app, command
+    sock.close()
+    server.stop()
+
+
+def test_status(control):
+    app, command = control
+    assert command({"command": "status"}) == {"ok": True, "result": app.status}
+
+
+def test_operations(control):
+    app, command = control
+    supervisor = app.supervisors[CONTROLLER_ID]
+
+    assert command({"command": "switch_netloc", "controller_id": CONTROLLER_ID}) == {
+        "ok": True,
+        "result": {"calls": 1},
+    }
+    response = command({"command": "switch_netloc", "controller_id": CONTROLLER_ID, "netloc": "10.0.0.1:11884"})
+    assert response["ok"]
+    assert command({"command": "reload", "controller_id": CONTROLLER_ID})["ok"]
+    assert supervisor.calls == [
+        ("switch_netloc", None),
+        ("switch_netloc", (ipaddress.ip_address("10.0.0.1"), 11884)),
+        ("reload",),
+    ]
+
+
+def test_errors(control):
+    app, command = control
+    assert command(b"garbage\n")["ok"] is False
+    assert command({"command": "reload", "controller_id": "unknown"})["ok"] is False
+    assert command({"command": "unknown", "controller_id": CONTROLLER_ID})["ok"] is False
+    assert command({"command": "switch_netloc", "controller_id": CONTROLLER_ID, "netloc": "x"})["ok"] is False
+    # connection is still usable
+    assert command({"command": "status"})["ok"]
+
+
+def test_socket_mode(tmp_path):
+    path = str(tmp_path / "control.sock")
+    umask = os.umask(0)
+    try:
+        server = ControlServer(path, App())
+    finally:
+        os.umask(umask)
+    server.start()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    server.stop()
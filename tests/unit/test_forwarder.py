@@ -1,9 +1,19 @@
+import collections
+import ipaddress
+import pathlib
 import threading
+import time
 import uuid
 
+from paho.mqtt.client import MQTTMessage
+
 from foris_forwarder.client import Client
+from foris_forwarder.configuration import ForwarderOptions, Host, Subordinate
+from foris_forwarder.forwarder import Forwarder
+from foris_forwarder.items import Publish
 
 TIMEOUT = 30.0
+FOSQUITTO_DIR = pathlib.Path(__file__).parent / "fosquitto"
 
 
 def wait_for_connected(client: Client):
@@ -172,3 +182,200 @@ def test_reply(host_settings, subordinate_settings, connected_forwarder, wait_fo
 
     wait_for_disconnected(host_client)
     wait_for_disconnected(subordinate_client)
+
+
+def test_shared_host(host_settings, subordinate_settings, shared_forwarder, wait_for_disconnected):
+    """Requests should be routed via shared host connection"""
+    _, host_settings, _ = host_settings
+    host_settings.controller_id = "7777777777777777"
+    host_client = Client(host_settings)
+
+    _, subordinate_settings, _ = subordinate_settings
+    subordinate_settings.controller_id = "8888888888888888"
+    subordinate_client = Client(subordinate_settings)
+
+    subscribe_event = threading.Event()
+
+    def subscribe(client, userdata, mid, granted_qos):
+        subscribe_event.set()
+
+    subordinate_client.set_subscribe_hook(subscribe)
+
+    stored_message = {}
+    message_event = threading.Event()
+
+    def message(client, userdata, message):
+        stored_message["payload"] = message.payload
+        stored_message["topic"] = message.topic
+        message_event.set()
+
+    subordinate_client.set_message_hook(message)
+
+    wait_for_connected(host_client)
+    wait_for_connected(subordinate_client)
+
+    subordinate_client.subscribe(
+        [(f"foris-controller/{shared_forwarder.subordinate.controller_id}/request/+/action/+", 0)]
+    )
+    assert subscribe_event.wait(TIMEOUT)
+
+    host_client.publish(
+        f"foris-controller/{shared_forwarder.subordinate.controller_id}/request/mod/action/act",
+        b'{"some": "request"}',
+    )
+
+    assert message_event.wait(TIMEOUT)
+
+    assert (
+        stored_message["topic"]
+        == f"foris-controller/{shared_forwarder.subordinate.controller_id}/request/mod/action/act"
+    )
+    assert stored_message["payload"] == b'{"some": "request"}'
+
+    wait_for_disconnected(host_client)
+    wait_for_disconnected(subordinate_client)
+
+
+def test_consolidated_subscriptions(host_settings, subordinate_settings, forwarder, wait_for_disconnected):
+    """Wildcard subscriptions should forward only messages of known controllers"""
+    consolidated_forwarder = Forwarder(
+        forwarder.host_conf, forwarder.subordinate_conf, options=ForwarderOptions(consolidated_subscriptions=True)
+    )
+    consolidated_forwarder.start()
+    consolidated_forwarder.wait_for_ready()
+
+    _, host_settings, _ = host_settings
+    host_settings.controller_id = "9999999999999999"
+    host_client = Client(host_settings)
+
+    _, subordinate_settings, _ = subordinate_settings
+    subordinate_settings.controller_id = "AAAAAAAAAAAAAAAA"
+    subordinate_client = Client(subordinate_settings)
+
+    subscribe_event = threading.Event()
+    subordinate_client.set_subscribe_hook(lambda client, userdata, mid, granted_qos: subscribe_event.set())
+
+    topics = []
+    message_event = threading.Event()
+
+    def message(client, userdata, message):
+        topics.append(message.topic)
+        message_event.set()
+
+    subordinate_client.set_message_hook(message)
+
+    wait_for_connected(host_client)
+    wait_for_connected(subordinate_client)
+
+    subordinate_client.subscribe([("foris-controller/+/request/+/action/+", 0)])
+    assert subscribe_event.wait(TIMEOUT)
+
+    # unknown controller is filtered out
+    host_client.publish("foris-controller/0000000000000000/request/mod/action/act", b'{"some": "request"}')
+    host_client.publish(
+        f"foris-controller/{consolidated_forwarder.subordinate.controller_id}/request/mod/action/act",
+        b'{"some": "request"}',
+    )
+
+    assert message_event.wait(TIMEOUT)
+    assert topics == [f"foris-controller/{consolidated_forwarder.subordinate.controller_id}/request/mod/action/act"]
+
+    wait_for_disconnected(host_client)
+    wait_for_disconnected(subordinate_client)
+    consolidated_forwarder.stop()
+    consolidated_forwarder.wait_for_disconnected()
+
+
+def test_reload_subordinate(connected_forwarder):
+    """Reload should not block the caller and repeated reloads should be merged"""
+    previous = connected_forwarder.subordinate
+
+    connected_forwarder.reload_subordinate(connected_forwarder.subordinate_conf)
+    connected_forwarder.reload_subordinate(connected_forwarder.subordinate_conf)
+    assert connected_forwarder.reloading
+
+    start = time.monotonic()
+    while connected_forwarder.reloading:
+        assert time.monotonic() - start < TIMEOUT
+        time.sleep(0.1)
+
+    assert connected_forwarder.subordinate is not previous
+    assert not previous.connected
+    connected_forwarder.subordinate.wait_until_connected(TIMEOUT)
+    assert connected_forwarder.subordinate.connected
+
+
+def test_reload_then_stop(forwarder):
+    """Stop requested during a pending reload should not be undone by the reload"""
+    forwarder.start()
+    forwarder.wait_for_ready()
+
+    forwarder.reload_subordinate(forwarder.subordinate_conf)
+    forwarder.stop()
+
+    start = time.monotonic()
+    while forwarder.reloading:
+        assert time.monotonic() - start < TIMEOUT
+        time.sleep(0.1)
+    assert forwarder.wait_for_disconnected(TIMEOUT)
+
+
+class PendingClient:
+    """Accepts publishes, but never confirms them"""
+
+    connected = True
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, completion=None):
+        self.published.append(payload)
+        return len(self.published)
+
+
+def test_pipelined_publishes():
+    """Publishes don't wait for the confirmations of the previous ones (starting with an empty window)"""
+    forwarder = Forwarder(
+        Host("000000050000005A", 11883, "username", "password"),
+        Subordinate("0000000A00000214", ipaddress.ip_address("127.0.0.1"), 11884, True, FOSQUITTO_DIR),
+        options=ForwarderOptions(inflight_window=4),
+    )
+    client = PendingClient()
+    assert forwarder.host_window.inflight == 0
+
+    for payload in (b"1", b"2", b"3"):
+        message = MQTTMessage(topic=b"foris-controller/0000000A00000214/notification/mod/action/act")
+        message.payload = payload
+        start = time.monotonic()
+        res = forwarder.process(
+            Publish(message), forwarder.host_queue, client, forwarder.host_window, collections.Counter()
+        )
+        assert res is True
+        assert time.monotonic() - start < 1.0
+
+    assert client.published == [b"1", b"2", b"3"]
+    assert forwarder.host_window.inflight == 3
+
+
+def test_fast_fail():
+    """Requests to a disconnected subordinate are answered with an error at once"""
+    forwarder = Forwarder(
+        Host("000000050000005A", 11883, "username", "password"),
+        Subordinate("0000000A00000214", ipaddress.ip_address("127.0.0.1"), 11884, True, FOSQUITTO_DIR, True),
+    )
+    message = MQTTMessage(topic=b"foris-controller/0000000A00000214/request/about/action/get")
+    message.payload = b'{"reply_msg_id": "abc"}'
+    forwarder.host_to_subordinate(None, None, message)
+
+    stats = forwarder.queue_stats()
+    assert stats["subordinate"]["messages"] == 0
+    assert stats["host"]["messages"] == 1
+    assert stats["fast_failed"] == {"requests": 1}
+    queued = [forwarder.host_queue.get(False) for _ in range(forwarder.host_queue.qsize())]
+    replies = [item.message.topic for item in queued if isinstance(item, Publish)]
+    assert replies == ["foris-controller/0000000A00000214/reply/abc"]
+
+    # requests which can't be answered are queued
+    message.payload = b"{}"
+    forwarder.host_to_subordinate(None, None, message)
+    assert forwarder.queue_stats()["subordinate"]["messages"] == 1
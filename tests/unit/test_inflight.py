@@ -0,0 +1,90 @@
+import threading
+import time
+
+from foris_forwarder.inflight import InflightWindow
+
+
+class FakeClient:
+    """Stores completions instead of sending messages"""
+
+    def __init__(self):
+        self.mid = 0
+        self.completions = {}
+        self.topics = []
+
+    def publish(self, topic, data, completion=None):
+        self.mid += 1
+        self.topics.append(topic)
+        self.completions[self.mid] = completion
+        return self.mid
+
+    def confirm(self, mid):
+        self.completions.pop(mid)(mid)
+
+
+def test_window_limit():
+    client = FakeClient()
+    window = InflightWindow("test", 2, 30.0)
+
+    assert window.publish(client, "a/1", b"") is True
+    assert window.publish(client, "a/2", b"") is True
+    assert window.inflight == 2
+
+    # window is full
+    assert window.publish(client, "a/3", b"", timeout=0.1) is None
+
+    # confirmation frees the slot (out of order)
+    client.confirm(2)
+    assert window.completed == 1
+    assert window.publish(client, "a/3", b"", timeout=0.1) is True
+    assert client.topics == ["a/1", "a/2", "a/3"]
+
+
+def test_window_expire():
+    client = FakeClient()
+    window = InflightWindow("test", 1, 0.2)
+
+    assert window.publish(client, "a/1", b"") is True
+
+    # waits only till the oldest message expires
+    assert window.publish(client, "a/2", b"", timeout=5.0) is True
+    assert window.expired == 1
+
+    # late confirmation is ignored
+    client.confirm(1)
+    assert window.completed == 0
+    assert window.inflight == 1
+
+
+def test_window_blocked_publisher():
+    client = FakeClient()
+    window = InflightWindow("test", 1, 30.0)
+    assert window.publish(client, "a/1", b"") is True
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(window.publish(client, "a/2", b"", timeout=30.0)))
+    thread.start()
+    client.confirm(1)
+    thread.join(30.0)
+
+    assert results == [True]
+
+
+def test_window_completed():
+    client = FakeClient()
+    window = InflightWindow("test", 2, 0.2)
+    completed = []
+
+    assert window.publish(client, "a/1", b"", completed=lambda: completed.append("a/1")) is True
+    assert window.publish(client, "a/2", b"", completed=lambda: completed.append("a/2")) is True
+    # called once confirmed, not when passed to the client
+    assert completed == []
+
+    client.confirm(2)
+    assert completed == ["a/2"]
+
+    # expired => not completed
+    time.sleep(0.3)
+    assert window.publish(client, "a/3", b"", timeout=5.0) is True
+    client.confirm(1)
+    assert completed == ["a/2"]
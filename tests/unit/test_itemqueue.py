@@ -0,0 +1,238 @@
+import queue
+import time
+
+import pytest
+
+from foris_forwarder import topics
+from foris_forwarder.itemqueue import DROP_NEWEST, DROP_NOTIFICATIONS_FIRST, DROP_OLDEST, LANE_WEIGHTS, ItemQueue
+
+TIMEOUT = 30.0
+
+
+class Item:
+    sequence = None  # set by the queue
+
+    def __init__(self, name: str, priority: int):
+        self.name = name
+        self.priority = priority
+
+
+class Message(Item):
+    droppable = True
+
+    def __init__(self, name: str, size: int = 1, message_class: str = topics.REQUEST):
+        super().__init__(name, 1)
+        self.size = size
+        self.message_class = message_class
+
+
+def drain(item_queue: ItemQueue):
+    res = []
+    while not item_queue.empty():
+        item = item_queue.get(False)
+        res.append(item if isinstance(item, bool) else item.name)
+    return res
+
+
+def test_priority():
+    item_queue = ItemQueue()
+    for i in range(3):
+        item_queue.put(Item(f"publish{i}", 1))
+    item_queue.put(Item("subscribe", 5))
+    item_queue.put(Item("connect", 10))
+    item_queue.put(True)
+    item_queue.put(Item("publish3", 1))
+
+    assert item_queue.qsize() == 7
+    assert drain(item_queue) == ["connect", "subscribe", True, "publish0", "publish1", "publish2", "publish3"]
+
+
+def test_fifo_within_priority():
+    item_queue = ItemQueue()
+    item_queue.put(Item("connect", 10))
+    item_queue.put(Item("subscribe1", 5))
+    assert drain(item_queue) == ["connect", "subscribe1"]
+
+    item_queue.put(Item("subscribe2", 5))
+    item_queue.put(Item("disconnect", 10))
+    item_queue.put(Item("subscribe3", 5))
+    assert drain(item_queue) == ["disconnect", "subscribe2", "subscribe3"]
+
+
+@pytest.mark.parametrize(
+    "policy,expected",
+    [
+        (DROP_OLDEST, ["connect", "request2", "request4", "notification3"]),
+        (DROP_NEWEST, ["connect", "request1", "request2", "notification0"]),
+        (DROP_NOTIFICATIONS_FIRST, ["connect", "request1", "request2", "request4"]),
+    ],
+)
+def test_overflow_items(policy, expected):
+    item_queue = ItemQueue(max_items=3, overflow_policy=policy)
+    item_queue.put(Message("notification0", message_class=topics.NOTIFICATION))
+    item_queue.put(Message("request1"))
+    item_queue.put(Message("request2"))
+    item_queue.put(Item("connect", 10))  # not counted
+    item_queue.put(Message("notification3", message_class=topics.NOTIFICATION))
+    item_queue.put(Message("request4"))
+
+    stats = item_queue.stats()
+    assert stats["depth"] == 4
+    assert stats["messages"] == 3
+    assert sum(stats["drops"].values()) == 2
+    # dropped items don't block join()
+    assert item_queue.unfinished_tasks == item_queue.qsize() + stats["delayed"]
+    assert drain(item_queue) == expected
+
+
+def test_overflow_bytes():
+    item_queue = ItemQueue(max_bytes=100)
+    item_queue.put(Message("first", 60))
+    item_queue.put(Message("second", 30))
+    assert item_queue.stats()["bytes"] == 90
+
+    item_queue.put(Message("third", 30))
+    assert item_queue.stats()["bytes"] == 60
+    assert item_queue.stats()["drops"] == {DROP_OLDEST: 1}
+    assert drain(item_queue) == ["second", "third"]
+    assert item_queue.stats()["bytes"] == 0
+
+
+def test_flush_expired():
+    item_queue = ItemQueue()
+    for i in range(4):
+        message = Message(f"message{i}")
+        message.expires_at = 10.0 if i % 2 else 20.0
+        item_queue.put(message)
+    item_queue.put(Item("connect", 10))
+
+    assert item_queue.flush_expired(15.0) == 2
+    assert item_queue.flush_expired(15.5) == 0, "flushed recently"
+    assert item_queue.stats()["drops"] == {"expired": 2}
+    assert drain(item_queue) == ["connect", "message0", "message2"]
+
+
+def test_put_later():
+    item_queue = ItemQueue()
+    item_queue.put_later(Item("retried", 5), 0.3)
+    item_queue.put_later(Item("retried_sooner", 5), 0.1)
+
+    with pytest.raises(queue.Empty):
+        item_queue.get(False)
+    assert item_queue.stats()["delayed"] == 2
+
+    start = time.monotonic()
+    assert item_queue.get(timeout=TIMEOUT).name == "retried_sooner"
+    assert item_queue.get(timeout=TIMEOUT).name == "retried"
+    assert time.monotonic() - start >= 0.3
+
+    item_queue.put_later(Item("dropped", 5), 0.1)
+    assert item_queue.clear_delayed() == 1
+    with pytest.raises(queue.Empty):
+        item_queue.get(timeout=0.3)
+
+
+def test_promote_delayed():
+    item_queue = ItemQueue()
+    item_queue.put(Message("retried"))
+    retried = item_queue.get(False)
+    item_queue.put_later(retried, 60.0, hold_lane=True)
+    item_queue.put(Message("newer"))
+    item_queue.put_later(Message("throttled"), 60.0)
+    with pytest.raises(queue.Empty):
+        item_queue.get(False)
+
+    assert item_queue.promote_delayed(lambda item: item.name == "retried") == 1
+    # the held lane is released
+    assert drain(item_queue) == ["retried", "newer"]
+    assert item_queue.stats()["delayed"] == 1
+
+
+def test_merge_delayed():
+    class Notification(Message):
+        def merge(self, other):
+            self.name, self.size = other.name, other.size
+
+    item_queue = ItemQueue(max_bytes=10)
+    held = Notification("first", 1)
+    item_queue.put_later(held, 0.0)
+    assert item_queue.merge_delayed(held, Notification("second", 5))
+
+    item = item_queue.get(timeout=TIMEOUT)
+    assert item.name == "second"
+    assert item_queue.stats()["bytes"] == 0
+
+    # put to the queue already => not merged
+    item_queue.put_later(held, 0.0)
+    item_queue.put(Message("other", 1))
+    item_queue.get(timeout=TIMEOUT)
+    assert not item_queue.merge_delayed(held, Notification("third", 5))
+    assert held.name == "second"
+    assert item_queue.stats()["bytes"] == 5
+    assert not item_queue.merge_delayed(Notification("unknown"), Notification("fourth"))
+
+
+def test_get_next_if():
+    item_queue = ItemQueue()
+    item_queue.put(Item("subscribe1", 5))
+    item_queue.put(Item("subscribe2", 5))
+    item_queue.put(True)
+    item_queue.put(Item("subscribe3", 5))
+
+    def is_item(item):
+        return isinstance(item, Item)
+
+    assert item_queue.get_next_if(is_item).name == "subscribe1"
+    assert item_queue.get_next_if(is_item).name == "subscribe2"
+    # only the next item is checked
+    assert item_queue.get_next_if(is_item) is None
+    assert drain(item_queue) == [True, "subscribe3"]
+    assert item_queue.get_next_if(is_item) is None
+
+
+def test_remove_if():
+    item_queue = ItemQueue()
+    item_queue.put(Item("connect", 10))
+    item_queue.put(Message("publish1"))
+    item_queue.put(Item("subscribe", 5))
+    item_queue.put(True)
+    item_queue.put(Message("publish2"))
+    item_queue.put_later(Message("retried"), 0.0)
+    item_queue.put_later(Item("retried-subscribe", 5), 0.0)
+
+    assert item_queue.remove_if(lambda item: not isinstance(item, (bool, Message))) == 3
+    assert item_queue.unfinished_tasks == item_queue.qsize() + item_queue.stats()["delayed"]
+    assert drain(item_queue) == [True, "publish1", "publish2", "retried"]
+    for _ in range(4):
+        item_queue.task_done()
+    item_queue.join()
+
+
+def test_lanes():
+    item_queue = ItemQueue()
+    for i in range(10):
+        item_queue.put(Message(f"notification{i}", message_class=topics.NOTIFICATION))
+    for i in range(3):
+        item_queue.put(Message(f"request{i}"))
+        item_queue.put(Message(f"reply{i}", message_class=topics.REPLY))
+
+    # interactive traffic first, but notifications are not starved
+    order = drain(item_queue)
+    assert order.index("notification0") < order.index("request2")
+    assert [e for e in order if e.startswith("reply")] == ["reply0", "reply1", "reply2"]
+    assert order.index("reply2") < order.index("request2")
+    assert [e for e in order if e.startswith("notification")] == [f"notification{i}" for i in range(10)]
+
+    # fair share according to weights
+    for i in range(100):
+        item_queue.put(Message(f"notification{i}", message_class=topics.NOTIFICATION))
+        item_queue.put(Message(f"request{i}"))
+    first = drain(item_queue)[:50]
+    share = LANE_WEIGHTS[topics.REQUEST] / (LANE_WEIGHTS[topics.REQUEST] + LANE_WEIGHTS[topics.NOTIFICATION])
+    assert len([e for e in first if e.startswith("request")]) == int(50 * share)
+
+    # a single lane
+    item_queue = ItemQueue(lane_weights={})
+    item_queue.put(Message("notification", message_class=topics.NOTIFICATION))
+    item_queue.put(Message("reply", message_class=topics.REPLY))
+    assert drain(item_queue) == ["notification", "reply"]
@@ -0,0 +1,142 @@
+import collections
+import logging
+
+from paho.mqtt.client import MQTTMessage
+
+from foris_forwarder.client import SubscriptionRegistry
+from foris_forwarder.configuration import ForwarderOptions
+from foris_forwarder.itemqueue import ItemQueue
+from foris_forwarder.items import SUBSCRIBE_FAILURE, ItemProcessor, Publish, Subscribe, Unsubscribe
+
+
+class FakeClient:
+    """Confirms subscriptions at once and rejects topics from `forbidden`"""
+
+    connected = True
+
+    def __init__(self, forbidden=()):
+        self.forbidden = set(forbidden)
+        self.subscriptions = SubscriptionRegistry()
+        self.subscribed = []
+        self.unsubscribed = []
+        self.published = []
+        self.publish_calls = 0
+        self.failing_publishes = set()
+
+    def subscribe(self, topics, completion=None):
+        self.subscribed.append([topic for topic, _ in topics])
+        granted_qos = [SUBSCRIBE_FAILURE if topic in self.forbidden else qos for topic, qos in topics]
+        self.subscriptions.confirm(topics, granted_qos)
+        completion(1, granted_qos)
+        return True
+
+    def unsubscribe(self, topics, completion=None):
+        self.unsubscribed.append(list(topics))
+        completion(1)
+        return True
+
+    def publish(self, topic, payload, completion=None):
+        self.publish_calls += 1
+        if self.publish_calls in self.failing_publishes:
+            return None
+        self.published.append(payload)
+        completion(1)
+        return 1
+
+
+class Processor(ItemProcessor):
+    logger = logging.getLogger(__file__)
+
+    def __init__(self, options):
+        self.options = options
+
+    def __str__(self):
+        return "processor"
+
+
+def test_coalesce():
+    processor = Processor(ForwarderOptions(subscribe_batch_size=3))
+    client = FakeClient()
+    item_queue = ItemQueue()
+    for name in ("a", "b", "c", "d"):
+        item_queue.put(Subscribe([(f"{name}/1", 0)]))
+    item_queue.put(Unsubscribe(["a/1"]))
+    item_queue.put(Unsubscribe(["b/1"]))
+
+    while not item_queue.empty():
+        processor.process(item_queue.get(False), item_queue, client, None, collections.Counter())
+
+    assert client.subscribed == [["a/1", "b/1", "c/1"], ["d/1"]]
+    assert client.unsubscribed == [["a/1", "b/1"]]
+
+
+def test_rejected_topics_retried():
+    processor = Processor(ForwarderOptions(retry_base_delay=0.01))
+    client = FakeClient(forbidden=["b/1"])
+    item_queue = ItemQueue()
+    retries = collections.Counter()
+
+    assert processor.process(Subscribe([("a/1", 0), ("b/1", 0)]), item_queue, client, None, retries) is False
+    assert retries["retries"] == 1
+
+    # only the rejected topic is planned again
+    client.forbidden = set()
+    item = item_queue.get(timeout=5.0)
+    assert item.topics_with_qos == [("b/1", 0)]
+    assert processor.process(item, item_queue, client, None, retries) is True
+
+
+def test_retry_now():
+    processor = Processor(ForwarderOptions(retry_base_delay=60.0))
+    client = FakeClient(forbidden=["a/1"])
+    item_queue = ItemQueue()
+    retries = collections.Counter()
+
+    item = Subscribe([("a/1", 0)])
+    item.attempt_number = 100  # retried till it succeeds by default
+    assert processor.process(item, item_queue, client, None, retries) is False
+    assert retries == {"failures": 1, "retries": 1}
+    assert item_queue.empty()
+
+    # e.g. reconnected, the backoff starts again
+    assert processor.retry_now(item_queue) == 1
+    assert item_queue.get(False) is item
+    assert item.attempt_number == 0
+
+
+def test_session_subscriptions_skipped():
+    processor = Processor(ForwarderOptions())
+    client = FakeClient()
+    client.subscriptions.add([("a/1", 0)])
+
+    assert processor.process(Subscribe([("a/1", 0)]), ItemQueue(), client, None, collections.Counter()) is True
+    assert client.subscribed == []
+
+    assert processor.process(Subscribe([("a/1", 0), ("b/1", 0)]), ItemQueue(), client, None, collections.Counter())
+    assert client.subscribed == [["b/1"]]
+
+
+def test_retried_publishes_ordered():
+    processor = Processor(ForwarderOptions(retry_base_delay=0.05))
+    client = FakeClient()
+    client.failing_publishes = {1, 4}  # first attempts of "1" and "2"
+    item_queue = ItemQueue()
+    retries = collections.Counter()
+
+    def publish(topic, payload):
+        message = MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        item_queue.put(Publish(message))
+
+    for payload in (b"1", b"2", b"3"):
+        publish("foris-controller/0000000A00000214/notification/mod/action/act", payload)
+
+    while len(client.published) < 4:
+        processor.process(item_queue.get(timeout=5.0), item_queue, client, None, retries)
+        if client.publish_calls == 1:
+            publish("foris-controller/0000000A00000214/reply/1", b"reply")
+
+    assert retries["retries"] == 2
+    # other lanes are not held
+    assert client.published[0] == b"reply"
+    assert client.published[1:] == [b"1", b"2", b"3"]
@@ -0,0 +1,64 @@
+import pytest
+
+from foris_forwarder import latency
+from foris_forwarder.latency import BUCKETS, Histogram, LatencyTracker
+
+GET = "foris-controller/0000000A00000214/request/wifi/action/get_settings"
+SCHEMA = "foris-controller/0000000A00000214/schema"
+REPLY = "foris-controller/0000000A00000214/reply/"
+
+
+def request(tracker: LatencyTracker, topic: str, reply_id: str, now: float):
+    tracker.request(topic, b'{"reply_msg_id": "%s"}' % reply_id.encode(), now)
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.quantile(0.5) is None
+    for value in (0.0005, 0.003, 0.003, 0.1, 1000.0):
+        histogram.observe(value)
+    assert histogram.count == 5
+    assert sum(histogram.counts) == 5
+    assert histogram.counts[0] == 1
+    assert histogram.counts[-1] == 1
+    assert histogram.quantile(0.5) == BUCKETS[2]
+    assert histogram.quantile(1.0) == float("inf")
+
+
+def test_tracker():
+    tracker = LatencyTracker("test")
+    request(tracker, GET, "1", 10.0)
+    request(tracker, GET, "2", 10.0)
+    request(tracker, SCHEMA, "3", 10.0)
+    tracker.reply(REPLY + "1", 10.01)
+    tracker.reply(REPLY + "3", 10.5)
+    tracker.reply(REPLY + "unknown", 10.5)
+
+    histograms = tracker.histograms(11.0)
+    get = histograms[("0000000A00000214", "wifi", "get_settings")]
+    assert get.count == 1
+    assert get.sum == pytest.approx(0.01)
+    assert histograms[("0000000A00000214", "", "schema")].count == 1
+
+    # no reply for too long
+    assert tracker.stats(11.0)["pending"] == 1
+    stats = tracker.stats(10.0 + latency.REPLY_TIMEOUT)
+    assert stats["pending"] == 0
+    assert stats["unanswered"] == 1
+    assert stats["answered"] == 2
+
+
+def test_bounds(monkeypatch):
+    monkeypatch.setattr(latency, "MAX_SERIES", 1)
+    monkeypatch.setattr(latency, "MAX_PENDING", 2)
+    tracker = LatencyTracker("test")
+    request(tracker, GET, "1", 10.0)
+    request(tracker, SCHEMA, "2", 10.0)
+    request(tracker, GET, "3", 10.0)  # 1 is forgotten
+    for reply_id in "123":
+        tracker.reply(REPLY + reply_id, 10.1)
+
+    histograms = tracker.histograms(10.1)
+    assert histograms[("0000000A00000214", "wifi", "get_settings")].count == 1
+    assert histograms[("0000000A00000214", "wifi", "get_settings")].unanswered == 1
+    assert histograms[("0000000A00000214", latency.OTHER, latency.OTHER)].count == 1
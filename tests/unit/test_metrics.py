@@ -0,0 +1,87 @@
+import http.client
+import socket
+import types
+
+from foris_forwarder.itemqueue import ItemQueue
+from foris_forwarder.latency import LatencyTracker
+from foris_forwarder.metrics import DirectionMetrics, MetricsServer, collect
+
+CONTROLLER_ID = "0000000A00000214"
+
+
+def supervisor():
+    subordinate_metrics = DirectionMetrics()
+    subordinate_metrics.published(10, 0.002)
+    subordinate_metrics.connects = 2
+    latency = LatencyTracker(CONTROLLER_ID)
+    latency.request(f"foris-controller/{CONTROLLER_ID}/request/about/action/get", b'{"reply_msg_id": "1"}', 1.0)
+    latency.reply(f"foris-controller/{CONTROLLER_ID}/reply/1", 1.5)
+    forwarder = types.SimpleNamespace(
+        subordinate_conf=types.SimpleNamespace(controller_id=CONTROLLER_ID),
+        host=types.SimpleNamespace(connected=True, connect_count=1),
+        subordinate=types.SimpleNamespace(connected=False, connect_count=1),
+        host_metrics=DirectionMetrics(),
+        subordinate_metrics=subordinate_metrics,
+        multiplexer=None,
+        latency=latency,
+        queue_stats=lambda: {"host": ItemQueue().stats(), "subordinate": ItemQueue().stats()},
+    )
+    return types.SimpleNamespace(forwarder=forwarder, switches=3)
+
+
+def test_collect():
+    lines = collect([supervisor()]).splitlines()
+    labels = f'controller_id="{CONTROLLER_ID}",direction="to_subordinate"'
+    assert f"foris_forwarder_messages_total{{{labels}}} 1" in lines
+    assert f"foris_forwarder_bytes_total{{{labels}}} 10" in lines
+    assert f'foris_forwarder_publish_duration_seconds_bucket{{{labels},le="0.002"}} 1' in lines
+    assert f'foris_forwarder_publish_duration_seconds_bucket{{{labels},le="+Inf"}} 1' in lines
+    assert f'foris_forwarder_connects_total{{controller_id="{CONTROLLER_ID}",connection="subordinate"}} 3' in lines
+    assert f'foris_forwarder_connected{{controller_id="{CONTROLLER_ID}",connection="subordinate"}} 0' in lines
+    assert f'foris_forwarder_netloc_switches_total{{controller_id="{CONTROLLER_ID}"}} 3' in lines
+    request = f'controller_id="{CONTROLLER_ID}",module="about",action="get"'
+    assert f"foris_forwarder_request_duration_seconds_count{{{request}}} 1" in lines
+    assert lines.count("# TYPE foris_forwarder_queue_depth gauge") == 1
+
+
+def test_collect_shared_host():
+    multiplexer = types.SimpleNamespace(
+        host_conf=types.SimpleNamespace(controller_id="000000050000005A"),
+        client=types.SimpleNamespace(connected=True, connect_count=2),
+    )
+    supervisors = [supervisor(), supervisor()]
+    for e in supervisors:
+        e.forwarder.multiplexer = multiplexer
+        e.forwarder.host = multiplexer.client
+
+    lines = collect(supervisors).splitlines()
+    connects = [line for line in lines if line.startswith("foris_forwarder_connects_total")]
+    assert 'foris_forwarder_connects_total{controller_id="000000050000005A",connection="host"} 2' in connects
+    assert len([line for line in connects if 'connection="host"' in line]) == 1
+
+
+def test_unix_socket(tmp_path):
+    path = str(tmp_path / "metrics.sock")
+    server = MetricsServer(path, lambda: collect([supervisor()]))
+    server.start()
+    try:
+        connection = http.client.HTTPConnection("localhost")
+        connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.sock.connect(path)
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        assert response.status == 200
+        assert b"foris_forwarder_messages_total" in response.read()
+    finally:
+        server.stop()
+
+
+def test_http():
+    server = MetricsServer("127.0.0.1:0", lambda: "")
+    server.start()
+    try:
+        connection = http.client.HTTPConnection(*server.server.server_address)
+        connection.request("GET", "/unknown")
+        assert connection.getresponse().status == 404
+    finally:
+        server.stop()
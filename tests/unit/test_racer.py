@@ -0,0 +1,128 @@
+import concurrent.futures
+import socket
+import threading
+
+import pytest
+
+from foris_forwarder.client import Settings
+from foris_forwarder.racer import Attempt, ConnectionRace, connect_packet
+
+TIMEOUT = 5.0
+
+
+def settings(port):
+    res = Settings()
+    res.controller_id = "0000000A00000214"
+    res.host = "127.0.0.1"
+    res.port = port
+    return res
+
+
+@pytest.fixture
+def broker():
+    """Listens and answers CONNECT with CONNACK after `delay` (None = never answers)"""
+    servers = []
+
+    def listen(return_code=0, delay=0.0):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        servers.append(server)
+        release = threading.Event()
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except OSError:
+                    return
+                conn.recv(1024)
+                if delay is not None:
+                    release.wait(delay)
+                    conn.sendall(bytes([0x20, 0x02, 0x00, return_code]))
+
+        threading.Thread(target=serve, daemon=True).start()
+        return server.getsockname()[1]
+
+    yield listen
+
+    for server in servers:
+        server.close()
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run(candidates, **kwargs):
+    finished = threading.Event()
+    race = ConnectionRace(
+        "test", [(port, settings(port)) for port in candidates], lambda race: finished.set(), **kwargs
+    )
+    race.start()
+    assert finished.wait(TIMEOUT)
+    return race
+
+
+def test_connect_packet():
+    packet = connect_packet("id", "user", "pass")
+    assert packet[0] == 0x10
+    assert packet[1] == len(packet) - 2
+    assert packet[2:8] == b"\x00\x04MQTT"
+    assert packet[8:10] == bytes([4, 0xC2])
+
+    assert connect_packet("x" * 200)[1:3] == bytes([(212 % 128) | 0x80, 1])
+
+
+def test_first_reachable_wins(broker):
+    refused = closed_port()
+    rejecting = broker(return_code=5)
+    reachable = broker()
+    race = run([refused, rejecting, reachable], stagger=1.0)
+
+    assert race.winner.netloc == reachable
+    assert race.winner.latency is not None
+    # failed attempts start the next one at once
+    assert race.winner.started - race.attempts[0].started < 1.0
+    assert all(attempt.error for attempt in race.losers())
+
+
+def test_slow_cancelled(broker):
+    silent = broker(delay=None)
+    reachable = broker()
+    race = run([silent, reachable], stagger=0.1)
+
+    assert race.winner.netloc == reachable
+    loser = race.losers()[0]
+    assert loser.cancelled
+    assert loser.cancelled_after >= 0.1
+
+
+def test_nothing_reachable():
+    race = run([closed_port(), closed_port()])
+    assert race.winner is None
+    assert len(race.losers()) == 2
+
+
+def test_bounded_pool(broker):
+    reachable = broker()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="test-attempt")
+    race = run([closed_port(), closed_port(), reachable], stagger=0.0, executor=executor)
+
+    assert race.winner.netloc == reachable
+    assert len([thread for thread in threading.enumerate() if thread.name.startswith("test-attempt")]) == 1
+    executor.shutdown()
+
+
+def test_cancelled_before_start(broker):
+    port = broker()
+    attempt = Attempt(port, settings(port), "test")
+    attempt.cancel()
+    attempt.run(TIMEOUT)
+    # attempts waiting for a free worker are not started at all
+    assert attempt.started is None
+    assert not attempt.finished
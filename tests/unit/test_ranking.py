@@ -0,0 +1,98 @@
+from foris_forwarder.ranking import DECAY, REFRESH_PERIOD, NetlocRanker, NetlocStat
+
+
+def test_order():
+    ranker = NetlocRanker()
+    ranker.add("old", NetlocStat(0, 1.0))
+    ranker.add("new", NetlocStat(0, 2.0))
+    ranker.add("failing", NetlocStat(1, 3.0))
+    assert ranker.ranked() == ["new", "old", "failing"], "youngest first, most failures last"
+    assert ranker.best() == "new"
+
+    # statistics changed in place are reflected
+    ranker.get("failing").fail_count = 0
+    assert ranker.best() == "failing"
+    ranker.get("old").when = 4.0
+    assert ranker.top(2) == ["old", "failing"]
+    assert len(ranker) == 3
+
+
+def test_latency():
+    ranker = NetlocRanker()
+    ranker.add("vpn", NetlocStat(0, 2.0))
+    ranker.add("lan", NetlocStat(0, 1.0))
+    ranker.get("vpn").observe(10.0, True, 0.2)
+    ranker.get("lan").observe(10.0, True, 0.002)
+    assert ranker.ranked() == ["lan", "vpn"], "faster first"
+
+    # unreliable netloc is more expensive
+    for _ in range(5):
+        ranker.get("lan").observe(11.0, False)
+    assert ranker.ranked() == ["vpn", "lan"]
+
+    # cancelled attempt only raises the estimate
+    stat = ranker.get("vpn")
+    stat.observe_slower(12.0, 0.1)
+    assert stat.latency == 0.2
+    stat.observe_slower(12.0, 0.5)
+    assert 0.2 < stat.latency < 0.5
+
+
+def test_decay():
+    stat = NetlocStat(0, 0.0)
+    stat.observe(0.0, True, 1.0)
+    stat.observe(1.0, True, 0.0)
+    recent = stat.latency
+
+    stat = NetlocStat(0, 0.0)
+    stat.observe(0.0, True, 1.0)
+    stat.observe(100000.0, True, 0.0)
+    assert stat.latency < recent, "old samples weigh less"
+
+
+def test_time_decay():
+    now = [0.0]
+    ranker = NetlocRanker(lambda: now[0])
+    ranker.add("stale", NetlocStat(0, 0.0))
+    ranker.add("recent", NetlocStat(0, 0.0))
+    ranker.get("stale").observe(0.0, True, 0.1)
+    ranker.get("recent").observe(0.0, True, 0.5)
+    assert ranker.best() == "stale"
+
+    # not observed for a long time => expected latency is getting back to the default
+    now[0] = 2 * DECAY
+    ranker.get("recent").observe(now[0], True, 0.5)
+    assert ranker.best() == "recent"
+    assert ranker.get("stale").latency == 0.1, "statistics themselves are kept"
+
+
+def test_refresh():
+    now = [0.0]
+    ranker = NetlocRanker(lambda: now[0])
+    ranker.add("failing", NetlocStat(0, 0.0))
+    ranker.add("slow", NetlocStat(0, 0.0))
+    for _ in range(5):
+        ranker.get("failing").observe(0.0, False)
+    ranker.get("slow").observe(0.0, True, 3.0)
+    assert ranker.best() == "slow"
+
+    # keys of netlocs which don't change are recomputed as well
+    now[0] = 5 * DECAY
+    ranker.get("slow").observe(now[0], True, 3.0)
+    assert ranker.best() == "failing", "failures weigh less over time"
+    assert now[0] - ranker.now < REFRESH_PERIOD
+
+
+def test_trim_and_compaction():
+    ranker = NetlocRanker()
+    for index in range(10):
+        ranker.add(index, NetlocStat(0, float(index)))
+    for when in range(100):
+        ranker.get(0).when = 100.0 + when
+    assert len(ranker._heap) <= 2 * len(ranker) + 16
+
+    ranker.trim(3)
+    assert ranker.ranked() == [0, 9, 8]
+    ranker.remove(9)
+    assert 9 not in ranker
+    assert ranker.ranked() == [0, 8]
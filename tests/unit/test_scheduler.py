@@ -0,0 +1,37 @@
+import threading
+import time
+
+from foris_forwarder.scheduler import Scheduler
+
+
+def test_deadlines():
+    scheduler = Scheduler()
+    scheduler.schedule("a", 20.0)
+    scheduler.schedule("b", 10.0)
+    scheduler.schedule("c", None)
+    assert scheduler.next_due() == 10.0
+
+    # the earliest plan wins
+    scheduler.schedule("a", 30.0)
+    scheduler.schedule("b", 5.0)
+    assert scheduler.pop_due(9.0) == ["b"]
+    assert scheduler.pop_due(9.0) == []
+    assert scheduler.next_due() == 20.0
+    assert scheduler.pop_due(100.0) == ["a"]
+    assert scheduler.next_due() is None
+
+
+def test_wait():
+    woken = []
+    scheduler = Scheduler(lambda: woken.append(True))
+    assert scheduler.wait(0.05) == []
+
+    scheduler.schedule("later", time.monotonic() + 0.1)
+    start = time.monotonic()
+    assert scheduler.wait() == ["later"]
+    assert time.monotonic() - start >= 0.09
+
+    # notified from a different thread
+    threading.Timer(0.05, scheduler.notify, ("event",)).start()
+    assert scheduler.wait(30.0) == ["event"]
+    assert woken == [True]
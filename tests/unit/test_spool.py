@@ -0,0 +1,70 @@
+from foris_forwarder.spool import DROP_SPOOL_FULL, DROP_TOO_LARGE, HEADER, RECORD, Spool
+
+SEGMENT_SIZE = HEADER.size + 3 * (RECORD.size + len("a/0") + 8)  # 3 records per segment
+
+
+def append(spool: Spool, count: int, start: int = 0):
+    for i in range(start, start + count):
+        assert spool.append(f"a/{i}", b"%08d" % i, 1000.0 + i)
+
+
+def replay(spool: Spool, batch: int = 2):
+    res = []
+    while True:
+        records = spool.read(batch)
+        if not records:
+            return res
+        for record in records:
+            res.append(record.topic)
+            spool.commit(record.position)
+
+
+def test_order(tmp_path):
+    spool = Spool(tmp_path, SEGMENT_SIZE, 4)
+    assert spool.empty
+    append(spool, 7)
+    assert not spool.empty
+    assert spool.stats()["segments"] == 3
+
+    assert replay(spool) == [f"a/{i}" for i in range(7)]
+    assert spool.empty
+    assert spool.stats()["segments"] == 1
+
+
+def test_uncommitted(tmp_path):
+    spool = Spool(tmp_path, SEGMENT_SIZE, 4)
+    append(spool, 2)
+
+    first = spool.read(2)
+    assert [e.payload for e in first] == [b"00000000", b"00000001"]
+    assert first[0].created == 1000.0
+
+    # only the first one was sent
+    spool.commit(first[0].position)
+    assert [e.topic for e in spool.read(2)] == ["a/1"]
+
+
+def test_restart(tmp_path):
+    spool = Spool(tmp_path, SEGMENT_SIZE, 4)
+    append(spool, 5)
+    records = spool.read(1)
+    spool.commit(records[0].position)
+    spool.close()
+    assert not spool.append("a/5", b"", 0.0)
+
+    spool = Spool(tmp_path, SEGMENT_SIZE, 4)
+    append(spool, 1, 5)
+    assert replay(spool) == [f"a/{i}" for i in range(1, 6)]
+
+
+def test_full(tmp_path):
+    spool = Spool(tmp_path, SEGMENT_SIZE, 2)
+    append(spool, 7)
+
+    # the oldest segment was dropped
+    assert spool.stats() == {"segments": 2, "drops": {DROP_SPOOL_FULL: 1}}
+    assert replay(spool) == [f"a/{i}" for i in range(3, 7)]
+
+    assert not spool.append("a/large", b"x" * SEGMENT_SIZE, 0.0)
+    assert spool.stats()["drops"][DROP_TOO_LARGE] == 1
+    assert len(list(tmp_path.iterdir())) == 1
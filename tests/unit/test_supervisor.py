@@ -15,6 +15,7 @@ def test_ip_workflow(forwarder, mosquitto_subordinate):
     fs.zconf_update([ip("192.168.1.1")], 11883)
     assert fs.netlocs == [(ip("192.168.1.1"), 11883), (ip("127.0.0.1"), 11884)], "One addded"
     assert fs.current_netloc == (ip("127.0.0.1"), 11884)
+    assert fs.races == 1, "Raced when not connected yet"
 
     fs.zconf_update([ip("192.168.2.1"), ip("192.168.2.2")], 11880)
     assert fs.netlocs == [
@@ -0,0 +1,69 @@
+import pytest
+
+from foris_forwarder import throttle
+from foris_forwarder.throttle import NotificationThrottle
+
+TOPIC = "foris-controller/0000000A00000214/notification/wifi/action/update_settings"
+OTHER = "foris-controller/0000000A00000214/notification/netmetr/action/status"
+
+
+class Value:
+    def __init__(self, value: int):
+        self.value = value
+
+    def merge(self, other: "Value"):
+        self.value = other.value
+
+
+def test_rate_limit():
+    limiter = NotificationThrottle("test", 2.0, 2, 0.0)
+    assert limiter.offer(TOPIC, Value(1), 10.0) == 0.0
+    assert limiter.offer(TOPIC, Value(2), 10.0) == 0.0
+    assert limiter.offer(TOPIC, Value(3), 10.0) is None
+    # other topics are not affected
+    assert limiter.offer(OTHER, Value(1), 10.0) == 0.0
+    # token refilled
+    assert limiter.offer(TOPIC, Value(4), 10.5) == 0.0
+    assert limiter.offer(TOPIC, Value(5), 10.5) is None
+    assert limiter.stats() == {"topics": 2, "passed": 4, "held": 0, "merged": 0, "dropped": 2}
+
+
+def test_window():
+    limiter = NotificationThrottle("test", 0.0, 1, 0.5)
+    held = Value(1)
+    assert limiter.offer(TOPIC, held, 10.0) == 0.5
+    assert limiter.offer(TOPIC, Value(2), 10.2) is None
+    assert limiter.offer(TOPIC, Value(3), 10.4) is None
+    assert held.value == 3, "the latest value wins"
+
+    # window passed => held again
+    assert limiter.offer(TOPIC, Value(4), 10.5) == 0.5
+    assert limiter.stats()["merged"] == 2
+
+
+def test_held_sent_meanwhile():
+    limiter = NotificationThrottle("test", 0.0, 1, 0.5)
+    held = Value(1)
+    assert limiter.offer(TOPIC, held, 10.0) == 0.5
+    # the held notification is not waiting anymore => the new one is held on its own
+    assert limiter.offer(TOPIC, Value(2), 10.2, lambda held, item: False) == 0.5
+    assert held.value == 1
+    assert limiter.stats()["merged"] == 0
+
+
+def test_window_with_rate():
+    limiter = NotificationThrottle("test", 1.0, 1, 0.1)
+    assert limiter.offer(TOPIC, Value(1), 10.0) == pytest.approx(0.1)
+    # next token is available at 11.1
+    assert limiter.offer(TOPIC, Value(2), 10.2) == pytest.approx(0.9)
+    assert limiter.offer(TOPIC, Value(3), 10.5) is None
+    assert limiter.stats()["dropped"] == 0
+
+
+def test_prune(monkeypatch):
+    monkeypatch.setattr(throttle, "MAX_TOPICS", 2)
+    limiter = NotificationThrottle("test", 1.0, 1, 0.0)
+    limiter.offer(TOPIC, Value(1), 10.0)
+    limiter.offer(OTHER, Value(1), 10.0)
+    limiter.offer(TOPIC + "x", Value(1), 20.0)
+    assert limiter.stats()["topics"] == 1
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from foris_forwarder import topics
+
+
+@pytest.mark.parametrize(
+    "topic,message_class",
+    [
+        ("foris-controller/0000000A00000214/request/about/action/get", topics.REQUEST),
+        ("foris-controller/0000000A00000214/request/about/list", topics.LIST),
+        ("foris-controller/0000000A00000214/list", topics.LIST),
+        ("foris-controller/0000000A00000214/schema", topics.LIST),
+        ("foris-controller/0000000A00000214/reply/2f3c7d2e-1b7e-11eb-a4d3-0800273d7fb1", topics.REPLY),
+        ("foris-controller/0000000A00000214/notification/wifi/action/update_settings", topics.NOTIFICATION),
+        ("foris-controller/0000000A00000214", topics.UNKNOWN),
+        ("/messaging-test/first", topics.UNKNOWN),
+    ],
+)
+def test_message_class(topic, message_class):
+    assert topics.message_class(topic) == message_class
+
+
+def test_is_routed():
+    controller_ids = frozenset(["0000000A00000214", "0000000D30000010"])
+    assert topics.is_routed("foris-controller/0000000A00000214/request/about/action/get", controller_ids)
+    assert not topics.is_routed("foris-controller/0000000B00000001/request/about/action/get", controller_ids)
+    assert not topics.is_routed("foris-controller", controller_ids)
+    assert topics.host_topics(topics.WILDCARD)[0] == ("foris-controller/+/request/+/action/+", 0)
+
+
+def test_error_reply():
+    request = "foris-controller/0000000A00000214/request/about/action/get"
+    error = topics.error_reply(request, b'{"reply_msg_id": "abc", "data": {}}', "unreachable")
+    assert error.topic == "foris-controller/0000000A00000214/reply/abc"
+    assert json.loads(error.payload) == {
+        "module": "about",
+        "action": "get",
+        "kind": "reply",
+        "data": {"errors": [{"description": "unreachable", "stacktrace": ""}]},
+    }
+    listing = topics.error_reply("foris-controller/0000000A00000214/request/about/list", b'{"reply_msg_id": "x"}', "")
+    assert json.loads(listing.payload)["action"] == "list"
+
+    # can't be answered
+    assert topics.error_reply(request, b"{}", "unreachable") is None
+    assert topics.error_reply(request, b"invalid", "unreachable") is None
+    assert topics.error_reply("foris-controller/0000000A00000214/list", b'{"reply_msg_id": "x"}', "") is None
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from foris_forwarder.itemqueue import ItemQueue
+from foris_forwarder.workers import QueueWorkers, Wait
+
+TIMEOUT = 30.0
+
+
+class Item:
+    def __init__(self, name: str, priority: int = 1):
+        self.name = name
+        self.priority = priority
+
+
+class Collector:
+    def __init__(self, expected: int):
+        self.names = []
+        self.expected = expected
+        self.done = threading.Event()
+
+    def __call__(self, item):
+        if item is False:
+            return False
+        self.names.append(item.name)
+        if len(self.names) == self.expected:
+            self.done.set()
+        return True
+
+
+def test_order():
+    workers = QueueWorkers(2)
+    workers.start()
+    collectors = [Collector(20) for _ in range(5)]
+    queues = [ItemQueue() for _ in collectors]
+    for item_queue, collector in zip(queues, collectors):
+        workers.add(item_queue, collector)
+
+    for i in range(20):
+        for number, item_queue in enumerate(queues):
+            item_queue.put(Item(f"{number}-{i}"))
+
+    for number, collector in enumerate(collectors):
+        assert collector.done.wait(TIMEOUT)
+        assert collector.names == [f"{number}-{i}" for i in range(20)]
+
+    assert len(workers.threads) == 2
+    workers.stop()
+
+
+def test_put_later():
+    workers = QueueWorkers(1)
+    workers.start()
+    collector = Collector(2)
+    item_queue = ItemQueue()
+    workers.add(item_queue, collector)
+
+    start = time.monotonic()
+    item_queue.put_later(Item("delayed"), 0.2)
+    item_queue.put(Item("first"))
+    assert collector.done.wait(TIMEOUT)
+    assert collector.names == ["first", "delayed"]
+    assert time.monotonic() - start >= 0.2
+    workers.stop()
+
+
+def test_wait():
+    workers = QueueWorkers(1)
+    workers.start()
+    waits = []
+    resumed = []
+    done = threading.Event()
+
+    def handler(item):
+        if item.name.startswith("wait"):
+            wait = Wait(0.2 if item.name == "wait-timeout" else TIMEOUT, lambda finished: resumed.append(finished))
+            waits.append(wait)
+            return wait
+        resumed.append(item.name)
+        if item.name == "last":
+            done.set()
+        return True
+
+    item_queue = ItemQueue()
+    other_queue = ItemQueue()
+    other_done = threading.Event()
+    workers.add(item_queue, handler)
+    workers.add(other_queue, lambda item: other_done.set())
+
+    item_queue.put(Item("wait-finish"))
+    item_queue.put(Item("after-finish"))
+    # the only worker is not blocked by the wait
+    other_queue.put(Item("other"))
+    assert other_done.wait(TIMEOUT)
+    assert resumed == []
+
+    waits[0].finish()
+    item_queue.put(Item("wait-timeout"))
+    item_queue.put(Item("last"))
+    assert done.wait(TIMEOUT)
+    assert resumed == [True, "after-finish", False, "last"]
+    workers.stop()